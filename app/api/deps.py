@@ -1,9 +1,13 @@
 from app.core.deps import DepsContainer, ServiceFactory
-from fastapi import Depends, Request
+from typing import Annotated
 
+from fastapi import Depends, Path
+from fastapi.requests import HTTPConnection
 
-async def deps_container(request: Request):
-    yield request.app.deps
+
+async def deps_container(conn: HTTPConnection):
+    # HTTPConnection同时适用于HTTP请求和WebSocket
+    yield conn.app.deps
 
 
 async def get_user_service(deps: DepsContainer = Depends(deps_container)):
@@ -11,5 +15,28 @@ async def get_user_service(deps: DepsContainer = Depends(deps_container)):
         yield service
 
 
-async def get_file_upload_service(deps: DepsContainer = Depends(deps_container)):
-    yield await ServiceFactory(deps).file_uploader()
+def get_client_id(conn: HTTPConnection) -> str | None:
+    # 按来源地址区分客户端；请求经过可信的反向代理时使用代理传过来的X-Client-Id
+    host = conn.client.host if conn.client else None
+    client_id = conn.headers.get("x-client-id")
+    if client_id and host in conn.app.deps.file_upload_settings().trusted_proxies:
+        return client_id
+    return host
+
+
+async def get_upload_timings(deps: DepsContainer = Depends(deps_container)):
+    yield deps.upload_timings()
+
+
+async def get_file_upload_service(
+    deps: DepsContainer = Depends(deps_container),
+    client_id: str | None = Depends(get_client_id),
+):
+    yield await ServiceFactory(deps).file_uploader(client_id)
+
+
+async def get_bucket_file_service(
+    bucket: Annotated[str, Path(pattern=r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")],
+    deps: DepsContainer = Depends(deps_container),
+):
+    yield await ServiceFactory(deps).file_uploader(bucket_name=bucket)
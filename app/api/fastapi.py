@@ -6,7 +6,8 @@ from fastapi import FastAPI
 
 from app.core.deps import DepsContainer
 from app.api.routers import users_router, items_router
-from app.api.file_router import file_router
+from app.api.file_router import file_router, upload_rejected_handler
+from app.core.file_storage.admission import UploadRejected
 
 
 def create_app() -> FastAPI:
@@ -32,6 +33,7 @@ def create_app() -> FastAPI:
     app.include_router(users_router)
     app.include_router(items_router)
     app.include_router(file_router)
+    app.add_exception_handler(UploadRejected, upload_rejected_handler)
     return app
 
 
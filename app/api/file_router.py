@@ -1,20 +1,80 @@
+from email.utils import formatdate
+from time import perf_counter
 from typing import Annotated
 from uuid import UUID
-from fastapi import APIRouter, Depends, Form, Request
-from fastapi.responses import StreamingResponse
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    Form,
+    HTTPException,
+    Path,
+    Request,
+    WebSocket,
+)
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from fastapi.routing import APIRoute
 from sse_starlette import EventSourceResponse, JSONServerSentEvent
 
-from app.api.deps import get_file_upload_service
+from app.api.deps import (
+    get_bucket_file_service,
+    get_file_upload_service,
+    get_upload_timings,
+)
+from app.core.file_storage.checksum import parse_checksum
+from app.core.file_storage.encoding import supported_encodings
 from app.core.file_storage.schemas import (
+    FileChunkEncoding,
     FileChunkUploadResponse,
     FileUploadTaskCreate,
     FileUploadTaskPublic,
+    FileUploadTaskQueryResult,
     FileChunkUploadRequest,
+    FileUploadRequest,
 )
+from app.core.file_storage.admission import UploadRejected, retry_after_header
+from app.core.file_storage.file_response import StorageFileResponse, is_not_modified
+from app.core.file_storage.file_upload import FileTooLarge
+from app.core.file_storage.metrics import StageTimings, UploadStage
 from app.services import FileUploadService
 
 
-file_router = APIRouter(prefix="/file", tags=["file"])
+class TimedRoute(APIRoute):
+    """
+    记录请求进入路由的时间，处理函数里可以算出请求体解析的耗时
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request) -> Response:
+            request.state.received_at = perf_counter()
+            return await handler(request)
+
+        return timed_handler
+
+
+file_router = APIRouter(prefix="/file", tags=["file"], route_class=TimedRoute)
+
+
+async def upload_rejected_handler(request: Request, exc: UploadRejected):
+    # 上传繁忙时立即返回429，客户端按Retry-After重试
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": retry_after_header(exc.retry_after)},
+    )
+
+
+def _check_checksum(value: str | None) -> str | None:
+    # 格式不对或者服务端不支持的校验和算法返回400
+    if value is None:
+        return None
+    try:
+        parse_checksum(value)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"无效的校验和 {value}: {e}")
+    return value
 
 
 @file_router.post("/upload/create_task")
@@ -22,31 +82,172 @@ async def create_upload_task(
     task_data: FileUploadTaskCreate,
     srv: FileUploadService = Depends(get_file_upload_service),
 ) -> FileUploadTaskPublic:
-    return await srv.create_task(task_data)
+    _check_checksum(task_data.checksum)
+    try:
+        return await srv.create_task(task_data)
+    except FileTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+
+# 批量接口一次最多处理的任务数
+MAX_BATCH_SIZE = 1000
+
+
+@file_router.post("/upload/create_tasks")
+async def create_upload_tasks(
+    tasks_data: Annotated[list[FileUploadTaskCreate], Body(max_length=MAX_BATCH_SIZE)],
+    srv: FileUploadService = Depends(get_file_upload_service),
+) -> list[FileUploadTaskPublic]:
+    for task_data in tasks_data:
+        _check_checksum(task_data.checksum)
+    try:
+        return await srv.create_tasks(tasks_data)
+    except FileTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+
+@file_router.post("/upload")
+async def upload_file(
+    req: Annotated[FileUploadRequest, Form()],
+    srv: FileUploadService = Depends(get_file_upload_service),
+) -> FileChunkUploadResponse:
+    # 小文件不需要先创建任务，一次请求上传完
+    if not req.file.size:
+        # 任务的文件大小必须大于0
+        raise HTTPException(status_code=400, detail="文件不能为空")
+    try:
+        return await srv.upload_file(req)
+    except FileTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+
+def _chunk_encoding(value: str | None) -> FileChunkEncoding:
+    # 不支持的压缩方式返回415，客户端可以改为不压缩上传
+    try:
+        encoding = FileChunkEncoding(value or FileChunkEncoding.IDENTITY)
+    except ValueError:
+        encoding = None
+    if encoding not in supported_encodings():
+        raise HTTPException(
+            status_code=415, detail=f"不支持的Content-Encoding: {value}"
+        )
+    return encoding
 
 
 @file_router.post("/upload/chunk")
 async def upload_chunk(
     req: Annotated[FileChunkUploadRequest, Form()],
+    request: Request,
     srv: FileUploadService = Depends(get_file_upload_service),
+    timings: StageTimings = Depends(get_upload_timings),
 ) -> FileChunkUploadResponse:
+    timings.observe(UploadStage.PARSE, perf_counter() - request.state.received_at)
+    req.content_encoding = _chunk_encoding(
+        req.content_encoding or req.chunk.headers.get("content-encoding")
+    )
+    _check_checksum(req.checksum)
     return await srv.upload_chunk(req)
 
 
-# @file_router.get("/upload/get_tasks")
-# async def query_upload_task(
-#     task_ids: list[UUID],
-#     srv: FileUploadService = Depends(get_file_upload_service),
-# ) -> list[FileUploadTaskPublic]:
-#     return await srv.query_task(task_ids)
+def _content_length(value: str | None) -> int | None:
+    # 格式不对的Content-Length返回400
+    if value is None:
+        return None
+    try:
+        length = int(value)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPException(status_code=400, detail=f"无效的Content-Length: {value}")
+    return length
+
+
+@file_router.put("/upload/{task_id}/chunks/{chunk_idx}")
+async def upload_chunk_stream(
+    task_id: UUID,
+    chunk_idx: Annotated[int, Path(ge=0)],
+    request: Request,
+    srv: FileUploadService = Depends(get_file_upload_service),
+) -> FileChunkUploadResponse:
+    # 请求体是application/octet-stream的原始分片数据，直接流式写到分片偏移，
+    # 带Content-Encoding时边接收边解压，带X-Chunk-Checksum时边写边校验
+    return await srv.upload_chunk_stream(
+        task_id,
+        chunk_idx,
+        request.stream(),
+        _content_length(request.headers.get("content-length")),
+        _chunk_encoding(request.headers.get("content-encoding")),
+        _check_checksum(request.headers.get("x-chunk-checksum")),
+    )
+
+
+@file_router.post("/upload/get_tasks")
+async def query_upload_tasks(
+    task_ids: Annotated[list[UUID], Body(max_length=MAX_BATCH_SIZE)],
+    srv: FileUploadService = Depends(get_file_upload_service),
+) -> list[FileUploadTaskQueryResult]:
+    return await srv.query_tasks(task_ids)
 
 
 @file_router.post("/upload/progress")
 async def upload_task_progress(
     task_ids: list[UUID],
+    request: Request,
+    batch: bool = False,
     srv: FileUploadService = Depends(get_file_upload_service),
 ):
-    return await srv.progress(task_ids)
+    """
+    上传进度的SSE流，默认每个事件的数据是一个任务的进度；
+    batch=true时每个事件的数据是一段时间内各个任务最新进度组成的数组
+    """
+    # 断线重连时EventSource会带上最后收到的事件id
+    return await srv.progress(
+        task_ids, request.headers.get("last-event-id"), batch
+    )
+
+
+@file_router.websocket("/upload/progress/ws")
+async def upload_task_progress_ws(
+    websocket: WebSocket,
+    srv: FileUploadService = Depends(get_file_upload_service),
+):
+    # 二进制的进度增量，协议见app/core/file_storage/progress_ws.py
+    await srv.progress_socket(websocket)
+
+
+@file_router.get("/metrics")
+async def upload_metrics(
+    format: str = "prometheus",
+    timings: StageTimings = Depends(get_upload_timings),
+):
+    # 上传各阶段耗时，format=json时返回各阶段的次数、总耗时和p50/p99
+    if format == "json":
+        return {"enabled": timings.enabled, "stages": timings.snapshot()}
+    return PlainTextResponse(timings.render_prometheus())
+
+
+@file_router.api_route("/{bucket}/{name}", methods=["GET", "HEAD"])
+async def download_file(
+    name: Annotated[str, Path(pattern=r"^[^/.][^/]*$")],
+    request: Request,
+    srv: FileUploadService = Depends(get_bucket_file_service),
+):
+    stored = await srv.stored_file(name)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    path, st, digest = stored
+    # 有摘要时用摘要作为强ETag，否则由FileResponse按mtime和大小生成
+    headers = {"etag": f'"{digest}"'} if digest else {}
+    rsp = StorageFileResponse(path, headers=headers, filename=name, stat_result=st)
+    if is_not_modified(request.headers, rsp.headers["etag"], st.st_mtime):
+        return Response(
+            status_code=304,
+            headers={
+                "etag": rsp.headers["etag"],
+                "last-modified": formatdate(st.st_mtime, usegmt=True),
+            },
+        )
+    return rsp
 
 
 # @file_router.post("/upload/progress")
@@ -4,9 +4,17 @@ from contextlib import asynccontextmanager
 
 from dependency_injector import containers, providers
 from app.core.db import Database
+from app.core.file_storage.admission import UploadAdmission
+from app.core.file_storage.chunking import ChunkSizePolicy, ClientThroughputStore
+from app.core.file_storage.digest import IncrementalDigests
+from app.core.file_storage.file_io import init_chunk_file_writer
 from app.core.file_storage.file_upload import FileChunkUploader, FileUploadSettings
+from app.core.file_storage.metrics import StageTimings
+from app.core.file_storage.progress import ProgressThrottle
+from app.core.file_storage.task_store import FileUploadTaskStore
+from app.core.pubsub import InProcessPubSubBackend, RedisPubSubBackend
 from app.core.redis import init_redis_pool
-from app.core.sse import SSEPubSub
+from app.core.sse import init_sse_pubsub
 from app.repositories import UserRepository
 from app.services import FileUploadService, UserService
 
@@ -20,13 +28,97 @@ class DepsContainer(containers.DeclarativeContainer):
 
     redis = providers.Resource(init_redis_pool, url=config.redis.url)
 
-    sse_pubsub = providers.ThreadSafeSingleton(SSEPubSub, redis=redis)
+    pubsub_backend = providers.Selector(
+        config.sse.backend,
+        redis=providers.ThreadSafeSingleton(
+            RedisPubSubBackend,
+            redis=redis,
+            queue_size=config.sse.queue_size.as_int(),
+            mode=config.sse.mode,
+            stream_maxlen=config.sse.stream_maxlen.as_int(),
+            snapshot_ttl=config.sse.snapshot_ttl.as_int(),
+        ),
+        memory=providers.ThreadSafeSingleton(
+            InProcessPubSubBackend,
+            queue_size=config.sse.queue_size.as_int(),
+            mode=config.sse.mode,
+            stream_maxlen=config.sse.stream_maxlen.as_int(),
+            snapshot_ttl=config.sse.snapshot_ttl.as_int(),
+        ),
+    )
+
+    sse_pubsub = providers.Resource(
+        init_sse_pubsub,
+        backend=pubsub_backend,
+        ping_interval=config.sse.ping_interval.as_float(),
+        send_timeout=config.sse.send_timeout.as_float(),
+    )
+
+    file_upload_settings = providers.Singleton(FileUploadSettings)
+
+    chunk_file_writer = providers.Resource(
+        init_chunk_file_writer,
+        max_open_files=file_upload_settings.provided.max_open_files,
+        io_workers=file_upload_settings.provided.io_workers,
+        max_pending=file_upload_settings.provided.io_max_pending,
+    )
+
+    progress_throttle = providers.ThreadSafeSingleton(
+        ProgressThrottle,
+        interval_ms=file_upload_settings.provided.progress_interval_ms,
+        step_percent=file_upload_settings.provided.progress_step_percent,
+    )
+
+    file_upload_task_store = providers.ThreadSafeSingleton(
+        FileUploadTaskStore, redis=redis
+    )
+
+    file_upload_digests = providers.ThreadSafeSingleton(
+        IncrementalDigests,
+        algorithm=file_upload_settings.provided.digest_algorithm,
+    )
+
+    chunk_size_policy = providers.ThreadSafeSingleton(
+        ChunkSizePolicy,
+        default_chunk_size=file_upload_settings.provided.chunk_size,
+        min_chunk_size=file_upload_settings.provided.min_chunk_size,
+        max_chunk_size=file_upload_settings.provided.max_chunk_size,
+        max_chunks=file_upload_settings.provided.max_chunks,
+        single_request_threshold=file_upload_settings.provided.single_request_threshold,
+        target_chunk_seconds=file_upload_settings.provided.target_chunk_seconds,
+    )
+
+    client_throughput_store = providers.ThreadSafeSingleton(
+        ClientThroughputStore, redis=redis
+    )
+
+    upload_admission = providers.ThreadSafeSingleton(
+        UploadAdmission,
+        redis=redis,
+        max_concurrent_writes=file_upload_settings.provided.max_concurrent_writes,
+        bucket_rate=file_upload_settings.provided.bucket_rate,
+        bucket_burst=file_upload_settings.provided.bucket_burst,
+        client_rate=file_upload_settings.provided.client_rate,
+        client_burst=file_upload_settings.provided.client_burst,
+    )
+
+    upload_timings = providers.ThreadSafeSingleton(
+        StageTimings, enabled=file_upload_settings.provided.metrics_enabled
+    )
 
     file_uploader = providers.Factory(
         FileChunkUploader,
-        settings=FileUploadSettings(),
+        settings=file_upload_settings,
         sse_pubsub=sse_pubsub,
         redis=redis,
+        file_writer=chunk_file_writer,
+        progress_throttle=progress_throttle,
+        task_store=file_upload_task_store,
+        digests=file_upload_digests,
+        chunk_size_policy=chunk_size_policy,
+        throughput_store=client_throughput_store,
+        admission=upload_admission,
+        timings=upload_timings,
     )
 
 
@@ -48,8 +140,12 @@ class ServiceFactory:
         async with db.scope_session() as session:
             yield UserService(UserRepository(session))
 
-    async def file_uploader(self):
-        return FileUploadService(await self.deps.file_uploader(bucket_name="test"))
+    async def file_uploader(
+        self, client_id: str | None = None, bucket_name: str = "test"
+    ):
+        return FileUploadService(
+            await self.deps.file_uploader(bucket_name=bucket_name, client_id=client_id)
+        )
 
 
 #
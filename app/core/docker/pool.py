@@ -10,8 +10,8 @@ from app.core.docker.image import ImageSpec
 """
 异步、线程安全（协程安全）的 Docker 容器池实现
 - 基于 aiodocker（纯异步 Docker SDK）
-- 使用 asyncio.Queue 作为容器租赁/归还的共享结构
-- 通过 asyncio.Lock 保护池大小的并发修改
+- 空闲容器和等待者都是 FIFO 队列；归还的容器直接交给最早的等待者
+- max_size 限制存活容器数，池大小只在事件循环内同步修改
 - 通过 labels 关联/清理同一池的容器
 - 提供池管理器，支持多 image、多池
 
@@ -27,6 +27,7 @@ import asyncio
 import logging
 import os
 import uuid
+from collections import deque
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from typing import Any, Optional, AsyncGenerator
@@ -46,26 +47,53 @@ logger = logging.getLogger(__name__)
 
 
 
+class ContainerPoolTimeout(TimeoutError):
+    """等待可用容器超时（池中容器数已达 max_size）。"""
+
+
+class ContainerPoolClosed(RuntimeError):
+    """池已关闭。"""
+
+
 class DockerContainerPool(AbstractAsyncContextManager):
     """
     管理单 image 的容器池（协程安全）。
 
     特性：
-    - 可配置 max_size / min_idle
+    - max_size：存活容器（空闲 + 租出 + 创建中）的硬上限；达到上限时按 FIFO 排队等待
+    - min_idle：start() 时预先创建的空闲容器数
+    - acquire_timeout：排队等待的最长秒数，超时抛 ContainerPoolTimeout；None 表示一直等
     - get_container() 返回异步上下文管理器；退出时自动归还
-    - 容器非运行状态会被丢弃并重建
+    - 容器非运行状态会被丢弃并重建；创建失败时名额会归还给下一个等待者
     - close() 会清理由该池创建的容器（通过 label 识别）
     """
     def __init__(
         self,
         client: aiodocker.Docker,
         image_spec: ImageSpec,
+        *,
+        max_size: int = 4,
+        min_idle: int = 0,
+        acquire_timeout: float | None = 60.0,
     ) -> None:
+        if max_size < 1:
+            raise ValueError("max_size must be >= 1")
+        if not 0 <= min_idle <= max_size:
+            raise ValueError("min_idle must be between 0 and max_size")
         self._client = client
         self._spec = image_spec
         self._name = f"sim-{image_spec.image}"
         self._labels = {"container-pool": self._name}
-        self._queue: asyncio.Queue[AsyncDockerContainer] = asyncio.Queue()
+        self._max_size = max_size
+        self._min_idle = min_idle
+        self._acquire_timeout = acquire_timeout
+        # 空闲容器，先进先出
+        self._idle: deque[AsyncDockerContainer] = deque()
+        # 等待者：结果是归还的容器，或者 None（获得一个创建名额）
+        self._waiters: deque[asyncio.Future[AsyncDockerContainer | None]] = deque()
+        # 存活容器数（包括创建中的），只在事件循环内同步修改，不需要锁
+        self._size = 0
+        self._closed = False
         self._user_uid = os.getuid()
 
     # ------------------------------- 公共属性 -------------------------------
@@ -81,16 +109,46 @@ class DockerContainerPool(AbstractAsyncContextManager):
     def labels(self) -> dict[str, str]:
         return self._labels
 
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def size(self) -> int:
+        """存活容器数（空闲 + 租出 + 创建中）。"""
+        return self._size
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for w in self._waiters if not w.done())
+
 
     async def __aexit__(self, exc_type, exc_value, traceback, /):
         await self.close()
 
     # ------------------------------- 生命周期 ------------------------------
 
+    async def start(self) -> None:
+        """预热 min_idle 个空闲容器。"""
+        while self._size < self._min_idle:
+            self._size += 1
+            c = await self._create_reserved()
+            self._idle.append(c)
+
     async def close(self) -> None:
-        while not self._queue.empty():
-            c = await self._queue.get()
-            await c.remove(force=True)
+        self._closed = True
+        # 1) 正在等待的获取直接失败
+        while self._waiters:
+            w = self._waiters.popleft()
+            if not w.done():
+                w.set_exception(ContainerPoolClosed(f"Pool {self._name} is closed"))
+
+        while self._idle:
+            await self._discard(self._idle.popleft())
             await asyncio.sleep(0)  # 让出调度
 
         # 2) 通过 label 扫描并删除残留容器（包括租出中的、被崩溃中断的）
@@ -112,26 +170,87 @@ class DockerContainerPool(AbstractAsyncContextManager):
             await self._release(c)
 
     async def _acquire(self) -> AsyncDockerContainer:
-        try:
-            c = self._queue.get_nowait()
+        if self._closed:
+            raise ContainerPoolClosed(f"Pool {self._name} is closed")
+        while self._idle:
+            c = self._idle.popleft()
             if await self._is_running(c):
                 return c
             # 不可用：销毁并继续
-            await self._destroy(c)
-        except asyncio.QueueEmpty:
-            pass
-
-        # 重新创建一个
-        return await self._create_container()
-
+            await self._discard(c)
+
+        # 未达上限且没有人排队：占用名额后创建
+        if self._size < self._max_size and not self._waiters:
+            self._size += 1
+            return await self._create_reserved()
+
+        c = await self._wait()
+        if c is None:
+            # 获得的是名额（有容器被销毁或创建失败）
+            return await self._create_reserved()
+        return c
+
+    async def _wait(self) -> AsyncDockerContainer | None:
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=self._acquire_timeout)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if not done:
+            self._abandon(waiter)
+            raise ContainerPoolTimeout(
+                f"No container available from pool {self._name} within "
+                f"{self._acquire_timeout}s (max_size={self._max_size}, "
+                f"in use={self._size - len(self._idle)}, waiting={self.waiting})"
+            )
+        return waiter.result()
+
+    def _abandon(self, waiter: asyncio.Future) -> None:
+        # 放弃等待；如果刚好已经分到容器或名额，转交给下一个等待者
+        if not waiter.done():
+            waiter.cancel()
+            self._waiters.remove(waiter)
+        elif not waiter.cancelled() and waiter.exception() is None:
+            c = waiter.result()
+            if c is None:
+                self._release_slot()
+            else:
+                self._hand_over(c)
+
+    def _hand_over(self, c: AsyncDockerContainer) -> None:
+        while self._waiters:
+            w = self._waiters.popleft()
+            if not w.done():
+                w.set_result(c)
+                return
+        self._idle.append(c)
+
+    def _release_slot(self) -> None:
+        # 名额直接交给最早的等待者，由它去创建容器
+        while self._waiters:
+            w = self._waiters.popleft()
+            if not w.done():
+                w.set_result(None)
+                return
+        self._size -= 1
 
     async def _release(self, c: AsyncDockerContainer) -> None:
-        if not await self._is_running(c):
-            await self._destroy(c)
+        if self._closed or not await self._is_running(c):
+            await self._discard(c)
             return
-        await self._queue.put(c)
+        self._hand_over(c)
 
     # ------------------------------- 创建/销毁 ------------------------------
+    async def _create_reserved(self) -> AsyncDockerContainer:
+        """在已经占用的名额上创建容器；失败时归还名额。"""
+        try:
+            return await self._create_container()
+        except BaseException:
+            self._release_slot()
+            raise
+
     async def _create_container(self) -> AsyncDockerContainer:
         name = f"sim-app-container-{uuid.uuid4().hex[:10]}"
         host_config: dict[str, Any] = {}
@@ -153,14 +272,25 @@ class DockerContainerPool(AbstractAsyncContextManager):
 
         # aiodocker: containers.create + start
         container = await self._client.containers.create(config=create_kwargs)
-        await container.start()
-
         wrapped = AsyncDockerContainer(container)
-        # 等待 running 状态（最多 10s）
-        await self._wait_running(wrapped, timeout=10.0)
+        try:
+            await container.start()
+            # 等待 running 状态（最多 10s）
+            await self._wait_running(wrapped, timeout=10.0)
+        except BaseException:
+            # 已经创建的容器不能泄漏
+            await self._destroy(wrapped)
+            raise
         logger.info("Created container %s from image %s", wrapped.short_id, self._spec.image)
         return wrapped
 
+    async def _discard(self, c: AsyncDockerContainer) -> None:
+        """销毁容器并归还名额。"""
+        try:
+            await self._destroy(c)
+        finally:
+            self._release_slot()
+
     @staticmethod
     async def _destroy(c: AsyncDockerContainer) -> None:
         # 先尝试删除
@@ -220,7 +350,7 @@ class DockerContainerPool(AbstractAsyncContextManager):
 #
 #     def __init__(self) -> None:
 #         self._client = aiodocker.Docker()
-#         self._pools: dict[str, AsyncDockerContainerPool] = {}
+#         self._pools: dict[str, DockerContainerPool] = {}
 #         self._lock = asyncio.Lock()
 #
 #     async def register_pool(
@@ -230,12 +360,12 @@ class DockerContainerPool(AbstractAsyncContextManager):
 #         max_size: int = 4,
 #         min_idle: int = 0,
 #         acquire_timeout: float | None = 60.0,
-#     ) -> AsyncDockerContainerPool:
+#     ) -> DockerContainerPool:
 #         """注册或返回已存在池。"""
 #         async with self._lock:
 #             pool = self._pools.get(image_spec.image)
 #             if pool is None:
-#                 pool = AsyncDockerContainerPool(
+#                 pool = DockerContainerPool(
 #                     self._client,
 #                     image_spec,
 #                     max_size=max_size,
@@ -246,7 +376,7 @@ class DockerContainerPool(AbstractAsyncContextManager):
 #                 await pool.start()
 #             return pool
 #
-#     async def get_pool(self, image: str) -> AsyncDockerContainerPool:
+#     async def get_pool(self, image: str) -> DockerContainerPool:
 #         async with self._lock:
 #             pool = self._pools.get(image)
 #             if pool is None:
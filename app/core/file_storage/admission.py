@@ -0,0 +1,120 @@
+import math
+from contextlib import asynccontextmanager
+from time import time
+from typing import AsyncIterator
+
+from redis.asyncio import Redis
+
+# 多个令牌桶一起检查，所有桶的令牌都足够时才一起扣减，否则返回需要等待的秒数
+# 消耗超过桶容量时，桶满就可以通过，但按实际消耗扣减，令牌变成负数，之后的请求要等欠下的令牌补回来
+# KEYS: 令牌桶
+# ARGV: now, cost, 之后每个桶依次是rate, burst
+_TAKE_TOKENS = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local remain = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local burst = tonumber(ARGV[2 + i * 2])
+    local tokens, ts = unpack(redis.call('HMGET', key, 'tokens', 'ts'))
+    tokens = tonumber(tokens) or burst
+    ts = tonumber(ts) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local need = math.min(cost, burst)
+    if tokens < need then
+        wait = math.max(wait, (need - tokens) / rate)
+    end
+    remain[i] = tokens - cost
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local burst = tonumber(ARGV[2 + i * 2])
+    redis.call('HSET', key, 'tokens', tostring(remain[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return '0'
+"""
+
+
+class UploadRejected(Exception):
+    """
+    上传繁忙，客户端需要在retry_after秒后重试
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class UploadAdmission:
+    """
+    分片写入的准入控制
+
+    - 每个进程同时写入的分片数不超过max_concurrent_writes
+    - 每个bucket、每个客户端的写入字节数按令牌桶限速，令牌桶保存在redis中，多个进程共享，
+      rate为0时不限速
+    - 超出限制时立即拒绝并给出重试时间，不排队等待
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        max_concurrent_writes: int = 64,
+        bucket_rate: int = 0,
+        bucket_burst: int = 0,
+        client_rate: int = 0,
+        client_burst: int = 0,
+        busy_retry_after: float = 1.0,
+    ):
+        self._redis = redis
+        self._max_concurrent_writes = max_concurrent_writes
+        self._bucket_rate = bucket_rate
+        self._bucket_burst = bucket_burst or bucket_rate
+        self._client_rate = client_rate
+        self._client_burst = client_burst or client_rate
+        self._busy_retry_after = busy_retry_after
+        self._writing = 0
+        self._take_tokens = redis.register_script(_TAKE_TOKENS)
+
+    @property
+    def writing(self) -> int:
+        return self._writing
+
+    async def _take(self, bucket_name: str, client_id: str | None, nbytes: int):
+        keys, args = [], [time(), nbytes]
+        if self._bucket_rate:
+            keys.append(f"file_upload_rate:bucket:{bucket_name}")
+            args += [self._bucket_rate, self._bucket_burst]
+        if self._client_rate and client_id:
+            keys.append(f"file_upload_rate:client:{client_id}")
+            args += [self._client_rate, self._client_burst]
+        if not keys:
+            return
+        wait = float(await self._take_tokens(keys=keys, args=args))
+        if wait > 0:
+            raise UploadRejected("上传速度超过限制", wait)
+
+    @asynccontextmanager
+    async def admit(
+        self, bucket_name: str, client_id: str | None, nbytes: int
+    ) -> AsyncIterator[None]:
+        """
+        申请写入nbytes字节，被拒绝时抛出UploadRejected
+        """
+        if self._writing >= self._max_concurrent_writes:
+            raise UploadRejected("同时上传的分片过多", self._busy_retry_after)
+        self._writing += 1
+        try:
+            await self._take(bucket_name, client_id, nbytes)
+            yield
+        finally:
+            self._writing -= 1
+
+
+def retry_after_header(retry_after: float) -> str:
+    # Retry-After只支持整数秒
+    return str(max(1, math.ceil(retry_after)))
@@ -0,0 +1,185 @@
+import mmap
+import zlib
+from enum import Enum
+from pathlib import Path
+
+try:
+    import google_crc32c
+except ImportError:  # crc32c是可选的
+    google_crc32c = None
+
+try:
+    import xxhash
+except ImportError:  # xxhash是可选的
+    xxhash = None
+
+
+class ChunkChecksumAlgorithm(str, Enum):
+    CRC32 = "crc32"
+    CRC32C = "crc32c"
+    XXH64 = "xxh64"
+    XXH3_64 = "xxh3_64"
+
+
+# 反射形式的CRC多项式，用于合并分片的CRC
+_CRC_POLYS = {
+    ChunkChecksumAlgorithm.CRC32: 0xEDB88320,
+    ChunkChecksumAlgorithm.CRC32C: 0x82F63B78,
+}
+
+
+class ChunkChecksumMismatch(Exception):
+    """
+    分片数据和客户端提供的校验和不一致
+    """
+
+
+def supported_checksums() -> set[ChunkChecksumAlgorithm]:
+    algorithms = {ChunkChecksumAlgorithm.CRC32}
+    if google_crc32c is not None:
+        algorithms.add(ChunkChecksumAlgorithm.CRC32C)
+    if xxhash is not None:
+        algorithms.update([ChunkChecksumAlgorithm.XXH64, ChunkChecksumAlgorithm.XXH3_64])
+    return algorithms
+
+
+def parse_checksum(value: str) -> tuple[ChunkChecksumAlgorithm, str]:
+    """
+    解析"算法:十六进制值"格式的校验和，算法不支持时抛出ValueError
+    """
+    algorithm, _, hexdigest = value.partition(":")
+    algorithm = ChunkChecksumAlgorithm(algorithm)
+    if algorithm not in supported_checksums():
+        raise ValueError(f"不支持的校验和算法: {algorithm.value}")
+    return algorithm, hexdigest.lower()
+
+
+class ChunkHasher:
+    """
+    分片数据写入时增量计算校验和，expected为None时只计算不校验
+    """
+
+    def __init__(self, algorithm: ChunkChecksumAlgorithm, expected: str | None = None):
+        self.algorithm = algorithm
+        self._expected = expected
+        self._crc = 0
+        self._xxh = None
+        if algorithm == ChunkChecksumAlgorithm.XXH64:
+            self._xxh = xxhash.xxh64()
+        elif algorithm == ChunkChecksumAlgorithm.XXH3_64:
+            self._xxh = xxhash.xxh3_64()
+
+    @classmethod
+    def from_checksum(cls, checksum: str) -> "ChunkHasher":
+        return cls(*parse_checksum(checksum))
+
+    def update(self, data: bytes | memoryview | mmap.mmap):
+        if self._xxh is not None:
+            self._xxh.update(data)
+        elif self.algorithm == ChunkChecksumAlgorithm.CRC32C:
+            self._crc = google_crc32c.extend(self._crc, bytes(data))
+        else:
+            self._crc = zlib.crc32(data, self._crc)
+
+    def update_from_fd(self, fd: int, count: int):
+        """
+        通过mmap计算文件描述符中的前count个字节，阻塞调用
+        """
+        if count:
+            with mmap.mmap(fd, count, access=mmap.ACCESS_READ) as m:
+                self.update(m)
+
+    def hexdigest(self) -> str:
+        if self._xxh is not None:
+            return self._xxh.hexdigest()
+        return f"{self._crc:08x}"
+
+    @property
+    def checksum(self) -> str:
+        return f"{self.algorithm.value}:{self.hexdigest()}"
+
+    def verify(self):
+        if self._expected is None:
+            return
+        actual = self.hexdigest()
+        if actual != self._expected:
+            raise ChunkChecksumMismatch(
+                f"分片校验和不一致: {self.algorithm.value}:{self._expected} != {actual}"
+            )
+
+
+def file_checksum(path: Path, algorithm: ChunkChecksumAlgorithm) -> str:
+    """
+    重新读取整个文件计算校验和，阻塞调用，需要在executor里执行
+    """
+    hasher = ChunkHasher(algorithm)
+    with open(path, "rb") as f:
+        while data := f.read(1024 * 1024):
+            hasher.update(data)
+    return hasher.checksum
+
+
+def _gf2_times(mat: list[int], vec: int) -> int:
+    s, i = 0, 0
+    while vec:
+        if vec & 1:
+            s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+
+def _gf2_square(mat: list[int]) -> list[int]:
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+
+def _crc_zeros_operator(poly: int, length: int) -> list[int]:
+    """
+    在CRC后面追加length个0字节的线性算子（GF(2)上的32x32矩阵，每个元素是一列）
+    """
+    # 追加1个0比特的算子，平方3次得到追加1个0字节的算子
+    op = [poly] + [1 << n for n in range(31)]
+    for _ in range(3):
+        op = _gf2_square(op)
+    result = [1 << n for n in range(32)]
+    while length:
+        if length & 1:
+            result = [_gf2_times(op, col) for col in result]
+        length >>= 1
+        if length:
+            op = _gf2_square(op)
+    return result
+
+
+def crc_combine(poly: int, crc1: int, crc2: int, len2: int) -> int:
+    """
+    已知A的crc1和B的crc2（B长len2字节），计算A+B的CRC，不需要重新读取数据（同zlib的crc32_combine）
+    """
+    return _gf2_times(_crc_zeros_operator(poly, len2), crc1) ^ crc2
+
+
+def combine_chunk_checksums(
+    checksums: list[str], chunk_size: int, file_size: int
+) -> str | None:
+    """
+    按分片顺序把每个分片的CRC合并成整个文件的CRC，返回"算法:十六进制值"；
+    分片校验和不全、算法不一致或者算法不能合并时返回None
+    """
+    if not checksums or any(not c for c in checksums):
+        return None
+    algorithms = {parse_checksum(c)[0] for c in checksums}
+    if len(algorithms) != 1:
+        return None
+    algorithm = algorithms.pop()
+    poly = _CRC_POLYS.get(algorithm)
+    if poly is None:
+        return None
+    # 除了最后一个分片长度都相同，算子只需要计算一次
+    operators: dict[int, list[int]] = {}
+    crc = 0
+    for idx, checksum in enumerate(checksums):
+        length = min(chunk_size, file_size - idx * chunk_size)
+        if length not in operators:
+            operators[length] = _crc_zeros_operator(poly, length)
+        crc = _gf2_times(operators[length], crc) ^ int(parse_checksum(checksum)[1], 16)
+    return f"{algorithm.value}:{crc:08x}"
@@ -0,0 +1,107 @@
+import math
+
+from redis.asyncio import Redis
+
+# 用指数加权移动平均更新客户端吞吐量，一次往返
+# KEYS: throughput
+# ARGV: bytes_per_second, alpha, expire_seconds
+_OBSERVE_THROUGHPUT = """
+local old = tonumber(redis.call('GET', KEYS[1]))
+local new = tonumber(ARGV[1])
+if old then
+    local alpha = tonumber(ARGV[2])
+    new = alpha * new + (1 - alpha) * old
+end
+redis.call('SET', KEYS[1], tostring(new), 'EX', ARGV[3])
+return tostring(new)
+"""
+
+
+class ChunkSizePolicy:
+    """
+    创建任务时选择分片大小
+
+    - 文件不超过single_request_threshold时整个文件作为一个分片，一次请求上传完
+    - 客户端提示的分片大小优先，其次按客户端最近的吞吐量让每个分片大约上传
+      target_chunk_seconds秒，都没有时使用默认分片大小
+    - 分片数不超过max_chunks，分片大小限制在[min_chunk_size, max_chunk_size]内，
+      并按min_chunk_size对齐
+
+    分片大小在创建任务时确定，之后不会变化，断点续传按分片索引计算偏移
+    """
+
+    def __init__(
+        self,
+        default_chunk_size: int = 1024 * 1024,
+        min_chunk_size: int = 256 * 1024,
+        max_chunk_size: int = 64 * 1024 * 1024,
+        max_chunks: int = 10000,
+        single_request_threshold: int = 1024 * 1024,
+        target_chunk_seconds: float = 2.0,
+    ):
+        self._default_chunk_size = default_chunk_size
+        self._min_chunk_size = min_chunk_size
+        self._max_chunk_size = max_chunk_size
+        self._max_chunks = max_chunks
+        self._single_request_threshold = single_request_threshold
+        self._target_chunk_seconds = target_chunk_seconds
+
+    @property
+    def single_request_threshold(self) -> int:
+        return self._single_request_threshold
+
+    def choose(
+        self,
+        file_size: int,
+        hint: int | None = None,
+        throughput: float | None = None,
+    ) -> int:
+        """
+        返回分片大小，throughput是客户端最近的吞吐量（字节/秒）
+        """
+        if file_size <= self._single_request_threshold:
+            return file_size
+        if hint:
+            chunk_size = hint
+        elif throughput:
+            chunk_size = int(throughput * self._target_chunk_seconds)
+        else:
+            chunk_size = self._default_chunk_size
+        align = self._min_chunk_size
+        chunk_size -= chunk_size % align
+        # 分片数不超过max_chunks，向上对齐
+        least = math.ceil(file_size / self._max_chunks / align) * align
+        chunk_size = min(max(chunk_size, least, align), self._max_chunk_size)
+        return min(chunk_size, file_size)
+
+
+class ClientThroughputStore:
+    """
+    按客户端记录最近的上传吞吐量（字节/秒），保存在redis中，
+    同一个客户端的请求落在不同的API进程上也能共享
+    """
+
+    def __init__(self, redis: Redis, alpha: float = 0.3, expire_seconds: int = 24 * 60 * 60):
+        self._redis = redis
+        self._alpha = alpha
+        self._expire_seconds = expire_seconds
+        self._observe = redis.register_script(_OBSERVE_THROUGHPUT)
+
+    def _key(self, client_id: str) -> str:
+        return f"file_upload_throughput:{client_id}"
+
+    async def get(self, client_id: str) -> float | None:
+        value = await self._redis.get(self._key(client_id))
+        return float(value) if value else None
+
+    async def observe(self, client_id: str, nbytes: int, seconds: float) -> float | None:
+        """
+        记录一次上传的字节数和耗时，返回更新后的吞吐量
+        """
+        if nbytes <= 0 or seconds <= 0:
+            return None
+        value = await self._observe(
+            keys=[self._key(client_id)],
+            args=[nbytes / seconds, self._alpha, self._expire_seconds],
+        )
+        return float(value)
@@ -0,0 +1,77 @@
+import hashlib
+import mmap
+from collections import OrderedDict
+from pathlib import Path
+from uuid import UUID
+
+
+class IncrementalDigests:
+    """
+    按任务保存增量哈希状态（进程内）
+
+    只有按偏移顺序写入的数据才能增量计算，hashed_bytes记录已经计算到的偏移。
+    分片乱序到达（并行上传）或者上一个分片落在其它进程时哈希状态会失效，
+    任务完成时由调用方回退为重新读取文件计算
+    """
+
+    def __init__(self, algorithm: str = "sha256", max_tasks: int = 10000):
+        self._algorithm = algorithm
+        self._max_tasks = max_tasks
+        # task_id -> (哈希对象, 已经计算到的偏移)
+        self._states: OrderedDict[UUID, tuple["hashlib._Hash", int]] = OrderedDict()
+
+    @property
+    def algorithm(self) -> str:
+        return self._algorithm
+
+    def accepts(self, task_id: UUID, offset: int) -> bool:
+        """
+        offset处的数据能否继续增量计算
+        """
+        state = self._states.get(task_id)
+        return offset == 0 if state is None else state[1] == offset
+
+    def update(self, task_id: UUID, offset: int, data: bytes | memoryview | mmap.mmap):
+        """
+        计算offset处的数据，不连续时丢弃该任务的哈希状态
+        """
+        if not self.accepts(task_id, offset):
+            self._states.pop(task_id, None)
+            return
+        state = self._states.get(task_id)
+        h = state[0] if state else hashlib.new(self._algorithm)
+        h.update(data)
+        self._states[task_id] = (h, offset + len(data))
+        self._states.move_to_end(task_id)
+        if len(self._states) > self._max_tasks:
+            self._states.popitem(last=False)
+
+    def update_from_fd(self, task_id: UUID, offset: int, fd: int, count: int):
+        """
+        通过mmap计算文件描述符中的前count个字节，不经过python的缓冲区
+        """
+        if not count or not self.accepts(task_id, offset):
+            self.update(task_id, offset, b"")
+            return
+        with mmap.mmap(fd, count, access=mmap.ACCESS_READ) as m:
+            self.update(task_id, offset, m)
+
+    def hexdigest(self, task_id: UUID, size: int) -> str | None:
+        """
+        size个字节都计算过时返回摘要，否则返回None
+        """
+        state = self._states.get(task_id)
+        if state is None or state[1] != size:
+            return None
+        return state[0].hexdigest()
+
+    def forget(self, task_id: UUID):
+        self._states.pop(task_id, None)
+
+
+def file_digest(path: Path, algorithm: str = "sha256") -> str:
+    """
+    重新读取整个文件计算摘要，阻塞调用，需要在executor里执行
+    """
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, algorithm).hexdigest()
@@ -0,0 +1,88 @@
+import zlib
+from typing import AsyncIterator, Iterator
+
+from app.core.file_storage.schemas import FileChunkEncoding
+
+try:
+    import zstandard
+except ImportError:  # zstd是可选的
+    zstandard = None
+
+_DECODE_ERRORS = (zlib.error,) if zstandard is None else (zlib.error, zstandard.ZstdError)
+
+# zstd的解压对象不能限制输出大小，每次只喂这么多压缩数据；
+# 一个最小的zstd块（4字节）最多展开成128KB，每次的输出不超过8MB左右
+_ZSTD_FEED_SIZE = 256
+
+
+class ChunkDecodeError(Exception):
+    """
+    压缩的分片数据损坏或者不完整
+    """
+
+
+def supported_encodings() -> set[FileChunkEncoding]:
+    encodings = {FileChunkEncoding.IDENTITY, FileChunkEncoding.GZIP}
+    if zstandard is not None:
+        encodings.add(FileChunkEncoding.ZSTD)
+    return encodings
+
+
+class _GzipDecoder:
+    def __init__(self):
+        self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decode(self, data: bytes, max_length: int) -> Iterator[bytes]:
+        # 每次最多解压max_length，避免一小段压缩数据展开成巨大的内存块
+        while data:
+            out = self._d.decompress(data, max_length)
+            data = self._d.unconsumed_tail
+            if self._d.eof and self._d.unused_data:
+                # 多个gzip成员首尾相接
+                data = self._d.unused_data
+                self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if out:
+                yield out
+
+    @property
+    def eof(self) -> bool:
+        return self._d.eof
+
+
+class _ZstdDecoder:
+    def __init__(self):
+        self._d = zstandard.ZstdDecompressor().decompressobj()
+
+    def decode(self, data: bytes, max_length: int) -> Iterator[bytes]:
+        # 分小段解压，调用方发现数据超过分片大小时停止迭代，不会把整段数据展开到内存里
+        for start in range(0, len(data), _ZSTD_FEED_SIZE):
+            out = self._d.decompress(data[start : start + _ZSTD_FEED_SIZE])
+            for pos in range(0, len(out), max_length):
+                yield out[pos : pos + max_length]
+
+    @property
+    def eof(self) -> bool:
+        return self._d.eof
+
+
+async def decode_stream(
+    stream: AsyncIterator[bytes], encoding: FileChunkEncoding, buffer_size: int
+) -> AsyncIterator[bytes]:
+    """
+    流式解压分片数据，按buffer_size产出解压后的数据
+    """
+    if encoding == FileChunkEncoding.IDENTITY:
+        async for data in stream:
+            yield data
+        return
+    if encoding not in supported_encodings():
+        raise ChunkDecodeError(f"不支持的Content-Encoding: {encoding.value}")
+    decoder = _GzipDecoder() if encoding == FileChunkEncoding.GZIP else _ZstdDecoder()
+    try:
+        async for data in stream:
+            for out in decoder.decode(data, buffer_size):
+                yield out
+    except _DECODE_ERRORS as e:
+        raise ChunkDecodeError(f"解压分片失败: {e}") from e
+    if not decoder.eof:
+        raise ChunkDecodeError("压缩的分片数据不完整")
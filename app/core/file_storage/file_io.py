@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkFileWriter:
+    """
+    分片文件写入器
+
+    - 目标文件在创建任务时一次性预分配（稀疏文件）
+    - 按路径缓存长期打开的文件描述符，分片用 pwrite 写到各自的偏移
+    - 分片已经落盘（SpooledTemporaryFile 已经 rollover）时，
+      用 copy_file_range 在内核中拷贝，不经过 python 的缓冲区
+    - 所有阻塞的磁盘操作都在独立的线程池里执行，不占用默认executor，
+      排队的操作超过max_pending时调用方等待
+    """
+
+    def __init__(
+        self, max_open_files: int = 256, io_workers: int = 16, max_pending: int = 256
+    ):
+        self._max_open_files = max_open_files
+        self._executor = ThreadPoolExecutor(
+            max_workers=io_workers, thread_name_prefix="file-io"
+        )
+        self._pending = asyncio.Semaphore(max_pending)
+        # path -> fd，按最近使用排序
+        self._fds: OrderedDict[Path, int] = OrderedDict()
+        # path -> 正在使用该fd的操作数，使用中的fd不能被淘汰
+        self._inflight: dict[Path, int] = {}
+
+    async def run(self, func, *args):
+        """
+        在磁盘I/O线程池里执行阻塞调用
+        """
+        async with self._pending:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, func, *args
+            )
+
+    def coalesce(self, path: Path, offset: int, batch_size: int) -> "CoalescedWriter":
+        """
+        从offset开始顺序写入path，小块数据合并成batch_size的大块再写
+        """
+        return CoalescedWriter(self, path, offset, batch_size)
+
+    async def _acquire(self, path: Path) -> int:
+        fd = self._fds.get(path)
+        if fd is None:
+            fd = await self.run(os.open, path, os.O_WRONLY)
+            if path in self._fds:
+                # 并发打开了同一个文件，保留先缓存的fd
+                os.close(fd)
+                fd = self._fds[path]
+            else:
+                self._fds[path] = fd
+        self._fds.move_to_end(path)
+        self._inflight[path] = self._inflight.get(path, 0) + 1
+        # 先标记为使用中再淘汰，否则使用中的fd都不能淘汰时会把刚打开的fd关掉
+        self._evict()
+        return fd
+
+    def _release(self, path: Path):
+        n = self._inflight.pop(path, 0) - 1
+        if n > 0:
+            self._inflight[path] = n
+
+    def _evict(self):
+        for path in list(self._fds):
+            if len(self._fds) <= self._max_open_files:
+                break
+            if self._inflight.get(path):
+                continue
+            os.close(self._fds.pop(path))
+
+    async def preallocate(self, path: Path, size: int):
+        """
+        创建目标文件并预分配大小（稀疏文件，不实际占用磁盘），失败时删除创建的文件
+        """
+
+        def _preallocate():
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(fd, size)
+            except BaseException:
+                os.close(fd)
+                os.unlink(path)
+                raise
+            return fd
+
+        fd = await self.run(_preallocate)
+        old_fd = self._fds.pop(path, None)
+        if old_fd is not None and not self._inflight.get(path):
+            os.close(old_fd)
+        self._fds[path] = fd
+        self._evict()
+
+    async def pwrite(self, path: Path, offset: int, data: bytes | memoryview) -> int:
+        """
+        把data写到文件的offset处
+        """
+
+        def _pwrite():
+            view = memoryview(data)
+            written = 0
+            while written < len(view):
+                written += os.pwrite(fd, view[written:], offset + written)
+            return written
+
+        fd = await self._acquire(path)
+        try:
+            return await self.run(_pwrite)
+        finally:
+            self._release(path)
+
+    async def copy_from(
+        self, path: Path, offset: int, src_fd: int, src_offset: int, count: int
+    ) -> int:
+        """
+        在内核中把src_fd从src_offset开始的count字节拷贝到文件的offset处，
+        返回实际拷贝的字节数（src到达末尾时可能小于count）
+        """
+
+        def _copy():
+            copied = 0
+            while copied < count:
+                n = _copy_file_range(
+                    src_fd, fd, count - copied, src_offset + copied, offset + copied
+                )
+                if n == 0:
+                    break
+                copied += n
+            return copied
+
+        fd = await self._acquire(path)
+        try:
+            return await self.run(_copy)
+        finally:
+            self._release(path)
+
+    async def close(self, path: Path):
+        """
+        关闭文件对应的fd，文件写完之后调用
+        """
+        fd = self._fds.pop(path, None)
+        if fd is not None:
+            await self.run(os.close, fd)
+
+    def close_all(self):
+        self._executor.shutdown(wait=True)
+        while self._fds:
+            _, fd = self._fds.popitem()
+            os.close(fd)
+
+
+class CoalescedWriter:
+    """
+    把连续的小块数据合并起来，攒够batch_size再一次pwrite，减少系统调用和线程池调度
+    """
+
+    def __init__(self, writer: ChunkFileWriter, path: Path, offset: int, batch_size: int):
+        self._writer = writer
+        self._path = path
+        self._offset = offset
+        self._batch_size = batch_size
+        self._buffer = bytearray()
+
+    async def write(self, data: bytes) -> int:
+        """
+        追加数据，返回本次实际落盘的字节数（没有攒够时为0）
+        """
+        if not self._buffer and len(data) >= self._batch_size:
+            # 本身就是大块，不用拷贝
+            return await self._pwrite(data)
+        self._buffer += data
+        if len(self._buffer) < self._batch_size:
+            return 0
+        return await self.flush()
+
+    async def flush(self) -> int:
+        """
+        写入缓冲区里剩余的数据，返回落盘的字节数
+        """
+        if not self._buffer:
+            return 0
+        data, self._buffer = self._buffer, bytearray()
+        return await self._pwrite(data)
+
+    async def _pwrite(self, data: bytes | bytearray) -> int:
+        n = await self._writer.pwrite(self._path, self._offset, data)
+        self._offset += n
+        return n
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, count: int, src_offset: int, dst_offset: int) -> int:
+    if hasattr(os, "copy_file_range"):
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+        except OSError as e:
+            # 跨文件系统等场景内核可能不支持，退化为pread/pwrite
+            logger.debug(f"copy_file_range 不可用: {e}")
+    data = os.pread(src_fd, min(count, 1024 * 1024), src_offset)
+    return os.pwrite(dst_fd, data, dst_offset) if data else 0
+
+
+def init_chunk_file_writer(
+    max_open_files: int, io_workers: int, max_pending: int
+) -> Iterator[ChunkFileWriter]:
+    writer = ChunkFileWriter(
+        max_open_files=max_open_files, io_workers=io_workers, max_pending=max_pending
+    )
+    yield writer
+    writer.close_all()
@@ -0,0 +1,38 @@
+from email.utils import parsedate_to_datetime
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+
+
+class StorageFileResponse(FileResponse):
+    """
+    存储文件的下载响应，只使用starlette FileResponse的公开接口
+
+    零拷贝取决于ASGI服务器：服务器支持 http.response.pathsend 扩展（例如Granian）时，
+    不带Range的整个文件由服务器直接按路径发送，不经过python的读循环；
+    uvicorn等不支持这个扩展的服务器，以及Range请求，按chunk_size读取文件发送
+    """
+
+    # 调大每次读取的大小，减少读循环的次数
+    chunk_size = 1024 * 1024
+
+
+def is_not_modified(request_headers: Headers, etag: str, mtime: float) -> bool:
+    """
+    根据If-None-Match（优先）或If-Modified-Since判断客户端缓存是否仍然有效
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # If-None-Match使用弱比较
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag.removeprefix("W/") in tags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
@@ -1,10 +1,32 @@
+import asyncio
+import json
 import math
+import os
+import stat
 from pathlib import Path
 from time import time
-from uuid import UUID
+from typing import AsyncIterator, Awaitable, Callable
+from uuid import UUID, uuid4
 
-import aiofiles.os
+from app.core.file_storage.admission import UploadAdmission
+from app.core.file_storage.checksum import (
+    ChunkChecksumMismatch,
+    ChunkHasher,
+    combine_chunk_checksums,
+    file_checksum,
+    parse_checksum,
+)
+from app.core.file_storage.chunking import ChunkSizePolicy, ClientThroughputStore
+from app.core.file_storage.digest import IncrementalDigests, file_digest
+from app.core.file_storage.encoding import ChunkDecodeError, decode_stream
+from app.core.file_storage.file_io import ChunkFileWriter, CoalescedWriter
+from app.core.file_storage.layout import paths_key, shard_path
+from app.core.file_storage.metrics import StageTimings, UploadStage
+from app.core.file_storage.progress import ProgressThrottle
+from app.core.file_storage.progress_ws import ProgressSocket
+from app.core.file_storage.task_store import FileUploadTaskStore
 from app.core.file_storage.schemas import (
+    FileChunkEncoding,
     FileChunkUploadResponse,
     FileChunkUploadRetCode,
     FileUploadProgress,
@@ -13,11 +35,12 @@ from app.core.file_storage.schemas import (
     FileUploadTaskCreate,
     FileUploadTaskPrivate,
     FileUploadTaskPublic,
+    FileUploadTaskQueryResult,
 )
 from redis.asyncio import Redis
 from pydantic_settings import BaseSettings
-import aiofiles
-from fastapi import UploadFile
+from fastapi import UploadFile, WebSocket
+from sse_starlette import EventSourceResponse
 
 from app.core.sse import SSEPubSub
 import logging
@@ -31,8 +54,64 @@ logger = logging.getLogger(__name__)
 class FileUploadSettings(BaseSettings):
     temp_dir: Path = Path("/tmp") / "file_upload" / "temp"
     storge_dir: Path = Path("/tmp") / "file_upload" / "storage"
+    # 默认分片大小，创建任务时会根据文件大小、客户端提示和吞吐量调整
     chunk_size: int = 1024 * 1024
+    min_chunk_size: int = 256 * 1024
+    max_chunk_size: int = 64 * 1024 * 1024
+    max_chunks: int = 10000
+    # 不超过这个大小的文件只用一个分片，可以一次请求上传完
+    single_request_threshold: int = 1024 * 1024
+    # 上传任务允许的最大文件大小
+    max_file_size: int = 1024**4
+    # 按吞吐量选择分片大小时，每个分片期望的上传时间
+    target_chunk_seconds: float = 2.0
+    # 每次从请求体读取的大小
     buffer_size: int = 64 * 1024
+    # 小块数据合并到这个大小再写入磁盘
+    write_batch_size: int = 1024 * 1024
+    # 上传专用的磁盘I/O线程数，以及最多排队的磁盘操作数
+    io_workers: int = 16
+    io_max_pending: int = 256
+    # 准入控制：每个进程同时写入的分片数，bucket和客户端的写入速度（字节/秒，0不限速）
+    max_concurrent_writes: int = 64
+    bucket_rate: int = 0
+    bucket_burst: int = 0
+    client_rate: int = 0
+    client_burst: int = 0
+    # 可信的反向代理地址，只有来自这些地址的请求才按X-Client-Id区分客户端，否则按来源地址
+    trusted_proxies: list[str] = []
+    # 记录上传各阶段的耗时直方图
+    metrics_enabled: bool = False
+    # 每个进程最多缓存多少个打开的分片目标文件
+    max_open_files: int = 256
+    # 进度推送节流：最多每progress_interval_ms或每前进progress_step_percent推送一次
+    progress_interval_ms: int = 500
+    progress_step_percent: float = 1.0
+    # 进度流按batch请求合并时，把这个间隔内多个任务的更新合并成一个SSE事件（0不合并）；
+    # WebSocket进度通道总是按这个间隔合并
+    progress_batch_ms: int = 200
+    # 每个WebSocket进度连接最多同时关注的任务数
+    progress_ws_max_tasks: int = 1000
+    # 文件内容摘要算法，存储按摘要寻址
+    digest_algorithm: str = "sha256"
+
+
+class ChunkSizeMismatch(Exception):
+    """
+    分片大小和任务期望的分片大小不一致
+    """
+
+
+class FileDigestMismatch(Exception):
+    """
+    上传完成的文件摘要和创建任务时提供的摘要不一致
+    """
+
+
+class FileTooLarge(Exception):
+    """
+    文件超过了允许的最大文件大小，或者超过了一次请求上传的大小限制（需要创建任务分片上传）
+    """
 
 
 class FileUploader:
@@ -42,37 +121,148 @@ class FileUploader:
         bucket_name: str,
         redis: Redis,
         sse_pubsub: SSEPubSub,
+        file_writer: ChunkFileWriter,
+        progress_throttle: ProgressThrottle,
+        task_store: FileUploadTaskStore,
+        digests: IncrementalDigests,
+        chunk_size_policy: ChunkSizePolicy,
+        throughput_store: ClientThroughputStore,
+        admission: UploadAdmission,
+        timings: StageTimings,
+        client_id: str | None = None,
     ):
         self._bucket_name = bucket_name
         self._settings = settings
         self._redis = redis
         self._sse_pubsub = sse_pubsub
+        self._file_writer = file_writer
+        self._progress_throttle = progress_throttle
+        self._task_store = task_store
+        self._digests = digests
+        self._chunk_size_policy = chunk_size_policy
+        self._throughput_store = throughput_store
+        self._admission = admission
+        self._timings = timings
+        self._client_id = client_id
         self._settings.temp_dir.mkdir(parents=True, exist_ok=True)
         self._settings.storge_dir.mkdir(parents=True, exist_ok=True)
 
     def _progress_channel(self, task_id: UUID) -> str:
         return f"file_upload_progress:{task_id}"
 
-    def _task_key(self, task_id: UUID) -> str:
-        return f"file_upload_task:{task_id}"
+    def _blobs_key(self) -> str:
+        # 摘要 -> blob路径
+        return "file_upload_blobs"
+
+    def _files_key(self) -> str:
+        # 文件名 -> 摘要
+        return f"file_upload_files:{self._bucket_name}"
+
+    def _blob_path(self, digest: str) -> Path:
+        # blob和存储目录在同一个文件系统上，文件名硬链接到blob，链接数就是引用计数
+        return shard_path(self._settings.storge_dir / ".blobs", digest)
+
+    def _paths_key(self) -> str:
+        return paths_key(self._bucket_name)
+
+    def _temp_path(self, task: FileUploadTaskPrivate) -> Path:
+        # 上传中的文件按任务id分片存放，同名文件的任务互不影响
+        return shard_path(task.temp_dir, task.id.hex)
+
+    def _storage_path(self, task: FileUploadTaskPrivate) -> Path:
+        return shard_path(task.storge_dir, task.id.hex)
+
+    async def _run_io(self, func, *args):
+        # 和分片写入共用上传专用的磁盘I/O线程池
+        return await self._file_writer.run(func, *args)
+
+    async def _find_blobs(
+        self, tasks: list[FileUploadTaskPrivate]
+    ) -> list[Path | None]:
+        """
+        根据摘要批量查找已经存储的blob，一次往返
+        """
+        digests = [task.digest for task in tasks if task.digest]
+        if not digests:
+            return [None] * len(tasks)
+        found = dict(zip(digests, await self._redis.hmget(self._blobs_key(), digests)))
+        blob_paths: list[Path | None] = []
+        for task in tasks:
+            blob_path = found.get(task.digest) if task.digest else None
+            if blob_path:
+                try:
+                    st = await self._run_io(os.stat, blob_path)
+                except FileNotFoundError:
+                    # blob已经被删除，索引过期
+                    await self._redis.hdel(self._blobs_key(), task.digest)
+                    blob_path = None
+                else:
+                    if st.st_size != task.file_size:
+                        blob_path = None
+            blob_paths.append(Path(blob_path) if blob_path else None)
+        return blob_paths
+
+    async def _link_file(self, task: FileUploadTaskPrivate, blob_path: Path):
+        """
+        把文件硬链接到blob，记录文件名对应的物理路径和摘要，
+        同名文件会被替换，旧的物理文件被删除
+        """
+        path = self._storage_path(task)
+        await self._run_io(_replace_with_link, blob_path, path)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hget(self._paths_key(), task.file_name)
+            pipe.hset(self._paths_key(), task.file_name, str(path.relative_to(task.storge_dir)))
+            pipe.hset(self._files_key(), task.file_name, task.digest)
+            pipe.hset(self._blobs_key(), task.digest, str(blob_path))
+            old_path, *_ = await pipe.execute()
+        if old_path and task.storge_dir / old_path != path:
+            try:
+                await self._run_io(os.remove, task.storge_dir / old_path)
+            except FileNotFoundError:
+                pass
+
+    async def stored_file(
+        self, file_name: str
+    ) -> tuple[Path, os.stat_result, str | None] | None:
+        """
+        查找已经存储的文件，返回(路径, stat, 摘要)，文件不存在时返回None；
+        文件名记录的摘要和文件指向的blob一致时才返回摘要
+        """
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hget(self._paths_key(), file_name)
+            pipe.hget(self._files_key(), file_name)
+            rel_path, digest = await pipe.execute()
+        if not rel_path:
+            return None
+        path = self._settings.storge_dir / self._bucket_name / rel_path
+        try:
+            st = await self._run_io(os.stat, path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        if digest:
+            try:
+                blob_st = await self._run_io(os.stat, self._blob_path(digest))
+            except FileNotFoundError:
+                digest = None
+            else:
+                if (blob_st.st_dev, blob_st.st_ino) != (st.st_dev, st.st_ino):
+                    # 文件被替换过，摘要已经过期
+                    digest = None
+        return path, st, digest
 
     async def store_task(self, task: FileUploadTaskPrivate):
         """
         存储文件上传任务
         """
-        await self._redis.set(
-            self._task_key(task.id),
-            task.model_dump_json(),
-        )
+        await self._task_store.store(task)
 
     async def get_task(self, task_id: UUID) -> FileUploadTaskPrivate | None:
         """
         获取文件上传任务
         """
-        task_json = await self._redis.get(self._task_key(task_id))
-        if not task_json:
-            return None
-        return FileUploadTaskPrivate.model_validate_json(task_json)
+        return await self._task_store.get(task_id)
 
     async def query_task(self, task_id: UUID) -> FileUploadTaskPublic | None:
         """
@@ -83,18 +273,57 @@ class FileUploader:
             return None
         return FileUploadTaskPublic.model_validate(task.model_dump())
 
+    async def query_tasks(self, task_ids: list[UUID]) -> list[FileUploadTaskQueryResult]:
+        """
+        批量查询文件上传任务，结果和task_ids一一对应，不存在的任务found为False
+        """
+        tasks = await self._task_store.get_many(task_ids)
+        return [
+            FileUploadTaskQueryResult(
+                id=task_id,
+                found=task is not None,
+                task=FileUploadTaskPublic.model_validate(task.model_dump())
+                if task
+                else None,
+            )
+            for task_id, task in zip(task_ids, tasks)
+        ]
+
     async def expire_task(self, task_id: UUID):
         """
         过期文件上传任务
         """
-        await self._redis.expire(self._task_key(task_id), 5 * 60)
+        await self._task_store.expire(task_id)
+
+    async def notify_progress(self, task: FileUploadTaskPrivate, force: bool = False):
+        """
+        通知文件上传进度，按时间和进度节流，force=True时总是推送
+        """
+        await self.notify_progress_many([task], force)
 
-    async def notify_progress(self, task: FileUploadTaskPrivate):
+    async def notify_progress_many(
+        self, tasks: list[FileUploadTaskPrivate], force: bool = False
+    ):
         """
-        通知文件上传进度
+        通知多个任务的进度，需要推送的消息一次往返发布
         """
+        messages = []
+        for task in tasks:
+            message = self._progress_message(task, force)
+            if message is not None:
+                messages.append((self._progress_channel(task.id), message))
+        if not messages:
+            return
+        with self._timings.stage(UploadStage.PUBLISH):
+            await self._sse_pubsub.publish_many(messages)
+
+    def _progress_message(self, task: FileUploadTaskPrivate, force: bool) -> str | None:
         file_size = task.file_size
         uploaded_bytes = task.uploaded_bytes
+        if not self._progress_throttle.should_emit(
+            task.id, uploaded_bytes, file_size, force
+        ):
+            return None
 
         p = FileUploadProgress(
             **task.model_dump(),
@@ -107,39 +336,148 @@ class FileUploader:
             else min(100.0, round((uploaded_bytes / p.elapsed_time) / 1024, 2))
         )
         p.unit = "KB/s"
-        await self._sse_pubsub.publish(
-            self._progress_channel(task.id),
-            p.model_dump_json(),
-        )
+        return p.model_dump_json()
 
-    async def progress(self, task_ids: list[UUID]):
+    async def progress(
+        self, task_ids: list[UUID], last_event_id: str | None = None, batch: bool = False
+    ) -> EventSourceResponse:
         """
-        获取文件上传进度
+        获取文件上传进度，断线重连时从last_event_id之后继续，所有任务都结束（完成、失败或者不存在）后关闭
+
+        默认每条进度是一个事件，数据是单个任务的进度；batch为True时，
+        多个任务的更新按progress_batch_ms合并成一个事件，数据是每个任务最新进度组成的数组
         """
+        task_ids = list(dict.fromkeys(task_ids))
+        tasks = await self._task_store.get_many(task_ids)
+        done = [
+            self._progress_channel(task_id)
+            for task_id, task in zip(task_ids, tasks)
+            if task is None or task.status in _FINAL_STATUSES
+        ]
         channels = tuple([self._progress_channel(task_id) for task_id in task_ids])
-        return await self._sse_pubsub.subscribe(*channels)
+        return await self._sse_pubsub.subscribe(
+            *channels,
+            last_event_id=last_event_id,
+            batch_interval=self._settings.progress_batch_ms / 1000 if batch else 0,
+            is_final=_is_final_progress,
+            done=done,
+        )
 
-    async def create_task(
-        self, task_data: FileUploadTaskCreate
-    ) -> FileUploadTaskPublic:
+    async def progress_socket(self, websocket: WebSocket):
         """
-        创建文件上传任务
+        通过WebSocket推送二进制的进度增量，连接期间可以增加或者取消关注的任务
         """
+        await ProgressSocket(
+            websocket,
+            self._sse_pubsub.backend,
+            self.query_tasks,
+            self._progress_channel,
+            self._settings.progress_batch_ms / 1000,
+            self._settings.progress_ws_max_tasks,
+        ).serve()
+
+    def _new_task(
+        self, task_data: FileUploadTaskCreate, throughput: float | None = None
+    ) -> FileUploadTaskPrivate:
         task_public = FileUploadTaskPublic(**task_data.model_dump())
-        task_public.chunk_size = self._settings.chunk_size
+        task_public.chunk_size = self._chunk_size_policy.choose(
+            task_data.file_size, task_data.chunk_size_hint, throughput
+        )
         task_public.total_chunks = math.ceil(
             task_public.file_size / task_public.chunk_size
         )
-        task = FileUploadTaskPrivate(
+        return FileUploadTaskPrivate(
             **task_public.model_dump(),
             temp_dir=self._settings.temp_dir / self._bucket_name,
             storge_dir=self._settings.storge_dir / self._bucket_name,
         )
-        task.temp_dir.mkdir(parents=True, exist_ok=True)
-        task.storge_dir.mkdir(parents=True, exist_ok=True)
-        await self.store_task(task)
-        await self.notify_progress(task)
-        return task_public
+
+    async def create_task(
+        self, task_data: FileUploadTaskCreate
+    ) -> FileUploadTaskPublic:
+        """
+        创建文件上传任务
+        """
+        return (await self.create_tasks([task_data]))[0]
+
+    async def create_tasks(
+        self, tasks_data: list[FileUploadTaskCreate]
+    ) -> list[FileUploadTaskPublic]:
+        """
+        批量创建文件上传任务，查找blob和存储任务都只需要一次往返
+        """
+        if not tasks_data:
+            return []
+        for task_data in tasks_data:
+            if task_data.file_size > self._settings.max_file_size:
+                raise FileTooLarge(
+                    f"文件大小 {task_data.file_size} 超过了 {self._settings.max_file_size}"
+                )
+        throughput = (
+            await self._throughput_store.get(self._client_id)
+            if self._client_id
+            else None
+        )
+        tasks = [self._new_task(task_data, throughput) for task_data in tasks_data]
+        finished: list[FileUploadTaskPrivate] = []
+        for task, blob_path in zip(tasks, await self._find_blobs(tasks)):
+            if blob_path:
+                # 已经存储过相同内容的文件，直接链接过去，任务立即完成
+                await self._link_file(task, blob_path)
+                task.uploaded_bytes = task.file_size
+                task.received_chunks = task.nxt_chunk_idx = task.total_chunks
+                task.status = FileUploadTaskStatus.FINISHED
+                task.end_time = time()
+                finished.append(task)
+            else:
+                # 提前预分配目标文件，分片按各自的偏移写入
+                path = self._temp_path(task)
+                await self._run_io(_makedirs, path.parent)
+                await self._file_writer.preallocate(path, task.file_size)
+
+        await self._task_store.store_many(tasks, expire=[task.id for task in finished])
+        await self.notify_progress_many(tasks, force=True)
+        for task in finished:
+            self._progress_throttle.forget(task.id)
+        return [FileUploadTaskPublic.model_validate(task.model_dump()) for task in tasks]
+
+
+async def _read_upload_file(file: UploadFile, buffer_size: int) -> AsyncIterator[bytes]:
+    while buffer := await file.read(buffer_size):
+        yield buffer
+
+
+_FINAL_STATUSES = (FileUploadTaskStatus.FINISHED, FileUploadTaskStatus.FAILED)
+
+
+def _is_final_progress(message: str) -> bool:
+    return json.loads(message).get("status") in _FINAL_STATUSES
+
+
+def _makedirs(path: Path):
+    path.mkdir(parents=True, exist_ok=True)
+
+
+def _store_blob(src: Path, blob_path: Path):
+    """
+    把上传完成的文件链接成blob，blob已经存在时（相同内容已经存储过，
+    或者相同内容的上传同时完成）保留已有的blob，丢弃上传的副本；
+    os.link不会覆盖已有的文件，不会替换掉已经被硬链接的blob
+    """
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(src, blob_path)
+    except FileExistsError:
+        pass
+    os.remove(src)
+
+
+def _replace_with_link(src: Path, dst: Path):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f".{dst.name}.link")
+    tmp.unlink(missing_ok=True)
+    os.link(src, tmp)
+    os.replace(tmp, dst)
 
 
 class FileChunkUploader(FileUploader):
@@ -148,106 +486,388 @@ class FileChunkUploader(FileUploader):
         task: FileUploadTaskPrivate,
         chunk_idx: int,
         chunk: UploadFile,
-    ):
+        encoding: FileChunkEncoding = FileChunkEncoding.IDENTITY,
+        hasher: ChunkHasher | None = None,
+    ) -> int:
         """
-        写入文件分片
+        写入文件分片，返回写入的字节数，分片大小必须和任务期望的一致
         """
+        if encoding != FileChunkEncoding.IDENTITY or not getattr(chunk.file, "_rolled", False):
+            # 内存中的分片和压缩的分片都按流写入，边写边检查大小，
+            # 压缩的分片边读边解压，偏移和大小都按解压后的字节计算
+            stream = _read_upload_file(chunk, self._settings.buffer_size)
+            content_length = chunk.size if encoding == FileChunkEncoding.IDENTITY else None
+            return await self._write_chunk_stream(
+                task, chunk_idx, stream, content_length, encoding, hasher
+            )
+
+        # 分片已经被starlette落盘，直接在内核中拷贝到目标偏移
+        path = self._temp_path(task)
         pos = chunk_idx * task.chunk_size
-        async with aiofiles.open(
-            task.temp_dir / f"{task.file_name}",
-            "wb",
-        ) as f:
-            await f.seek(pos)
-            while True:
-                buffer = await chunk.read(self._settings.buffer_size)
-                if not buffer:
-                    break
-                await f.write(buffer)
-                task.uploaded_bytes += len(buffer)
-                await self.notify_progress(task)
+        src_fd = chunk.file.fileno()
+        count = os.fstat(src_fd).st_size
+        expected = self._expected_chunk_size(task, chunk_idx)
+        if count != expected:
+            # 写入之前检查，不能写到下一个分片的范围里
+            raise ChunkSizeMismatch(f"分片大小 {count} != {expected}")
+        if self._digests.accepts(task.id, pos):
+            await self._run_io(self._digests.update_from_fd, task.id, pos, src_fd, count)
+        if hasher:
+            await self._run_io(hasher.update_from_fd, src_fd, count)
+            hasher.verify()
+        n = await self._file_writer.copy_from(path, pos, src_fd, 0, count)
+        if n != count:
+            raise ChunkSizeMismatch(f"分片大小 {n} != {expected}")
+        task.uploaded_bytes += n
+        await self.notify_progress(task)
+        return n
+
+    async def _write_chunk_stream(
+        self,
+        task: FileUploadTaskPrivate,
+        chunk_idx: int,
+        stream: AsyncIterator[bytes],
+        content_length: int | None,
+        encoding: FileChunkEncoding = FileChunkEncoding.IDENTITY,
+        hasher: ChunkHasher | None = None,
+    ) -> int:
+        """
+        把请求体流直接写到分片偏移，分片大小必须和任务期望的一致，
+        压缩的分片按解压后的大小计算，有校验和时边写边校验
+        """
+        expected = self._expected_chunk_size(task, chunk_idx)
+        if encoding != FileChunkEncoding.IDENTITY:
+            stream = decode_stream(stream, encoding, self._settings.buffer_size)
+        elif content_length is not None and content_length != expected:
+            raise ChunkSizeMismatch(f"Content-Length {content_length} != {expected}")
+
+        path = self._temp_path(task)
+        start = pos = chunk_idx * task.chunk_size
+        batch = self._file_writer.coalesce(path, pos, self._settings.write_batch_size)
+        async for buffer in stream:
+            if not buffer:
+                continue
+            if pos - start + len(buffer) > expected:
+                # 不能写到下一个分片的范围里
+                raise ChunkSizeMismatch(f"分片大小超过了 {expected}")
+            pos = await self._write_buffer(task, batch, pos, buffer, hasher)
+        if pos - start != expected:
+            raise ChunkSizeMismatch(f"分片大小 {pos - start} != {expected}")
+        if hasher:
+            hasher.verify()
+        await self._flush_buffer(task, batch)
+        return expected
+
+    async def _write_buffer(
+        self,
+        task: FileUploadTaskPrivate,
+        batch: CoalescedWriter,
+        pos: int,
+        buffer: bytes,
+        hasher: ChunkHasher | None = None,
+    ) -> int:
+        """
+        把一块数据追加到pos处，同时更新摘要和校验和，攒够一批落盘后更新进度，返回新的pos
+        """
+        self._digests.update(task.id, pos, buffer)
+        if hasher:
+            hasher.update(buffer)
+        n = await batch.write(buffer)
+        if n:
+            task.uploaded_bytes += n
+            await self.notify_progress(task)
+        return pos + len(buffer)
+
+    async def _flush_buffer(self, task: FileUploadTaskPrivate, batch: CoalescedWriter):
+        n = await batch.flush()
+        if n:
+            task.uploaded_bytes += n
+            await self.notify_progress(task)
+
+    @staticmethod
+    def _expected_chunk_size(task: FileUploadTaskPrivate, chunk_idx: int) -> int:
+        return min(task.chunk_size, task.file_size - chunk_idx * task.chunk_size)
 
     async def _storage_file(self, task: FileUploadTaskPrivate):
         """
-        移动文件分片到存储目录
+        计算文件摘要并移动到按摘要寻址的存储目录，文件名硬链接到blob
+        """
+        path = self._temp_path(task)
+        await self._file_writer.close(path)
+        if task.checksum:
+            await self._verify_checksum(task, path)
+        digest = self._digests.hexdigest(task.id, task.file_size)
+        self._digests.forget(task.id)
+        if digest is None:
+            # 分片乱序到达或者落在了其它进程，只能重新读取文件计算
+            digest = await self._run_io(
+                file_digest, path, self._settings.digest_algorithm
+            )
+        if task.digest and task.digest != digest:
+            await self._run_io(os.remove, path)
+            raise FileDigestMismatch(f"文件摘要不一致: {task.digest} != {digest}")
+        task.digest = digest
+
+        blob_path = self._blob_path(digest)
+        await self._run_io(_store_blob, path, blob_path)
+        await self._link_file(task, blob_path)
+
+    async def _verify_checksum(self, task: FileUploadTaskPrivate, path: Path):
+        """
+        用每个分片的CRC合并出整个文件的CRC来校验，不需要重新读取文件；
+        分片的校验和不全时才重新读取文件计算
         """
-        await aiofiles.os.rename(
-            task.temp_dir / f"{task.file_name}",
-            task.storge_dir / f"{task.file_name}",
+        checksum = combine_chunk_checksums(
+            await self._task_store.chunk_checksums(task), task.chunk_size, task.file_size
         )
+        if checksum is None:
+            algorithm, _ = parse_checksum(task.checksum)
+            checksum = await self._run_io(file_checksum, path, algorithm)
+        if checksum != task.checksum:
+            self._digests.forget(task.id)
+            await self._run_io(os.remove, path)
+            raise FileDigestMismatch(f"文件校验和不一致: {task.checksum} != {checksum}")
+
+    def _chunk_hasher(
+        self, task: FileUploadTaskPrivate, checksum: str | None
+    ) -> ChunkHasher | None:
+        # 分片带了校验和时边写边校验；任务有整个文件的CRC时，
+        # 没带校验和的分片也要计算CRC，完成时用来合并
+        if checksum:
+            return ChunkHasher.from_checksum(checksum)
+        if task.checksum:
+            return ChunkHasher(parse_checksum(task.checksum)[0])
+        return None
+
+    async def _finish_task(self, task: FileUploadTaskPrivate):
+        """
+        所有分片上传完成，移动文件并结束任务
+        """
+        with self._timings.stage(UploadStage.FINALIZE):
+            await self._storage_file(task)
+        await self._task_store.finish(task)
+        await self.notify_progress(task, force=True)
+        self._progress_throttle.forget(task.id)
+        await self._observe_throughput(task)
+
+    async def _observe_throughput(self, task: FileUploadTaskPrivate):
+        """
+        用整个任务的平均速度更新客户端吞吐量，小文件主要是请求延迟，不计入
+        """
+        if (
+            not self._client_id
+            or task.file_size <= self._chunk_size_policy.single_request_threshold
+        ):
+            return
+        try:
+            await self._throughput_store.observe(
+                self._client_id, task.file_size, time() - task.start_time
+            )
+        except Exception as e:
+            logger.error(f"记录客户端{self._client_id}吞吐量失败: {e}")
+
+    async def _fail_task(self, task: FileUploadTaskPrivate):
+        """
+        任务失败，清理上传中的文件
+        """
+        self._digests.forget(task.id)
+        try:
+            await self._task_store.fail(task)
+        except Exception as e:
+            logger.error(f"标记文件上传任务{task.id}失败出错: {e}")
+        path = self._temp_path(task)
+        try:
+            await self._file_writer.close(path)
+            await self._run_io(os.remove, path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"删除文件上传任务{task.id}的临时文件失败: {e}")
+        await self._notify_failure(task)
+        self._progress_throttle.forget(task.id)
+
+    async def _notify_failure(self, task: FileUploadTaskPrivate):
+        """
+        分片上传失败时强制推送一次进度，推送失败不影响返回
+        """
+        try:
+            await self.notify_progress(task, force=True)
+        except Exception as e:
+            logger.error(f"推送文件上传任务{task.id}进度失败: {e}")
 
     async def upload_chunk(
         self, req: FileChunkUploadRequest
     ) -> FileChunkUploadResponse:
         """
-        上传文件分片
+        上传文件分片（multipart表单）
         """
-        # TODO: 如果有必要的话加锁，一次只能处理一个分片
         rsp = FileChunkUploadResponse.model_validate(req.model_dump())
-        task = await self.get_task(req.id)
-        if not task:
-            # 任务不存在，应该重新创建任务
-            rsp.success = False
-            rsp.code = FileChunkUploadRetCode.TASK_NOT_EXIST
-            return rsp
+        encoding = req.content_encoding or FileChunkEncoding.IDENTITY
+        async with self._admit(req.chunk.size):
+            return await self._upload_chunk(
+                rsp,
+                lambda task, hasher: self._write_chunk(
+                    task, req.chunk_idx, req.chunk, encoding, hasher
+                ),
+                req.checksum,
+            )
 
-        # 默认设置rsp里面需要的nxt_chunk_idx
-        nxt_chunk_idx = task.nxt_chunk_idx
-        rsp.nxt_chunk_idx = nxt_chunk_idx
-        if req.chunk_idx != nxt_chunk_idx:
-            # 分片索引错误, 应该根据rsp里面返回的nxt_chunk_idx来进行上传
-            rsp.success = False
-            rsp.code = FileChunkUploadRetCode.CHUNK_IDX_WRONG
-            return rsp
+    async def upload_file(
+        self, task_data: FileUploadTaskCreate, file: UploadFile
+    ) -> FileChunkUploadResponse:
+        """
+        小文件一次请求上传完：创建只有一个分片的任务并直接写入
+        """
+        if task_data.file_size > self._chunk_size_policy.single_request_threshold:
+            raise FileTooLarge(
+                f"文件大小 {task_data.file_size} 超过了 "
+                f"{self._chunk_size_policy.single_request_threshold}"
+            )
+        async with self._admit(task_data.file_size):
+            task = await self.create_task(task_data)
+            rsp = FileChunkUploadResponse(id=task.id, chunk_idx=0)
+            if task.status == FileUploadTaskStatus.FINISHED:
+                # 秒传
+                rsp.success = True
+                rsp.code = FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+                rsp.nxt_chunk_idx = rsp.received_chunks = task.total_chunks
+                return rsp
+            return await self._upload_chunk(
+                rsp, lambda task, hasher: self._write_chunk(task, 0, file, hasher=hasher)
+            )
 
-        if task.status == FileUploadTaskStatus.FINISHED:
-            # 任务已经完成，不能再上传分片
-            rsp.success = False
-            rsp.code = FileChunkUploadRetCode.TASK_ALREADY_FINISHED
-            return rsp
+    async def upload_chunk_stream(
+        self,
+        task_id: UUID,
+        chunk_idx: int,
+        stream: AsyncIterator[bytes],
+        content_length: int | None = None,
+        encoding: FileChunkEncoding = FileChunkEncoding.IDENTITY,
+        checksum: str | None = None,
+    ) -> FileChunkUploadResponse:
+        """
+        上传文件分片（原始请求体），不经过multipart解析和临时文件
+        """
+        rsp = FileChunkUploadResponse(id=task_id, chunk_idx=chunk_idx)
+        async with self._admit(content_length):
+            return await self._upload_chunk(
+                rsp,
+                lambda task, hasher: self._write_chunk_stream(
+                    task, chunk_idx, stream, content_length, encoding, hasher
+                ),
+                checksum,
+            )
+
+    def _admit(self, nbytes: int | None):
+        """
+        准入控制，繁忙或者超过限速时抛出UploadRejected，
+        不知道分片大小时按默认分片大小计算
+        """
+        return self._admission.admit(
+            self._bucket_name, self._client_id, nbytes or self._settings.chunk_size
+        )
 
-        if task.status == FileUploadTaskStatus.UPLOADING_ONE_CHUNK:
-            # 正在上传中，需要等待上传完成再上传下一个分片
+    async def _upload_chunk(
+        self,
+        rsp: FileChunkUploadResponse,
+        write: Callable[[FileUploadTaskPrivate, ChunkHasher | None], Awaitable[int]],
+        checksum: str | None = None,
+    ) -> FileChunkUploadResponse:
+        """
+        上传文件分片，write负责把分片写到文件里（同时计算校验和）并返回写入的字节数，
+        checksum是客户端提供的分片校验和
+
+        顺序上传一次只能上传nxt_chunk_idx指向的分片；
+        并行上传的分片可以并发、乱序到达，每个分片写到自己的偏移，
+        所有分片都收到后任务完成
+        """
+        chunk_idx = rsp.chunk_idx
+        # 占用分片，同一个分片同时只能有一个请求在写，token用来确认提交时占用还属于这个请求
+        token = uuid4().hex
+        with self._timings.stage(UploadStage.STATE_LOAD):
+            code, task = await self._task_store.claim_chunk(rsp.id, chunk_idx, token)
+        if task:
+            # 默认设置rsp里面需要的nxt_chunk_idx，
+            # 顺序上传时客户端应该根据nxt_chunk_idx来进行上传
+            rsp.nxt_chunk_idx = task.nxt_chunk_idx
+            rsp.received_chunks = task.received_chunks
+        if code:
+            # 任务不存在、分片索引错误、分片正在上传、任务已经完成等
             rsp.success = False
-            rsp.code = FileChunkUploadRetCode.CHUNK_UPLOADING
+            rsp.code = code
             return rsp
 
-        chunk_idx = req.chunk_idx
+        task.status = FileUploadTaskStatus.UPLOADING_ONE_CHUNK
+        uploaded_bytes = task.uploaded_bytes
         try:
-            # 设置任务状态为上传中
-            task.status = FileUploadTaskStatus.UPLOADING_ONE_CHUNK
-            await self.store_task(task)
-
             # 写入文件分片
-            await self._write_chunk(task, chunk_idx, req.chunk)
-            nxt_chunk_idx = chunk_idx + 1
-            rsp.nxt_chunk_idx = nxt_chunk_idx
-            task.nxt_chunk_idx = nxt_chunk_idx
-            if nxt_chunk_idx == task.total_chunks:
-                # 上传完成
-                rsp.success = True
-                rsp.code = FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
-
-                # 移动文件分片到存储目录
-                await self._storage_file(task)
-                task.end_time = time()
-                task.status = FileUploadTaskStatus.FINISHED
-                await self.store_task(task)
-                await self.expire_task(task.id)
-                await self.notify_progress(task)
+            hasher = self._chunk_hasher(task, checksum)
+            with self._timings.stage(UploadStage.DISK_WRITE):
+                chunk_bytes = await write(task, hasher)
+            with self._timings.stage(UploadStage.STATE_STORE):
+                rsp.code = await self._task_store.complete_chunk(
+                    task, chunk_idx, chunk_bytes, token, hasher.checksum if hasher else None
+                )
+        except BaseException as e:
+            # 释放分片，客户端需要重新上传该分片；
+            # 客户端断开（CancelledError）时也要释放，否则分片一直处于上传中
+            try:
+                await asyncio.shield(
+                    self._task_store.release_chunk(task.id, chunk_idx, token)
+                )
+            except Exception as release_error:
+                logger.error(f"释放文件分片{chunk_idx}失败: {release_error}")
+            # 增量摘要已经算进了这个分片被拒绝的数据，重传可能落在其它进程，
+            # 之后到达这个进程的分片不能接着算，完成时重新读取文件计算
+            self._digests.forget(task.id)
+            if not isinstance(e, Exception):
+                raise
+            logger.error(f"上传文件分片{chunk_idx}失败: {e}")
+            if isinstance(e, ChunkSizeMismatch):
+                rsp.code = FileChunkUploadRetCode.CHUNK_SIZE_WRONG
+            elif isinstance(e, ChunkDecodeError):
+                rsp.code = FileChunkUploadRetCode.CHUNK_DECODE_FAILED
+            elif isinstance(e, ChunkChecksumMismatch):
+                # 只需要重新上传这个分片
+                rsp.code = FileChunkUploadRetCode.CHUNK_CHECKSUM_MISMATCH
             else:
-                # 当前分片上传成功，等待上传下个分片
-                rsp.success = True
-                rsp.code = FileChunkUploadRetCode.WAITING_NEXT_CHUNK
-                task.nxt_chunk_idx = nxt_chunk_idx
-                task.status = FileUploadTaskStatus.WAITING_NEXT_CHUNK
-                await self.store_task(task)
-                await self.notify_progress(task)
+                rsp.code = FileChunkUploadRetCode.INTERNAL_ERROR
+            task.uploaded_bytes = uploaded_bytes
+            await self._notify_failure(task)
+            rsp.success = False
+            return rsp
 
-        except Exception as e:
-            # 记录错误信息，发生错误的时候不修改任务状态，需要重新上传
-            logger.error(f"上传文件分片{chunk_idx}失败: {e}")
+        rsp.nxt_chunk_idx = task.nxt_chunk_idx
+        rsp.received_chunks = task.received_chunks
+        if rsp.code not in (
+            FileChunkUploadRetCode.WAITING_NEXT_CHUNK,
+            FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED,
+        ):
+            # 占用超时后被其它请求接手，这个分片由接手的请求提交
+            logger.warning(f"文件分片{chunk_idx}的占用已经被接手: {rsp.code}")
+            self._digests.forget(task.id)
             rsp.success = False
-            rsp.code = FileChunkUploadRetCode.INTERNAL_ERROR
             return rsp
 
+        rsp.success = True
+        if rsp.code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED:
+            # 上传完成，移动文件到存储目录
+            try:
+                await self._finish_task(task)
+            except Exception as e:
+                # 所有分片都已经收到，没有请求会再次完成这个任务，
+                # 直接标记为失败，客户端需要重新创建任务上传
+                logger.error(f"完成文件上传任务{task.id}失败: {e}")
+                await self._fail_task(task)
+                rsp.success = False
+                rsp.code = (
+                    FileChunkUploadRetCode.DIGEST_MISMATCH
+                    if isinstance(e, FileDigestMismatch)
+                    else FileChunkUploadRetCode.INTERNAL_ERROR
+                )
+            return rsp
+
+        # 当前分片上传成功，等待上传下个分片
+        task.status = FileUploadTaskStatus.WAITING_NEXT_CHUNK
+        await self.notify_progress(task)
         return rsp
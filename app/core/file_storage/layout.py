@@ -0,0 +1,14 @@
+from pathlib import Path
+
+
+def shard_path(root: Path, file_id: str) -> Path:
+    """
+    按id的十六进制前缀分两级目录：root/ab/cd/<id>，
+    每级最多256个子目录，单个目录里的文件数保持在较小的规模
+    """
+    return root / file_id[:2] / file_id[2:4] / file_id
+
+
+def paths_key(bucket_name: str) -> str:
+    # 文件名 -> 物理路径（相对于bucket目录）
+    return f"file_upload_paths:{bucket_name}"
@@ -0,0 +1,149 @@
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+from enum import Enum
+from time import perf_counter
+
+
+class UploadStage(str, Enum):
+    # multipart请求体解析（请求到达到进入处理函数）
+    PARSE = "parse"
+    # 占用分片、加载任务状态
+    STATE_LOAD = "state_load"
+    # 写入分片数据（包括读取请求体、解压、校验，不包括其间推送进度的时间）
+    DISK_WRITE = "disk_write"
+    # 提交分片、更新任务状态
+    STATE_STORE = "state_store"
+    # 推送进度
+    PUBLISH = "publish"
+    # 计算摘要、移动到存储目录
+    FINALIZE = "finalize"
+
+
+# 直方图的桶（秒）
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # 最后一个是+Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float | None:
+        """
+        按桶估计分位数，返回所在桶的上界；
+        落在+Inf桶时返回最大的有限上界（实际值不小于它），和Prometheus的histogram_quantile一致
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class _Timer:
+    """
+    嵌套的阶段只计入最内层，例如写入分片期间推送进度的时间只计入PUBLISH
+    """
+
+    __slots__ = ("_histogram", "_start", "_nested", "_parent", "_token")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+        self._nested = 0.0
+
+    def __enter__(self):
+        self._parent = _current_timer.get()
+        self._token = _current_timer.set(self)
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = perf_counter() - self._start
+        _current_timer.reset(self._token)
+        if self._parent is not None:
+            self._parent._nested += elapsed
+        self._histogram.observe(elapsed - self._nested)
+
+
+# 当前协程里正在计时的阶段
+_current_timer: ContextVar[_Timer | None] = ContextVar("_current_timer", default=None)
+
+
+_NOOP = nullcontext()
+
+
+class StageTimings:
+    """
+    上传分片各阶段的耗时直方图（进程内）
+
+    关闭时stage()返回共享的空上下文管理器，只有一次属性判断的开销
+    """
+
+    def __init__(self, enabled: bool = False, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self._histograms = {stage: Histogram(buckets) for stage in UploadStage}
+
+    def stage(self, stage: UploadStage):
+        """
+        记录with块的耗时
+        """
+        if not self.enabled:
+            return _NOOP
+        return _Timer(self._histograms[stage])
+
+    def observe(self, stage: UploadStage, seconds: float):
+        if self.enabled:
+            self._histograms[stage].observe(seconds)
+
+    def reset(self):
+        for stage in UploadStage:
+            self._histograms[stage] = Histogram(self._histograms[stage].buckets)
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        各阶段的次数、总耗时、p50/p99（秒）
+        """
+        return {
+            stage.value: {
+                "count": h.count,
+                "sum": h.sum,
+                "p50": h.quantile(0.5),
+                "p99": h.quantile(0.99),
+            }
+            for stage, h in self._histograms.items()
+        }
+
+    def render_prometheus(self, name: str = "file_upload_stage_seconds") -> str:
+        """
+        Prometheus文本格式
+        """
+        lines = [
+            f"# HELP {name} Upload chunk pipeline stage latency in seconds.",
+            f"# TYPE {name} histogram",
+        ]
+        for stage, h in self._histograms.items():
+            cumulative = 0
+            for bound, n in zip(h.buckets, h.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{stage="{stage.value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage.value}",le="+Inf"}} {h.count}')
+            lines.append(f'{name}_sum{{stage="{stage.value}"}} {h.sum}')
+            lines.append(f'{name}_count{{stage="{stage.value}"}} {h.count}')
+        return "\n".join(lines) + "\n"
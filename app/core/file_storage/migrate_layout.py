@@ -0,0 +1,130 @@
+"""
+把平铺的bucket目录迁移到按哈希前缀分片的目录结构（离线执行）
+
+    python -m app.core.file_storage.migrate_layout --bucket test [--dry-run]
+
+storge_dir/<bucket>/<file_name> 会被移动到 storge_dir/<bucket>/ab/cd/<id>，
+id是文件名的sha1，同时在redis中记录文件名到物理路径的对应关系。
+先写映射再移动文件，文件经过暂存目录 storge_dir/<bucket>/.migrate 中转，
+中途退出后重新执行即可继续。
+迁移期间需要停止API服务，temp_dir中未完成的上传不会迁移，需要重新创建任务
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+from redis.asyncio import Redis
+
+from app.core.deps import DepsContainer
+from app.core.file_storage.layout import paths_key, shard_path
+
+logging.basicConfig(level=logging.INFO)
+
+logger = logging.getLogger(__name__)
+
+
+# 迁移中的文件先按id放到这个隐藏目录，所有平铺的文件都移走之后再放到分片目录
+STAGING_DIR = ".migrate"
+
+
+def _file_id(file_name: str) -> str:
+    return hashlib.sha1(file_name.encode()).hexdigest()
+
+
+def _flat_files(bucket_dir: Path) -> list[str]:
+    # 只迁移bucket目录下直接存放的普通文件，分片目录和隐藏的临时文件跳过
+    with os.scandir(bucket_dir) as it:
+        return [
+            entry.name
+            for entry in it
+            if entry.is_file(follow_symlinks=False) and not entry.name.startswith(".")
+        ]
+
+
+def _unstage(bucket_dir: Path):
+    """
+    把暂存目录里的文件移动到分片目录；
+    这时bucket目录下已经没有平铺的文件，分片目录不会和文件重名（例如名为ab的文件）
+    """
+    staging = bucket_dir / STAGING_DIR
+    if not staging.is_dir():
+        return
+    with os.scandir(staging) as it:
+        file_ids = [entry.name for entry in it]
+    for file_id in file_ids:
+        target = shard_path(bucket_dir, file_id)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(staging / file_id, target)
+    staging.rmdir()
+
+
+async def migrate_bucket(
+    redis: Redis, storge_dir: Path, bucket_name: str, batch_size: int = 1000, dry_run: bool = False
+) -> int:
+    """
+    迁移一个bucket，返回本次迁移的平铺文件数
+
+    每批先写映射，再把文件移到暂存目录，最后统一移动到分片目录；
+    中途退出后重新执行，剩下的平铺文件和暂存目录里的文件都会继续迁移
+    """
+    bucket_dir = storge_dir / bucket_name
+    if not bucket_dir.is_dir():
+        logger.error(f"bucket目录不存在: {bucket_dir}")
+        return 0
+    file_names = await asyncio.to_thread(_flat_files, bucket_dir)
+    staging = bucket_dir / STAGING_DIR
+    migrated = 0
+    for i in range(0, len(file_names), batch_size):
+        batch = file_names[i : i + batch_size]
+        file_ids = {name: _file_id(name) for name in batch}
+        if dry_run:
+            for name, file_id in file_ids.items():
+                logger.info(f"{bucket_dir / name} -> {shard_path(bucket_dir, file_id)}")
+            migrated += len(batch)
+            continue
+        await redis.hset(
+            paths_key(bucket_name),
+            mapping={
+                name: str(shard_path(bucket_dir, file_id).relative_to(bucket_dir))
+                for name, file_id in file_ids.items()
+            },
+        )
+
+        def _stage():
+            staging.mkdir(exist_ok=True)
+            for name, file_id in file_ids.items():
+                os.rename(bucket_dir / name, staging / file_id)
+
+        await asyncio.to_thread(_stage)
+        migrated += len(batch)
+        logger.info(f"{bucket_name}: 已迁移 {migrated}/{len(file_names)}")
+    if not dry_run:
+        await asyncio.to_thread(_unstage, bucket_dir)
+    return migrated
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bucket", action="append", required=True)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    deps = DepsContainer()
+    settings = deps.file_upload_settings()
+    redis = await deps.redis()
+    try:
+        for bucket_name in args.bucket:
+            await migrate_bucket(
+                redis, settings.storge_dir, bucket_name, args.batch_size, args.dry_run
+            )
+    finally:
+        await deps.shutdown_resources()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
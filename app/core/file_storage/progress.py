@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from time import monotonic
+from uuid import UUID
+
+
+class ProgressThrottle:
+    """
+    文件上传进度推送节流
+
+    距离上次推送超过interval_ms，或者进度前进超过step_percent时才推送，
+    完成、失败等需要强制推送的场景传force=True
+    """
+
+    def __init__(
+        self,
+        interval_ms: int = 500,
+        step_percent: float = 1.0,
+        max_tasks: int = 10000,
+    ):
+        self._interval = interval_ms / 1000
+        self._step_percent = step_percent
+        self._max_tasks = max_tasks
+        # task_id -> (上次推送时间, 上次推送时的uploaded_bytes)
+        self._last: OrderedDict[UUID, tuple[float, int]] = OrderedDict()
+
+    def should_emit(
+        self, task_id: UUID, uploaded_bytes: int, file_size: int, force: bool = False
+    ) -> bool:
+        """
+        判断本次进度是否需要推送，需要推送时记录推送时间和进度
+        """
+        now = monotonic()
+        last = self._last.get(task_id)
+        if not force and last is not None:
+            last_time, last_bytes = last
+            if (
+                now - last_time < self._interval
+                and (uploaded_bytes - last_bytes) * 100 < self._step_percent * file_size
+            ):
+                return False
+        self._last[task_id] = (now, uploaded_bytes)
+        self._last.move_to_end(task_id)
+        if len(self._last) > self._max_tasks:
+            # 长时间没有进度的任务（例如客户端放弃上传）被淘汰
+            self._last.popitem(last=False)
+        return True
+
+    def forget(self, task_id: UUID):
+        """
+        任务结束后清理节流状态
+        """
+        self._last.pop(task_id, None)
@@ -0,0 +1,163 @@
+"""
+上传进度的WebSocket通道，给高频率的内部客户端使用，比SSE的完整JSON文档小得多
+
+客户端 -> 服务端（文本JSON）：
+    {"op": "watch", "task_ids": [...]}      关注任务
+    {"op": "unwatch", "task_ids": [...]}    取消关注
+
+服务端 -> 客户端：
+    文本JSON {"type": "snapshot", "statuses": [...], "tasks": [{"index": 0, "id": ..., "found": true, "task": {...}}]}
+        每次关注新任务时发送一次这些任务的完整状态，index是之后增量记录里的任务编号，
+        statuses是增量记录里status编号对应的状态
+    二进制 若干条13字节的增量记录（小端）：index(uint32) uploaded_bytes(uint64) status(uint8)
+        同一个间隔内每个任务只发送最新的状态
+    文本JSON {"type": "error", "detail": "..."}
+        命令无效或者关注的任务数超过max_tasks时发送，连接继续可用
+"""
+
+import asyncio
+import json
+import struct
+from typing import Awaitable, Callable
+from uuid import UUID
+
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, ValidationError
+
+from app.core.file_storage.schemas import FileUploadTaskQueryResult, FileUploadTaskStatus
+from app.core.pubsub import PubSubBackend, Subscription
+
+DELTA = struct.Struct("<IQB")
+
+_STATUSES = list(FileUploadTaskStatus)
+_STATUS_CODES = {status: code for code, status in enumerate(_STATUSES)}
+
+
+class _Command(BaseModel):
+    op: str
+    task_ids: list[UUID] = []
+
+
+def pack_delta(index: int, message: str) -> bytes:
+    progress = json.loads(message)
+    return DELTA.pack(
+        index,
+        progress["uploaded_bytes"],
+        _STATUS_CODES[FileUploadTaskStatus(progress["status"])],
+    )
+
+
+class ProgressSocket:
+    """
+    一个WebSocket连接上的进度推送，连接期间可以随时增加或者取消关注的任务
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        backend: PubSubBackend,
+        query_tasks: Callable[[list[UUID]], Awaitable[list[FileUploadTaskQueryResult]]],
+        channel: Callable[[UUID], str],
+        batch_interval: float = 0.2,
+        max_tasks: int = 1000,
+    ):
+        self._ws = websocket
+        self._backend = backend
+        self._query_tasks = query_tasks
+        self._channel = channel
+        self._batch_interval = batch_interval
+        # 一个连接最多同时关注的任务数
+        self._max_tasks = max_tasks
+        # 频道 -> 任务编号，编号不复用
+        self._indexes: dict[str, int] = {}
+        self._next_index = 0
+        # 新任务的完整状态发出之前不能发送它的增量
+        self._send_lock = asyncio.Lock()
+        self._subscription: Subscription | None = None
+
+    async def serve(self):
+        await self._ws.accept()
+        # 每个任务只发送最新的状态，按频道合并消息，关注的任务再多也不会丢掉最终状态
+        self._subscription = await self._backend.subscribe(coalesce=True)
+        sender = asyncio.create_task(self._send_deltas())
+        try:
+            while True:
+                message = await self._ws.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                await self._handle(message.get("text") or message.get("bytes") or b"")
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sender.cancel()
+            self._subscription.close()
+
+    async def _handle(self, data: str | bytes):
+        try:
+            command = _Command.model_validate_json(data)
+        except ValidationError as e:
+            # 不是JSON对象、缺少op或者任务id无效，回复错误后继续处理之后的命令
+            detail = f"无效的命令: {e.errors()[0]['msg']}"
+            await self._ws.send_json({"type": "error", "detail": detail})
+            return
+        op, task_ids = command.op, command.task_ids
+        if op == "watch":
+            await self._watch(task_ids)
+        elif op == "unwatch":
+            channels = [self._channel(task_id) for task_id in task_ids]
+            self._subscription.remove(*channels)
+            for channel in channels:
+                self._indexes.pop(channel, None)
+        else:
+            await self._ws.send_json({"type": "error", "detail": f"未知的操作: {op}"})
+
+    async def _watch(self, task_ids: list[UUID]):
+        task_ids = [
+            task_id
+            for task_id in dict.fromkeys(task_ids)
+            if self._channel(task_id) not in self._indexes
+        ]
+        if not task_ids:
+            return
+        if len(self._indexes) + len(task_ids) > self._max_tasks:
+            await self._ws.send_json(
+                {"type": "error", "detail": f"关注的任务数超过限制: {self._max_tasks}"}
+            )
+            return
+        async with self._send_lock:
+            indexes = []
+            for task_id in task_ids:
+                self._indexes[self._channel(task_id)] = self._next_index
+                indexes.append(self._next_index)
+                self._next_index += 1
+            # 先订阅再查询，避免两者之间的进度丢失
+            await self._subscription.add(*[self._channel(task_id) for task_id in task_ids])
+            results = await self._query_tasks(task_ids)
+            await self._ws.send_json(
+                {
+                    "type": "snapshot",
+                    "statuses": [status.value for status in _STATUSES],
+                    "tasks": [
+                        {"index": index, **result.model_dump(mode="json")}
+                        for index, result in zip(indexes, results)
+                    ],
+                }
+            )
+
+    async def _send_deltas(self):
+        while True:
+            events = [await self._subscription.get()]
+            if self._batch_interval > 0:
+                await asyncio.sleep(self._batch_interval)
+            events += self._subscription.drain()
+            # 每个任务只保留最新的状态，已经取消关注的任务跳过
+            latest: dict[int, str] = {}
+            for channel, _, message in events:
+                index = self._indexes.get(channel)
+                if index is not None:
+                    latest[index] = message
+            if not latest:
+                continue
+            frame = b"".join(pack_delta(index, message) for index, message in latest.items())
+            async with self._send_lock:
+                await self._ws.send_bytes(frame)
@@ -6,12 +6,26 @@ from uuid import UUID, uuid4
 from pathlib import Path
 
 
+class FileUploadMode(str, Enum):
+    # 顺序上传：一次只能上传nxt_chunk_idx指向的分片
+    SEQUENTIAL = "sequential"
+    # 并行上传：分片可以并发、乱序上传，用位图记录已收到的分片
+    PARALLEL = "parallel"
+
+
 class FileUploadTaskBase(BaseModel):
     file_name: str
     file_size: int = Field(gt=0)
+    mode: FileUploadMode = Field(default=FileUploadMode.SEQUENTIAL)
+    # 文件内容摘要（默认sha256的十六进制），创建任务时提供可以秒传已经存在的文件
+    digest: str | None = Field(default=None, pattern=r"^[0-9a-f]+$")
+    # 整个文件的CRC（"crc32:<hex>"或"crc32c:<hex>"），完成时由分片的CRC合并校验，不需要重新读取文件
+    checksum: str | None = Field(default=None, pattern=r"^crc32c?:[0-9a-f]{8}$")
 
 
-class FileUploadTaskCreate(FileUploadTaskBase): ...
+class FileUploadTaskCreate(FileUploadTaskBase):
+    # 客户端期望的分片大小，服务端会限制在配置的范围内
+    chunk_size_hint: int | None = Field(default=None, gt=0)
 
 
 class FileUploadTaskStatus(str, Enum):
@@ -31,6 +45,13 @@ class FileUploadTaskPublic(FileUploadTaskBase):
     start_time: float = Field(default_factory=time)
     end_time: float | None = Field(default=None)
     nxt_chunk_idx: int = Field(default=0, ge=0)
+    received_chunks: int = Field(default=0, ge=0)
+
+
+class FileUploadTaskQueryResult(BaseModel):
+    id: UUID
+    found: bool = Field(default=False)
+    task: FileUploadTaskPublic | None = Field(default=None)
 
 
 class FileUploadTaskPrivate(FileUploadTaskPublic):
@@ -38,10 +59,29 @@ class FileUploadTaskPrivate(FileUploadTaskPublic):
     storge_dir: Path
 
 
+CHUNK_CHECKSUM_PATTERN = r"^(crc32|crc32c|xxh64|xxh3_64):[0-9a-f]+$"
+
+
+class FileChunkEncoding(str, Enum):
+    IDENTITY = "identity"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+
 class FileChunkUploadRequest(BaseModel):
     id: UUID
     chunk: UploadFile = File(...)
     chunk_idx: int = Field(default=0, ge=0)
+    # 分片数据的压缩方式，不传时使用分片自身的Content-Encoding头
+    content_encoding: FileChunkEncoding | None = Field(default=None)
+    # 分片（解压后）数据的校验和，"算法:十六进制值"，例如"crc32c:1a2b3c4d"
+    checksum: str | None = Field(default=None, pattern=CHUNK_CHECKSUM_PATTERN)
+
+
+class FileUploadRequest(BaseModel):
+    file_name: str
+    digest: str | None = Field(default=None, pattern=r"^[0-9a-f]+$")
+    file: UploadFile = File(...)
 
 
 class FileUploadProgress(FileUploadTaskPublic):
@@ -55,9 +95,15 @@ class FileChunkUploadRetCode(str, Enum):
     WAITING_NEXT_CHUNK = "waiting_next_chunk"
     CHUNK_UPLOADING = "chunk_uploading"
     CHUNK_IDX_WRONG = "chunk_idx_wrong"
+    CHUNK_ALREADY_UPLOADED = "chunk_already_uploaded"
+    CHUNK_SIZE_WRONG = "chunk_size_wrong"
+    CHUNK_DECODE_FAILED = "chunk_decode_failed"
+    CHUNK_CHECKSUM_MISMATCH = "chunk_checksum_mismatch"
+    DIGEST_MISMATCH = "digest_mismatch"
     ALL_CHUNKS_UPLOADED = "all_chunks_uploaded"
     TASK_NOT_EXIST = "task_not_exist"
     TASK_ALREADY_FINISHED = "task_already_finished"
+    TASK_FAILED = "task_failed"
     INTERNAL_ERROR = "internal_error"
 
 
@@ -65,5 +111,6 @@ class FileChunkUploadResponse(BaseModel):
     id: UUID
     chunk_idx: int = Field(default=0, ge=0)
     nxt_chunk_idx: int = Field(default=0, ge=0)
+    received_chunks: int = Field(default=0, ge=0)
     success: bool = Field(default=False)
     code: FileChunkUploadRetCode = Field(default=FileChunkUploadRetCode.INTERNAL_ERROR)
@@ -0,0 +1,331 @@
+from time import time
+from uuid import UUID
+
+from redis.asyncio import Redis
+
+from app.core.file_storage.schemas import (
+    FileChunkUploadRetCode,
+    FileUploadTaskPrivate,
+    FileUploadTaskStatus,
+)
+
+# 任务状态保存在redis hash中，状态和分片索引的迁移都在lua脚本里完成，
+# 每次迁移只需要一次往返，多个API进程同时处理同一个任务时也不会互相覆盖。
+# 脚本里的状态字符串和FileUploadTaskStatus、FileChunkUploadRetCode的取值一一对应
+
+# 占用一个分片
+# 顺序上传只能占用nxt_chunk_idx指向的分片，同时只能有一个分片在上传，
+# 占用超过claim_timeout的分片视为上传进程已经退出，可以被重新占用；
+# 并行上传可以占用任意一个还没收到的分片，正在上传的分片记录在位图中，
+# 占用时间记录在任务的claim:<分片索引>字段，同样超过claim_timeout后可以被重新占用。
+# 每次占用记录请求的token（顺序上传claim_token，并行上传claim_token:<分片索引>），
+# 提交和释放时比较token，占用超时被接手之后原来的请求不能再提交或者释放
+# KEYS: task, chunks_received, chunks_uploading
+# ARGV: chunk_idx, now, claim_timeout, token
+_CLAIM_CHUNK = """
+local task = redis.call('HGETALL', KEYS[1])
+if #task == 0 then
+    return {'task_not_exist'}
+end
+local mode, status, nxt, total, claimed_at = unpack(redis.call(
+    'HMGET', KEYS[1], 'mode', 'status', 'nxt_chunk_idx', 'total_chunks', 'claimed_at'))
+local chunk_idx = tonumber(ARGV[1])
+if mode == 'parallel' then
+    if status == 'finished' then
+        return {'task_already_finished', task}
+    end
+    if status == 'failed' then
+        return {'task_failed', task}
+    end
+    if chunk_idx >= tonumber(total) then
+        return {'chunk_idx_wrong', task}
+    end
+    if redis.call('GETBIT', KEYS[2], chunk_idx) == 1 then
+        return {'chunk_already_uploaded', task}
+    end
+    local claim = 'claim:' .. chunk_idx
+    if redis.call('SETBIT', KEYS[3], chunk_idx, 1) == 1
+            and tonumber(ARGV[2]) - tonumber(redis.call('HGET', KEYS[1], claim) or 0)
+                < tonumber(ARGV[3]) then
+        return {'chunk_uploading', task}
+    end
+    redis.call('HSET', KEYS[1], 'status', 'uploading_one_chunk', claim, ARGV[2],
+        'claim_token:' .. chunk_idx, ARGV[4])
+    return {'ok', task}
+end
+if status == 'finished' then
+    return {'task_already_finished', task}
+end
+if status == 'failed' then
+    return {'task_failed', task}
+end
+if chunk_idx ~= tonumber(nxt) then
+    return {'chunk_idx_wrong', task}
+end
+if status == 'uploading_one_chunk'
+        and tonumber(ARGV[2]) - tonumber(claimed_at or 0) < tonumber(ARGV[3]) then
+    return {'chunk_uploading', task}
+end
+redis.call('HSET', KEYS[1], 'status', 'uploading_one_chunk', 'claimed_at', ARGV[2],
+    'claim_token', ARGV[4])
+return {'ok', task}
+"""
+
+# 分片写入成功，累加uploaded_bytes并推进分片索引，
+# 返回all_chunks_uploaded时由调用方完成任务：
+# 顺序上传由最后一个分片完成，并行上传由置上最后一位的请求完成；
+# 占用已经被其它请求接手时不做任何修改，分片已经收到时返回chunk_already_uploaded，否则返回chunk_uploading
+# KEYS: task, chunks_received, chunks_uploading, chunk_checksums
+# ARGV: chunk_idx, chunk_bytes, chunk_checksum, token
+_COMPLETE_CHUNK = """
+local mode, total = unpack(redis.call('HMGET', KEYS[1], 'mode', 'total_chunks'))
+total = tonumber(total)
+local chunk_idx = tonumber(ARGV[1])
+local token_field = mode == 'parallel' and 'claim_token:' .. chunk_idx or 'claim_token'
+if redis.call('HGET', KEYS[1], token_field) ~= ARGV[4] then
+    local uploaded_bytes, received_chunks, nxt = unpack(redis.call(
+        'HMGET', KEYS[1], 'uploaded_bytes', 'received_chunks', 'nxt_chunk_idx'))
+    local received
+    if mode == 'parallel' then
+        received = redis.call('GETBIT', KEYS[2], chunk_idx) == 1
+    else
+        received = chunk_idx < tonumber(nxt)
+    end
+    return {received and 'chunk_already_uploaded' or 'chunk_uploading',
+        uploaded_bytes, received_chunks, nxt}
+end
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[4], ARGV[1], ARGV[3])
+end
+if mode ~= 'parallel' then
+    local nxt = chunk_idx + 1
+    local uploaded_bytes = redis.call('HINCRBY', KEYS[1], 'uploaded_bytes', ARGV[2])
+    redis.call('HSET', KEYS[1], 'nxt_chunk_idx', nxt, 'received_chunks', nxt)
+    if nxt == total then
+        return {'all_chunks_uploaded', uploaded_bytes, nxt, nxt}
+    end
+    redis.call('HSET', KEYS[1], 'status', 'waiting_next_chunk')
+    redis.call('HDEL', KEYS[1], 'claimed_at', 'claim_token')
+    return {'waiting_next_chunk', uploaded_bytes, nxt, nxt}
+end
+redis.call('SETBIT', KEYS[3], chunk_idx, 0)
+redis.call('HDEL', KEYS[1], 'claim:' .. chunk_idx, token_field)
+local received = redis.call('SETBIT', KEYS[2], chunk_idx, 1)
+if received == 0 then
+    redis.call('HINCRBY', KEYS[1], 'uploaded_bytes', ARGV[2])
+    redis.call('HINCRBY', KEYS[1], 'received_chunks', 1)
+end
+local uploaded_bytes, received_chunks = unpack(
+    redis.call('HMGET', KEYS[1], 'uploaded_bytes', 'received_chunks'))
+-- 位图按字节补齐，bitpos可能返回超出分片数的位置
+local nxt = math.min(redis.call('BITPOS', KEYS[2], 0), total)
+redis.call('HSET', KEYS[1], 'nxt_chunk_idx', nxt)
+if received == 0 and tonumber(received_chunks) == total then
+    return {'all_chunks_uploaded', uploaded_bytes, received_chunks, nxt}
+end
+if redis.call('BITCOUNT', KEYS[3]) == 0 then
+    redis.call('HSET', KEYS[1], 'status', 'waiting_next_chunk')
+end
+return {'waiting_next_chunk', uploaded_bytes, received_chunks, nxt}
+"""
+
+# 分片写入失败，释放占用，客户端可以重新上传该分片；占用已经被其它请求接手时不释放
+# KEYS: task, chunks_received, chunks_uploading
+# ARGV: chunk_idx, token
+_RELEASE_CHUNK = """
+local mode, status, nxt = unpack(
+    redis.call('HMGET', KEYS[1], 'mode', 'status', 'nxt_chunk_idx'))
+if mode == 'parallel' then
+    local token_field = 'claim_token:' .. ARGV[1]
+    if redis.call('HGET', KEYS[1], token_field) == ARGV[2] then
+        redis.call('SETBIT', KEYS[3], ARGV[1], 0)
+        redis.call('HDEL', KEYS[1], 'claim:' .. ARGV[1], token_field)
+    end
+elseif status == 'uploading_one_chunk' and tonumber(nxt) == tonumber(ARGV[1])
+        and redis.call('HGET', KEYS[1], 'claim_token') == ARGV[2] then
+    redis.call('HSET', KEYS[1], 'status', 'waiting_next_chunk')
+    redis.call('HDEL', KEYS[1], 'claimed_at', 'claim_token')
+end
+return 0
+"""
+
+# 任务结束（完成或者失败），设置结束时间、文件摘要，并过期任务相关的key
+# KEYS: task, chunks_received, chunks_uploading, chunk_checksums
+# ARGV: status, end_time, expire_seconds, digest
+_END_TASK = """
+redis.call('HSET', KEYS[1], 'status', ARGV[1], 'end_time', ARGV[2])
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[1], 'digest', ARGV[4])
+end
+redis.call('HDEL', KEYS[1], 'claimed_at', 'claim_token')
+for _, key in ipairs(KEYS) do
+    redis.call('EXPIRE', key, ARGV[3])
+end
+return 0
+"""
+
+
+def _pairs_to_dict(pairs: list) -> dict:
+    return dict(zip(pairs[::2], pairs[1::2]))
+
+
+class FileUploadTaskStore:
+    """
+    文件上传任务状态存储，任务保存在redis hash中
+    """
+
+    def __init__(
+        self, redis: Redis, claim_timeout: int = 5 * 60, expire_seconds: int = 5 * 60
+    ):
+        self._redis = redis
+        self._claim_timeout = claim_timeout
+        self._expire_seconds = expire_seconds
+        self._claim_chunk = redis.register_script(_CLAIM_CHUNK)
+        self._complete_chunk = redis.register_script(_COMPLETE_CHUNK)
+        self._release_chunk = redis.register_script(_RELEASE_CHUNK)
+        self._end_task = redis.register_script(_END_TASK)
+
+    def _task_key(self, task_id: UUID) -> str:
+        return f"file_upload_task:{task_id}"
+
+    def _chunks_received_key(self, task_id: UUID) -> str:
+        return f"file_upload_chunks_received:{task_id}"
+
+    def _chunks_uploading_key(self, task_id: UUID) -> str:
+        return f"file_upload_chunks_uploading:{task_id}"
+
+    def _chunk_checksums_key(self, task_id: UUID) -> str:
+        return f"file_upload_chunk_checksums:{task_id}"
+
+    def _task_keys(self, task_id: UUID) -> list[str]:
+        return [
+            self._task_key(task_id),
+            self._chunks_received_key(task_id),
+            self._chunks_uploading_key(task_id),
+            self._chunk_checksums_key(task_id),
+        ]
+
+    @staticmethod
+    def _encode(task: FileUploadTaskPrivate) -> dict[str, str | int | float]:
+        return {
+            k: int(v) if isinstance(v, bool) else v
+            for k, v in task.model_dump(mode="json", exclude_none=True).items()
+        }
+
+    @staticmethod
+    def _decode(data: dict) -> FileUploadTaskPrivate:
+        return FileUploadTaskPrivate.model_validate(data)
+
+    async def store(self, task: FileUploadTaskPrivate):
+        """
+        存储整个任务，只在创建任务时使用，之后的修改都通过状态迁移完成
+        """
+        await self._redis.hset(self._task_key(task.id), mapping=self._encode(task))
+
+    async def store_many(
+        self, tasks: list[FileUploadTaskPrivate], expire: list[UUID] | None = None
+    ):
+        """
+        批量存储任务，expire里的任务（例如秒传直接完成的任务）同时设置过期，一次往返
+        """
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for task in tasks:
+                pipe.hset(self._task_key(task.id), mapping=self._encode(task))
+            for task_id in expire or []:
+                pipe.expire(self._task_key(task_id), self._expire_seconds)
+            await pipe.execute()
+
+    async def get(self, task_id: UUID) -> FileUploadTaskPrivate | None:
+        data = await self._redis.hgetall(self._task_key(task_id))
+        if not data:
+            return None
+        return self._decode(data)
+
+    async def get_many(self, task_ids: list[UUID]) -> list[FileUploadTaskPrivate | None]:
+        """
+        批量获取任务，结果和task_ids一一对应，一次往返
+        """
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hgetall(self._task_key(task_id))
+            results = await pipe.execute()
+        return [self._decode(data) if data else None for data in results]
+
+    async def expire(self, task_id: UUID):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key in self._task_keys(task_id):
+                pipe.expire(key, self._expire_seconds)
+            await pipe.execute()
+
+    async def claim_chunk(
+        self, task_id: UUID, chunk_idx: int, token: str
+    ) -> tuple[FileChunkUploadRetCode | None, FileUploadTaskPrivate | None]:
+        """
+        用token占用一个分片，返回(错误码, 占用前的任务)，占用成功时错误码为None，
+        任务不存在时任务为None；之后用同一个token提交或者释放
+        """
+        code, *rest = await self._claim_chunk(
+            keys=self._task_keys(task_id),
+            args=[chunk_idx, time(), self._claim_timeout, token],
+        )
+        task = self._decode(_pairs_to_dict(rest[0])) if rest else None
+        if code == "ok":
+            return None, task
+        return FileChunkUploadRetCode(code), task
+
+    async def release_chunk(self, task_id: UUID, chunk_idx: int, token: str):
+        """
+        分片写入失败，释放token的占用
+        """
+        await self._release_chunk(keys=self._task_keys(task_id), args=[chunk_idx, token])
+
+    async def complete_chunk(
+        self,
+        task: FileUploadTaskPrivate,
+        chunk_idx: int,
+        chunk_bytes: int,
+        token: str,
+        checksum: str | None = None,
+    ) -> FileChunkUploadRetCode:
+        """
+        分片写入成功，用最新的uploaded_bytes、received_chunks、nxt_chunk_idx更新task，
+        同时记录分片的校验和，返回ALL_CHUNKS_UPLOADED时由调用方完成任务；
+        token的占用已经超时被其它请求接手时不提交，返回CHUNK_UPLOADING或者CHUNK_ALREADY_UPLOADED
+        """
+        code, uploaded_bytes, received_chunks, nxt_chunk_idx = (
+            await self._complete_chunk(
+                keys=self._task_keys(task.id),
+                args=[chunk_idx, chunk_bytes, checksum or "", token],
+            )
+        )
+        task.uploaded_bytes = int(uploaded_bytes)
+        task.received_chunks = int(received_chunks)
+        task.nxt_chunk_idx = int(nxt_chunk_idx)
+        return FileChunkUploadRetCode(code)
+
+    async def chunk_checksums(self, task: FileUploadTaskPrivate) -> list[str | None]:
+        """
+        按分片顺序返回每个分片的校验和，没有校验和的分片为None
+        """
+        checksums = await self._redis.hgetall(self._chunk_checksums_key(task.id))
+        return [checksums.get(str(idx)) for idx in range(task.total_chunks)]
+
+    async def _end(self, task: FileUploadTaskPrivate, status: FileUploadTaskStatus):
+        task.end_time = time()
+        task.status = status
+        await self._end_task(
+            keys=self._task_keys(task.id),
+            args=[status.value, task.end_time, self._expire_seconds, task.digest or ""],
+        )
+
+    async def finish(self, task: FileUploadTaskPrivate):
+        """
+        任务完成，设置结束时间并过期任务相关的key
+        """
+        await self._end(task, FileUploadTaskStatus.FINISHED)
+
+    async def fail(self, task: FileUploadTaskPrivate):
+        """
+        任务失败，客户端需要重新创建任务
+        """
+        await self._end(task, FileUploadTaskStatus.FAILED)
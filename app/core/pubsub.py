@@ -0,0 +1,495 @@
+import asyncio
+import re
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from enum import Enum
+from time import time
+
+from redis.asyncio import Redis
+from redis.asyncio.client import PubSub
+import logging
+
+logger = logging.getLogger(__name__)
+
+# stream模式：XADD追加消息并按MAXLEN（近似）裁剪，刷新过期时间，再把"事件id 消息"发布到频道
+# 多个频道的消息一次执行，返回每条消息的事件id
+# KEYS: 每个频道的stream
+# ARGV: maxlen, ttl（0不过期）, 之后每个频道依次是channel, message
+_PUBLISH_STREAM = """
+local maxlen = ARGV[1]
+local ttl = tonumber(ARGV[2])
+local ids = {}
+for i, key in ipairs(KEYS) do
+    local channel = ARGV[1 + i * 2]
+    local message = ARGV[2 + i * 2]
+    local id = redis.call('XADD', key, 'MAXLEN', '~', maxlen, '*', 'data', message)
+    if ttl > 0 then
+        redis.call('EXPIRE', key, ttl)
+    end
+    redis.call('PUBLISH', channel, id .. ' ' .. message)
+    ids[i] = id
+end
+return ids
+"""
+
+_STREAM_ID = re.compile(r"^(\d+)-(\d+)$")
+
+
+class PubSubMode(str, Enum):
+    # 只保留每个频道的最后一条消息，断线期间的消息会丢失
+    PUBSUB = "pubsub"
+    # 保存每个频道最近的消息，每个事件带id，断线重连后按Last-Event-ID补发
+    STREAM = "stream"
+
+
+def stream_id(event_id: str) -> tuple[int, int]:
+    """
+    "毫秒-序号"格式的事件id，转换成可以比较大小的元组
+    """
+    ms, seq = event_id.split("-")
+    return int(ms), int(seq)
+
+
+# (频道, 事件id, 消息)，pubsub模式下事件id为None
+Event = tuple[str, str | None, str]
+
+
+class Subscription:
+    """
+    一个客户端的订阅，收到的消息放在有界队列里，队列满时丢弃最旧的消息
+
+    coalesce为True时每个频道只保留最新一条还没取出的消息，队列长度不超过频道数，不会丢弃消息
+    """
+
+    def __init__(
+        self, owner, channels: tuple[str, ...], maxsize: int, coalesce: bool = False
+    ):
+        self.channels = channels
+        self.dropped = 0
+        self._owner = owner
+        self._coalesce = coalesce
+        # 合并模式下队列里是频道，消息放在_latest里
+        self._queue: asyncio.Queue = asyncio.Queue(0 if coalesce else maxsize)
+        self._latest: dict[str, Event] = {}
+
+    def put(self, channel: str, event_id: str | None, message: str):
+        if self._coalesce:
+            if channel not in self._latest:
+                self._queue.put_nowait(channel)
+            self._latest[channel] = (channel, event_id, message)
+            return
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait((channel, event_id, message))
+
+    def _pop(self, item) -> Event:
+        return self._latest.pop(item) if self._coalesce else item
+
+    async def get(self) -> Event:
+        """
+        等待下一条消息，返回(频道, 事件id, 消息)
+        """
+        return self._pop(await self._queue.get())
+
+    def drain(self) -> list[Event]:
+        """
+        取出队列里已有的所有消息，不等待
+        """
+        events = []
+        while not self._queue.empty():
+            events.append(self._pop(self._queue.get_nowait()))
+        return events
+
+    async def add(self, *channels: str):
+        """
+        增加订阅的频道，返回后这些频道发布的消息都会进入队列
+        """
+        await self._owner.attach(self, channels)
+
+    def remove(self, *channels: str):
+        self._owner.detach(self, channels)
+
+    def close(self):
+        self._owner.detach(self, self.channels)
+
+
+class PubSubBackend(ABC):
+    """
+    进度消息的发布订阅后端
+    """
+
+    @property
+    @abstractmethod
+    def channels(self) -> int:
+        """
+        当前有订阅者的频道数
+        """
+
+    async def publish(self, channel: str, message: str) -> str | None:
+        """
+        发布消息，stream模式下返回事件id
+        """
+        return (await self.publish_many([(channel, message)]))[0]
+
+    @abstractmethod
+    async def publish_many(self, messages: list[tuple[str, str]]) -> list[str | None]:
+        """
+        一次发布多个频道的消息[(频道, 消息)]，返回每条消息的事件id
+        """
+
+    @abstractmethod
+    async def snapshot(
+        self, channels: tuple[str, ...], last_event_id: str | None = None
+    ) -> list[Event]:
+        """
+        新订阅者需要先收到的消息，按发布顺序排列
+
+        没有last_event_id时每个频道只取最后一条，stream模式下从last_event_id之后开始补发
+        """
+
+    @abstractmethod
+    async def subscribe(self, *channels: str, coalesce: bool = False) -> Subscription:
+        """
+        订阅频道，返回后发布的消息都会进入订阅队列
+
+        coalesce为True时每个频道只保留最新一条还没取出的消息
+        """
+
+    async def close(self):
+        pass
+
+
+class SubscriptionHub:
+    """
+    每个进程共用一个redis订阅连接，按频道的订阅者数量决定是否订阅，再把消息分发到各个订阅者的队列
+
+    同一轮事件循环中的订阅和取消订阅合并成一条SUBSCRIBE/UNSUBSCRIBE命令
+    """
+
+    def __init__(self, redis: Redis, queue_size: int = 256, with_event_id: bool = False):
+        self._redis = redis
+        self._queue_size = queue_size
+        # stream模式下发布的消息是"事件id 消息"
+        self._with_event_id = with_event_id
+        self._pubsub: PubSub | None = None
+        self._reader: asyncio.Task | None = None
+        # 频道 -> 订阅者，订阅者集合的大小就是频道的引用计数
+        self._subscribers: dict[str, set[Subscription]] = {}
+        # 等待发送的订阅变更：频道 -> True订阅/False取消订阅
+        self._pending: dict[str, bool] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def channels(self) -> int:
+        return len(self._subscribers)
+
+    async def subscribe(self, *channels: str, coalesce: bool = False) -> Subscription:
+        """
+        订阅频道，返回时SUBSCRIBE命令已经发出
+        """
+        sub = Subscription(self, (), self._queue_size, coalesce)
+        await self.attach(sub, channels)
+        return sub
+
+    async def attach(self, sub: Subscription, channels: tuple[str, ...]):
+        subscribed = set(sub.channels)
+        channels = tuple(c for c in dict.fromkeys(channels) if c not in subscribed)
+        sub.channels += channels
+        for channel in channels:
+            subscribers = self._subscribers.setdefault(channel, set())
+            if not subscribers:
+                self._pending[channel] = True
+            subscribers.add(sub)
+        if not channels:
+            return
+        try:
+            await asyncio.shield(self._schedule_flush())
+        except BaseException:
+            # 订阅失败或者等待时被取消，撤销这次增加的频道，不留下没有人读取的订阅者
+            self.detach(sub, channels)
+            raise
+
+    def detach(self, sub: Subscription, channels: tuple[str, ...]):
+        removed = set(channels)
+        sub.channels = tuple(c for c in sub.channels if c not in removed)
+        for channel in removed:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is None:
+                continue
+            subscribers.discard(sub)
+            if not subscribers:
+                del self._subscribers[channel]
+                self._pending[channel] = False
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> asyncio.Task:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+            # 只有取消订阅时没有人等待结果，异常已经记录在日志里
+            self._flush_task.add_done_callback(
+                lambda t: t.cancelled() or t.exception()
+            )
+        return self._flush_task
+
+    async def _flush(self):
+        # 让出一次事件循环，合并同一轮里的订阅变更
+        await asyncio.sleep(0)
+        # 保证多次变更按顺序发出；拿到锁之后再取变更，前一次失败后重新标记的变更也会发出
+        async with self._flush_lock:
+            self._flush_task = None
+            pending, self._pending = self._pending, {}
+            subscribe = [c for c, on in pending.items() if on]
+            unsubscribe = [c for c, on in pending.items() if not on]
+            if self._pubsub is None:
+                if not subscribe:
+                    return
+                self._pubsub = self._redis.pubsub()
+            try:
+                if unsubscribe:
+                    await self._pubsub.unsubscribe(*unsubscribe)
+                if subscribe:
+                    await self._pubsub.subscribe(*subscribe)
+            except Exception as e:
+                logger.error(f"更新订阅失败: {e}")
+                # 这次的变更没有生效，重新标记，之后的flush按当时是否还有订阅者重新订阅或者取消订阅；
+                # 等待这次flush的订阅者会收到异常并撤销自己的订阅
+                for channel in pending:
+                    self._pending.setdefault(channel, channel in self._subscribers)
+                raise
+            if self._reader is None:
+                self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        while True:
+            try:
+                msg = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=None
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 连接断开后redis-py会在重连时重新订阅所有频道
+                logger.error(f"读取订阅消息失败: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not msg or msg["type"] != "message":
+                continue
+            event_id, message = None, msg["data"]
+            if self._with_event_id:
+                event_id, _, message = message.partition(" ")
+            for sub in self._subscribers.get(msg["channel"], ()):
+                sub.put(msg["channel"], event_id, message)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+
+class RedisPubSubBackend(PubSubBackend):
+    """
+    基于redis的发布订阅，多个进程之间共享
+
+    - pubsub模式：最后一条消息保存在prev_<channel>，再PUBLISH
+    - stream模式：消息保存在stream_<channel>（redis stream），事件id就是stream的条目id
+
+    不管一次发布多少条消息都只有一次往返，保存的消息在snapshot_ttl秒没有更新后过期
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        queue_size: int = 256,
+        mode: PubSubMode = PubSubMode.PUBSUB,
+        stream_maxlen: int = 100,
+        snapshot_ttl: int = 24 * 3600,
+    ):
+        self._redis = redis
+        self._mode = PubSubMode(mode)
+        self._stream_maxlen = stream_maxlen
+        self._snapshot_ttl = snapshot_ttl
+        self._hub = SubscriptionHub(
+            redis, queue_size, with_event_id=self._mode == PubSubMode.STREAM
+        )
+        self._publish_stream = redis.register_script(_PUBLISH_STREAM)
+
+    @property
+    def channels(self) -> int:
+        return self._hub.channels
+
+    async def publish_many(self, messages: list[tuple[str, str]]) -> list[str | None]:
+        if not messages:
+            return []
+        if self._mode == PubSubMode.STREAM:
+            args = [self._stream_maxlen, self._snapshot_ttl]
+            for channel, message in messages:
+                args += [channel, message]
+            return await self._publish_stream(
+                keys=[f"stream_{channel}" for channel, _ in messages], args=args
+            )
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for channel, message in messages:
+                pipe.set(f"prev_{channel}", message, ex=self._snapshot_ttl or None)
+                pipe.publish(channel, message)
+            await pipe.execute()
+        return [None] * len(messages)
+
+    async def snapshot(
+        self, channels: tuple[str, ...], last_event_id: str | None = None
+    ) -> list[Event]:
+        if not channels:
+            return []
+        if self._mode == PubSubMode.PUBSUB:
+            messages = await self._redis.mget([f"prev_{channel}" for channel in channels])
+            return [
+                (channel, None, message)
+                for channel, message in zip(channels, messages)
+                if message
+            ]
+        # 不同stream的条目id只按毫秒可比，从last_event_id所在的毫秒开始补发，可能重复一条消息
+        match = _STREAM_ID.match(last_event_id or "")
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for channel in channels:
+                if match:
+                    pipe.xrange(f"stream_{channel}", min=f"{match.group(1)}-0")
+                else:
+                    pipe.xrevrange(f"stream_{channel}", count=1)
+            results = await pipe.execute()
+        events = [
+            (channel, event_id, fields["data"])
+            for channel, entries in zip(channels, results)
+            for event_id, fields in entries
+        ]
+        events.sort(key=lambda e: stream_id(e[1]))
+        return events
+
+    async def subscribe(self, *channels: str, coalesce: bool = False) -> Subscription:
+        return await self._hub.subscribe(*channels, coalesce=coalesce)
+
+    async def close(self):
+        await self._hub.close()
+
+
+class InProcessPubSubBackend(PubSubBackend):
+    """
+    进程内的发布订阅，只适合单进程部署和测试，发布直接放进订阅者的队列，不经过网络
+
+    事件id和redis stream一样是"毫秒-序号"，在进程内全局递增；
+    保存的消息在snapshot_ttl秒没有更新后过期，发布时顺带清理
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 256,
+        mode: PubSubMode = PubSubMode.PUBSUB,
+        stream_maxlen: int = 100,
+        snapshot_ttl: int = 24 * 3600,
+    ):
+        self._queue_size = queue_size
+        self._mode = PubSubMode(mode)
+        self._history_size = stream_maxlen if self._mode == PubSubMode.STREAM else 1
+        self._snapshot_ttl = snapshot_ttl
+        self._subscribers: dict[str, set[Subscription]] = {}
+        # 频道 -> 最近的(事件id, 消息)，按最后更新时间排序
+        self._history: OrderedDict[str, deque[tuple[str, str]]] = OrderedDict()
+        # 频道 -> 过期时间
+        self._expire_at: dict[str, float] = {}
+        self._last_id = (0, 0)
+
+    @property
+    def channels(self) -> int:
+        return len(self._subscribers)
+
+    def _next_id(self) -> str:
+        ms = int(time() * 1000)
+        last_ms, last_seq = self._last_id
+        self._last_id = (ms, 0) if ms > last_ms else (last_ms, last_seq + 1)
+        return "%d-%d" % self._last_id
+
+    def _expire(self, now: float):
+        while self._history:
+            channel = next(iter(self._history))
+            if self._expire_at[channel] > now:
+                break
+            del self._history[channel]
+            del self._expire_at[channel]
+
+    def _publish(self, channel: str, message: str, now: float) -> str | None:
+        event_id = self._next_id()
+        history = self._history.get(channel)
+        if history is None:
+            history = self._history[channel] = deque(maxlen=self._history_size)
+        else:
+            self._history.move_to_end(channel)
+        history.append((event_id, message))
+        if self._snapshot_ttl:
+            self._expire_at[channel] = now + self._snapshot_ttl
+        if self._mode == PubSubMode.PUBSUB:
+            event_id = None
+        for sub in self._subscribers.get(channel, ()):
+            sub.put(channel, event_id, message)
+        return event_id
+
+    async def publish_many(self, messages: list[tuple[str, str]]) -> list[str | None]:
+        now = time()
+        if self._snapshot_ttl:
+            self._expire(now)
+        return [self._publish(channel, message, now) for channel, message in messages]
+
+    def _alive(self, channel: str, now: float) -> bool:
+        return channel in self._history and (
+            not self._snapshot_ttl or self._expire_at[channel] > now
+        )
+
+    async def snapshot(
+        self, channels: tuple[str, ...], last_event_id: str | None = None
+    ) -> list[Event]:
+        now = time()
+        channels = [channel for channel in channels if self._alive(channel, now)]
+        if self._mode == PubSubMode.PUBSUB:
+            return [(channel, None, self._history[channel][-1][1]) for channel in channels]
+        # 事件id全局有序，可以准确地从last_event_id之后补发
+        after = stream_id(last_event_id) if _STREAM_ID.match(last_event_id or "") else None
+        events = []
+        for channel in channels:
+            history = self._history[channel]
+            if after is None:
+                history = [history[-1]]
+            events.extend(
+                (channel, event_id, message)
+                for event_id, message in history
+                if after is None or stream_id(event_id) > after
+            )
+        events.sort(key=lambda e: stream_id(e[1]))
+        return events
+
+    async def subscribe(self, *channels: str, coalesce: bool = False) -> Subscription:
+        sub = Subscription(self, (), self._queue_size, coalesce)
+        await self.attach(sub, channels)
+        return sub
+
+    async def attach(self, sub: Subscription, channels: tuple[str, ...]):
+        subscribed = set(sub.channels)
+        channels = tuple(c for c in dict.fromkeys(channels) if c not in subscribed)
+        sub.channels += channels
+        for channel in channels:
+            self._subscribers.setdefault(channel, set()).add(sub)
+
+    def detach(self, sub: Subscription, channels: tuple[str, ...]):
+        removed = set(channels)
+        sub.channels = tuple(c for c in sub.channels if c not in removed)
+        for channel in removed:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is None:
+                continue
+            subscribers.discard(sub)
+            if not subscribers:
+                del self._subscribers[channel]
@@ -1,45 +1,149 @@
 import asyncio
-from redis.asyncio import Redis
-from sse_starlette import JSONServerSentEvent, EventSourceResponse
+from typing import AsyncIterator, Callable, Iterable
+
+from sse_starlette import JSONServerSentEvent, EventSourceResponse, ServerSentEvent
 import logging
 
+from app.core.pubsub import Event, PubSubBackend, Subscription, stream_id
+
 logger = logging.getLogger(__name__)
 
 
 class SSEPubSub:
-    def __init__(self, redis: Redis):
-        self._redis = redis
+    """
+    进度消息的发布和SSE推送，消息的存储和分发由PubSubBackend实现
+
+    每个SSE连接阻塞等待自己订阅队列里的下一条消息，收到就立即推送，没有轮询；
+    空闲的连接只每隔ping_interval秒发送一次keepalive注释，
+    客户端超过send_timeout秒不读取时断开连接
+    """
 
-    async def publish(self, channel: str, message: str):
-        await self._redis.set(f"prev_{channel}", message)
-        await self._redis.publish(channel, message)
+    def __init__(
+        self,
+        backend: PubSubBackend,
+        ping_interval: float = 15,
+        send_timeout: float | None = 30,
+    ):
+        self._backend = backend
+        self._ping_interval = ping_interval
+        self._send_timeout = send_timeout
 
-    async def get_prev_message(self, channel: str) -> str | None:
-        return await self._redis.get(f"prev_{channel}")
+    @property
+    def backend(self) -> PubSubBackend:
+        return self._backend
 
-    async def subscribe(self, *channels: str):
+    async def publish(self, channel: str, message: str) -> str | None:
+        return await self._backend.publish(channel, message)
+
+    async def publish_many(self, messages: list[tuple[str, str]]) -> list[str | None]:
         """
-        订阅频道
+        一次发布多个频道的消息[(频道, 消息)]
+        """
+        return await self._backend.publish_many(messages)
+
+    async def _events(
+        self,
+        subscription: Subscription,
+        last_event_id: str | None,
+        batch_interval: float,
+        is_final: Callable[[str], bool] | None,
+        done: set[str],
+    ):
+        # 每个频道已经发送的最后一个事件id，补发期间收到的实时消息不重复发送
+        sent: dict[str, tuple[int, int]] = {}
+        finished = set(done)
+
+        def accept(event: Event) -> bool:
+            channel, event_id, message = event
+            if event_id:
+                if channel in sent and stream_id(event_id) <= sent[channel]:
+                    return False
+                sent[channel] = stream_id(event_id)
+            if is_final is not None and is_final(message):
+                finished.add(channel)
+            return True
+
+        channels = set(subscription.channels)
+
+        def all_finished() -> bool:
+            return is_final is not None and finished >= channels
+
+        pending = [
+            e
+            for e in await self._backend.snapshot(subscription.channels, last_event_id)
+            if accept(e)
+        ]
+        while True:
+            if batch_interval > 0:
+                if pending:
+                    yield _batch_event(pending)
+            else:
+                for _, event_id, message in pending:
+                    yield JSONServerSentEvent(data=message, id=event_id)
+            if all_finished():
+                return
+            event = await subscription.get()
+            pending = [event] if accept(event) else []
+            if batch_interval > 0 and not all_finished():
+                # 收到第一条消息后再等一个间隔，期间的消息合并成一个事件
+                await asyncio.sleep(batch_interval)
+                pending += [e for e in subscription.drain() if accept(e)]
+
+    async def subscribe(
+        self,
+        *channels: str,
+        last_event_id: str | None = None,
+        batch_interval: float = 0,
+        is_final: Callable[[str], bool] | None = None,
+        done: Iterable[str] = (),
+    ):
+        """
+        订阅频道，stream模式下从last_event_id之后开始补发
+
+        batch_interval大于0时，每个间隔内的消息合并成一个事件，数据是每个频道最新消息组成的JSON数组；
+        给出is_final时，所有频道都收到is_final的消息后结束，done中的频道视为已经结束
         """
 
         async def _event_generator():
             logger.info(f"subscribe channels: {channels}")
-            for channel in channels:
-                prev_message = await self.get_prev_message(channel)
-                if prev_message:
-                    # logger.info(f"get prev message: {prev_message}")
-                    yield JSONServerSentEvent(data=prev_message)
-            async with self._redis.pubsub() as pubsub:
-                await pubsub.subscribe(*channels)
-                while True:
-                    msg = await pubsub.get_message(
-                        ignore_subscribe_messages=True, timeout=0.1
-                    )
-                    if msg and msg["type"] == "message":
-                        # logger.info(f"get message: {msg['data']}")
-                        yield JSONServerSentEvent(
-                            data=msg["data"],
-                        )
-                    await asyncio.sleep(0.5)
-
-        return EventSourceResponse(_event_generator())
+            # 先订阅再读取历史消息，避免两者之间发布的消息丢失
+            subscription = None
+            try:
+                # 批量模式只用到每个频道最新的消息，按频道合并，关注的频道再多也不会丢掉最终消息
+                subscription = await self._backend.subscribe(
+                    *channels, coalesce=batch_interval > 0
+                )
+                async for event in self._events(
+                    subscription, last_event_id, batch_interval, is_final, set(done)
+                ):
+                    yield event
+            finally:
+                if subscription is not None:
+                    subscription.close()
+
+        return EventSourceResponse(
+            _event_generator(), ping=self._ping_interval, send_timeout=self._send_timeout
+        )
+
+    async def close(self):
+        await self._backend.close()
+
+
+def _batch_event(events: list[Event]) -> ServerSentEvent:
+    # 每个频道只保留最新的消息，消息本身已经是JSON，直接拼成数组
+    latest = {channel: message for channel, _, message in events}
+    event_ids = [event_id for _, event_id, _ in events if event_id]
+    return ServerSentEvent(
+        data=f"[{','.join(latest.values())}]",
+        id=max(event_ids, key=stream_id) if event_ids else None,
+    )
+
+
+async def init_sse_pubsub(
+    backend: PubSubBackend,
+    ping_interval: float = 15,
+    send_timeout: float | None = 30,
+) -> AsyncIterator[SSEPubSub]:
+    sse_pubsub = SSEPubSub(backend, ping_interval, send_timeout)
+    yield sse_pubsub
+    await sse_pubsub.close()
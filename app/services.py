@@ -1,12 +1,22 @@
 """Services module."""
 
+import os
+from pathlib import Path
+from typing import AsyncIterator
 from uuid import UUID
+
+from fastapi import WebSocket
+from sse_starlette import EventSourceResponse
+
 from app.core.file_storage.file_upload import FileChunkUploader, FileUploader
 from app.core.file_storage.schemas import (
+    FileChunkEncoding,
     FileChunkUploadRequest,
     FileChunkUploadResponse,
     FileUploadTaskCreate,
     FileUploadTaskPublic,
+    FileUploadTaskQueryResult,
+    FileUploadRequest,
 )
 from .repositories import UserRepository
 from .models import UserCreate, User
@@ -30,13 +40,49 @@ class FileUploadService:
     ) -> FileUploadTaskPublic:
         return await self._uploader.create_task(task_data)
 
+    async def create_tasks(
+        self, tasks_data: list[FileUploadTaskCreate]
+    ) -> list[FileUploadTaskPublic]:
+        return await self._uploader.create_tasks(tasks_data)
+
     async def upload_chunk(
         self, req: FileChunkUploadRequest
     ) -> FileChunkUploadResponse:
         return await self._uploader.upload_chunk(req)
 
-    # async def query_task(self, task_ids: list[UUID]) -> list[FileUploadTaskPublic]:
-    #     return await self._uploader.query_task(task_ids)
+    async def upload_file(self, req: FileUploadRequest) -> FileChunkUploadResponse:
+        task_data = FileUploadTaskCreate(
+            file_name=req.file_name, file_size=req.file.size, digest=req.digest
+        )
+        return await self._uploader.upload_file(task_data, req.file)
+
+    async def upload_chunk_stream(
+        self,
+        task_id: UUID,
+        chunk_idx: int,
+        stream: AsyncIterator[bytes],
+        content_length: int | None = None,
+        encoding: FileChunkEncoding = FileChunkEncoding.IDENTITY,
+        checksum: str | None = None,
+    ) -> FileChunkUploadResponse:
+        return await self._uploader.upload_chunk_stream(
+            task_id, chunk_idx, stream, content_length, encoding, checksum
+        )
+
+    async def query_tasks(
+        self, task_ids: list[UUID]
+    ) -> list[FileUploadTaskQueryResult]:
+        return await self._uploader.query_tasks(task_ids)
+
+    async def stored_file(
+        self, file_name: str
+    ) -> tuple[Path, os.stat_result, str | None] | None:
+        return await self._uploader.stored_file(file_name)
+
+    async def progress(
+        self, task_ids: list[UUID], last_event_id: str | None = None, batch: bool = False
+    ) -> EventSourceResponse:
+        return await self._uploader.progress(task_ids, last_event_id, batch)
 
-    async def progress(self, task_ids: list[UUID]) -> FileUploadTaskPublic:
-        return await self._uploader.progress(task_ids)
+    async def progress_socket(self, websocket: WebSocket):
+        await self._uploader.progress_socket(websocket)
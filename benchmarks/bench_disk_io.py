@@ -0,0 +1,101 @@
+"""
+分片写入基准：并发上传时合并写入对系统调用次数和延迟的影响
+
+    python -m benchmarks.bench_disk_io --uploads 200 --file-size 4194304
+
+每个上传按buffer_size的小块写入，对比不同write_batch_size下
+pwrite系统调用次数、总耗时和单个上传耗时的p50/p99
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from app.core.file_storage import file_io
+from app.core.file_storage.file_io import ChunkFileWriter
+from benchmarks.bench_upload import _percentile
+
+
+class _SyscallCounter:
+    def __init__(self):
+        self.pwrite = 0
+        self._pwrite = os.pwrite
+
+    def __enter__(self):
+        def pwrite(fd, data, offset):
+            self.pwrite += 1
+            return self._pwrite(fd, data, offset)
+
+        file_io.os.pwrite = pwrite
+        return self
+
+    def __exit__(self, *exc):
+        file_io.os.pwrite = self._pwrite
+
+
+async def _upload(
+    writer: ChunkFileWriter, path: Path, data: bytes, buffer_size: int, batch_size: int
+) -> float:
+    start = perf_counter()
+    batch = writer.coalesce(path, 0, batch_size)
+    for pos in range(0, len(data), buffer_size):
+        await batch.write(data[pos : pos + buffer_size])
+        # 模拟从网络读取下一块数据
+        await asyncio.sleep(0)
+    await batch.flush()
+    await writer.close(path)
+    return perf_counter() - start
+
+
+async def _run(args, batch_size: int) -> dict:
+    writer = ChunkFileWriter(
+        max_open_files=args.uploads, io_workers=args.io_workers, max_pending=args.max_pending
+    )
+    data = os.urandom(args.file_size)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [Path(tmp) / f"{i}.bin" for i in range(args.uploads)]
+        for path in paths:
+            await writer.preallocate(path, args.file_size)
+        with _SyscallCounter() as counter:
+            start = perf_counter()
+            latencies = await asyncio.gather(
+                *[
+                    _upload(writer, path, data, args.buffer_size, batch_size)
+                    for path in paths
+                ]
+            )
+            elapsed = perf_counter() - start
+    writer.close_all()
+    return {
+        "write_batch_size": batch_size,
+        "pwrite_calls": counter.pwrite,
+        "total_s": round(elapsed, 3),
+        "throughput_mb_s": round(args.uploads * args.file_size / elapsed / 2**20, 1),
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--uploads", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--buffer-size", type=int, default=64 * 1024)
+    parser.add_argument(
+        "--batch-sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[64 * 1024, 1024 * 1024, 4 * 1024 * 1024],
+    )
+    parser.add_argument("--io-workers", type=int, default=16)
+    parser.add_argument("--max-pending", type=int, default=256)
+    args = parser.parse_args()
+
+    for batch_size in args.batch_sizes:
+        print(asyncio.run(_run(args, batch_size)))
+
+
+if __name__ == "__main__":
+    main()
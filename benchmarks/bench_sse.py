@@ -0,0 +1,332 @@
+"""
+SSE订阅者容量基准：一个进程能同时承载多少个/file/upload/progress连接
+
+    python -m benchmarks.bench_sse --output bench_sse.json
+    python -m benchmarks.bench_sse --subscribers 1000,5000,10000 --tasks 500 --rate 2000
+
+create_app()跑在进程内的uvicorn上（SSE是流式响应，ASGITransport会等响应结束），redis使用进程内的fakeredis。
+每个订阅者是一个很轻的原始TCP客户端，订阅一个任务（订阅者按顺序分配到--tasks个任务上），
+连接全部就绪后，发布者按--rate条/秒调用SSEPubSub.publish，持续--duration秒。统计：
+    端到端延迟的p50/p99/max（发布到客户端收到数据）
+    每个送达事件的CPU时间（整个进程，包括发布者和客户端解析）
+    每个空闲订阅者的内存（RSS增量，包括客户端这一侧的连接）
+    redis连接数
+需要安装fakeredis[lua]；订阅者很多时注意ulimit -n
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter, process_time
+
+import uvicorn
+from dependency_injector import providers
+from fakeredis import aioredis
+
+from app.api.fastapi import create_app
+from app.core.file_storage.file_upload import FileUploadSettings
+from benchmarks.bench_upload import _git_commit, _init_fake_redis, _int_list, _percentile
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+# 每个连接一行的订阅日志会淹没结果
+logging.getLogger("app.core.sse").setLevel(logging.WARNING)
+
+# 同时发起的连接数，避免超过监听队列
+CONNECT_BURST = 256
+
+
+def _rss() -> int:
+    """
+    当前进程的RSS（字节），没有/proc时退化为峰值RSS
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # macOS上ru_maxrss的单位是字节，linux上是KB
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if platform.system() == "Darwin" else maxrss * 1024
+
+
+def _redis_connections(redis: aioredis.FakeRedis) -> int:
+    pool = redis.connection_pool
+    return len(pool._available_connections) + len(pool._in_use_connections)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _messages(data: str) -> list:
+    # 单条事件的数据是JSON编码后的消息字符串，合并的事件是消息组成的数组
+    value = json.loads(data)
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value if isinstance(value, list) else [value]
+
+
+class _Subscriber:
+    """
+    只解析分块编码和SSE数据行的最小客户端，尽量不让客户端的开销影响服务端的测量
+    """
+
+    def __init__(self, port: int, task_id: str, latencies: list[float], batch: bool):
+        self._port = port
+        self._task_id = task_id
+        self._latencies = latencies
+        # --batch-ms大于0时请求合并的进度流
+        self._batch = b"true" if batch else b"false"
+        self.ready = asyncio.get_running_loop().create_future()
+        self.events = 0
+        self._writer: asyncio.StreamWriter | None = None
+
+    async def run(self, connect: asyncio.Semaphore):
+        async with connect:
+            reader, self._writer = await asyncio.open_connection("127.0.0.1", self._port)
+            body = json.dumps([self._task_id]).encode()
+            self._writer.write(
+                b"POST /file/upload/progress?batch=%s HTTP/1.1\r\n"
+                b"Host: bench\r\n"
+                b"Accept: text/event-stream\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n" % (self._batch, len(body)) + body
+            )
+            status = await reader.readline()
+            if b" 200 " not in status:
+                raise RuntimeError(f"订阅失败: {status!r}")
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+        buffer = b""
+        while True:
+            size = int(await reader.readline(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if not size:
+                return
+            received = perf_counter()
+            buffer += chunk[:-2].replace(b"\r\n", b"\n")
+            *events, buffer = buffer.split(b"\n\n")
+            for event in events:
+                for line in event.split(b"\n"):
+                    if line.startswith(b"data:"):
+                        self._on_data(line[5:].strip().decode(), received)
+
+    def _on_data(self, data: str, received: float):
+        for message in _messages(data):
+            sent_at = message.get("sent_at")
+            if sent_at is None:
+                # 订阅时补发的初始消息，说明连接已经就绪
+                if not self.ready.done():
+                    self.ready.set_result(None)
+                continue
+            self.events += 1
+            self._latencies.append(received - sent_at)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+async def _create_tasks(port: int, count: int) -> list[str]:
+    from httpx import AsyncClient
+
+    task_ids = []
+    async with AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None) as client:
+        # create_tasks每次最多1000个
+        for start in range(0, count, 1000):
+            response = await client.post(
+                "/file/upload/create_tasks",
+                json=[
+                    {"file_name": f"bench_sse_{i}.bin", "file_size": 2**30}
+                    for i in range(start, min(count, start + 1000))
+                ],
+            )
+            response.raise_for_status()
+            task_ids += [task["id"] for task in response.json()]
+    return task_ids
+
+
+def _progress(task_id: str, uploaded_bytes: int, sent_at: float | None) -> str:
+    return json.dumps(
+        {
+            "id": task_id,
+            "status": "waiting_next_chunk",
+            "uploaded_bytes": uploaded_bytes,
+            "sent_at": sent_at,
+        }
+    )
+
+
+async def _publish(
+    sse_pubsub, task_ids: list[str], channels: list[str], rate: float, duration: float
+) -> int:
+    """
+    按rate条/秒轮流向各个频道发布，返回发布的消息数
+    """
+    published = 0
+    start = perf_counter()
+    while (elapsed := perf_counter() - start) < duration:
+        # 按已经过去的时间补齐应该发布的消息数，事件循环繁忙时不会少发
+        due = int(elapsed * rate) - published
+        for _ in range(due):
+            i = published % len(channels)
+            await sse_pubsub.publish(
+                channels[i], _progress(task_ids[i], published, perf_counter())
+            )
+            published += 1
+        await asyncio.sleep(0.001)
+    return published
+
+
+async def _run(args, subscribers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app()
+        redis = aioredis.FakeRedis(decode_responses=True)
+        app.deps.redis.override(providers.Resource(_init_fake_redis, redis))
+        app.deps.config.sse.backend.from_value(args.pubsub_backend)
+        app.deps.config.sse.mode.from_value(args.sse_mode)
+        app.deps.file_upload_settings.override(
+            providers.Object(
+                FileUploadSettings(
+                    temp_dir=Path(tmp) / "temp",
+                    storge_dir=Path(tmp) / "storage",
+                    progress_batch_ms=args.batch_ms,
+                )
+            )
+        )
+        port = _free_port()
+        server = uvicorn.Server(
+            uvicorn.Config(
+                app,
+                host="127.0.0.1",
+                port=port,
+                log_level="warning",
+                access_log=False,
+                backlog=2048,
+            )
+        )
+        serve = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+
+        uploader = await app.deps.file_uploader(bucket_name="bench")
+        sse_pubsub = await app.deps.sse_pubsub()
+        task_ids = await _create_tasks(port, min(args.tasks, subscribers))
+        channels = [uploader._progress_channel(task_id) for task_id in task_ids]
+        # 先发布一条初始消息，订阅者收到它就说明订阅已经生效
+        await sse_pubsub.publish_many(
+            [
+                (channel, _progress(task_id, 0, None))
+                for task_id, channel in zip(task_ids, channels)
+            ]
+        )
+
+        latencies: list[float] = []
+        connect = asyncio.Semaphore(CONNECT_BURST)
+        clients = [
+            _Subscriber(port, task_ids[i % len(task_ids)], latencies, args.batch_ms > 0)
+            for i in range(subscribers)
+        ]
+        rss_before = _rss()
+        start = perf_counter()
+        readers = [asyncio.create_task(client.run(connect)) for client in clients]
+        ready = asyncio.gather(*[client.ready for client in clients])
+        done, _ = await asyncio.wait(
+            [ready, *readers], return_when=asyncio.FIRST_COMPLETED
+        )
+        if ready not in done:
+            # 连接全部就绪之前有客户端失败
+            for reader in done:
+                reader.result()
+        connect_s = perf_counter() - start
+        # 等连接空闲下来再测内存
+        await asyncio.sleep(1)
+        rss_idle = _rss()
+        redis_connections = _redis_connections(redis)
+
+        cpu_start = process_time()
+        published = await _publish(sse_pubsub, task_ids, channels, args.rate, args.duration)
+        # 等最后一个合并间隔和队列里的消息送达
+        await asyncio.sleep(args.batch_ms / 1000 + 1)
+        cpu = process_time() - cpu_start
+
+        for client in clients:
+            client.close()
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        server.should_exit = True
+        await serve
+        await redis.aclose()
+
+    delivered = sum(client.events for client in clients)
+    latencies.sort()
+    return {
+        "subscribers": subscribers,
+        "tasks": len(task_ids),
+        "pubsub_backend": args.pubsub_backend,
+        "sse_mode": args.sse_mode,
+        "batch_ms": args.batch_ms,
+        "rate": args.rate,
+        "connect_s": round(connect_s, 3),
+        "published": published,
+        # 不合并时每条消息送达订阅这个任务的所有连接
+        "expected": published * subscribers // len(task_ids),
+        "delivered": delivered,
+        "latency_p50_ms": round(_percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        "latency_p99_ms": round(_percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "latency_max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+        "cpu_us_per_event": round(cpu / delivered * 1e6, 1) if delivered else None,
+        "rss_kb_per_subscriber": round((rss_idle - rss_before) / subscribers / 1024, 1),
+        "redis_connections": redis_connections,
+    }
+
+
+async def _main(args) -> list[dict]:
+    results = []
+    for subscribers in args.subscribers:
+        result = await _run(args, subscribers)
+        print(result)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--subscribers", type=_int_list, default=[100, 1000, 5000])
+    # 订阅者分配到的任务数，每个任务的订阅者数是subscribers/tasks
+    parser.add_argument("--tasks", type=int, default=100)
+    # 每秒发布的消息数
+    parser.add_argument("--rate", type=float, default=500)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--batch-ms", type=int, default=0)
+    parser.add_argument("--pubsub-backend", choices=["redis", "memory"], default="redis")
+    parser.add_argument("--sse-mode", choices=["pubsub", "stream"], default="pubsub")
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    results = asyncio.run(_main(args))
+    if args.output:
+        report = {
+            "commit": _git_commit(),
+            "time": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "args": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+上传吞吐量基准：通过httpx.ASGITransport直接驱动create_app()，redis使用进程内的fakeredis
+
+    python -m benchmarks.bench_upload --output bench_upload.json
+    python -m benchmarks.bench_upload --file-sizes 4194304 --chunk-sizes 1048576 \\
+        --buffer-sizes 65536 --concurrency 1,10,100,1000
+
+对文件大小、分片大小、buffer_size和并发上传数的每种组合，上传concurrency个文件（每个文件的分片按顺序上传），
+统计MB/s、请求数/s、分片请求延迟的p50/p99、每MB数据的redis命令数，以及上传各阶段的耗时。
+结果写成JSON，可以在不同提交之间对比。需要安装fakeredis[lua]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+
+from asgi_lifespan import LifespanManager
+from dependency_injector import providers
+from fakeredis import aioredis
+from httpx import ASGITransport, AsyncClient
+
+from app.api.fastapi import create_app
+from app.core.file_storage.file_upload import FileUploadSettings
+
+
+# 每个请求一行的访问日志会淹没结果
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def _int_list(s: str) -> list[int]:
+    return [int(x) for x in s.split(",")]
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """
+    q分位数（q是0.01的整数倍），各个基准都用这个实现；只有一个值时quantiles没有意义，直接取唯一的值
+    """
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[round(q * 100) - 1]
+
+
+async def _init_fake_redis(redis: aioredis.FakeRedis):
+    # 和init_redis_pool一样是异步资源，依赖redis的provider仍然需要await
+    yield redis
+
+
+class _RedisCommandCounter:
+    """
+    统计发送给redis的命令数，管道和事务中的每个命令都单独计数
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self._pack_command = aioredis.FakeAsyncRedisConnection.pack_command
+
+    def __enter__(self):
+        pack_command = self._pack_command
+
+        def counting_pack_command(conn, *args):
+            self.commands += 1
+            return pack_command(conn, *args)
+
+        aioredis.FakeAsyncRedisConnection.pack_command = counting_pack_command
+        return self
+
+    def __exit__(self, *exc):
+        aioredis.FakeAsyncRedisConnection.pack_command = self._pack_command
+
+
+async def _upload(
+    client: AsyncClient,
+    file_name: str,
+    data: bytes,
+    chunk_size: int,
+    endpoint: str,
+    latencies: list[float],
+) -> tuple[int, int, int]:
+    """
+    创建任务并按顺序上传所有分片，返回(请求数, 被拒绝重试的次数, 服务端选择的分片大小)
+    """
+    response = await client.post(
+        "/file/upload/create_task",
+        json={"file_name": file_name, "file_size": len(data), "chunk_size_hint": chunk_size},
+    )
+    response.raise_for_status()
+    task = response.json()
+    requests, rejected = 1, 0
+    for chunk_idx in range(task["total_chunks"]):
+        pos = chunk_idx * task["chunk_size"]
+        chunk = data[pos : pos + task["chunk_size"]]
+        while True:
+            start = perf_counter()
+            if endpoint == "raw":
+                response = await client.put(
+                    f"/file/upload/{task['id']}/chunks/{chunk_idx}",
+                    content=chunk,
+                    headers={"Content-Type": "application/octet-stream"},
+                )
+            else:
+                response = await client.post(
+                    "/file/upload/chunk",
+                    data={"id": task["id"], "chunk_idx": chunk_idx},
+                    files=[("chunk", ("chunk", chunk))],
+                )
+            latencies.append(perf_counter() - start)
+            requests += 1
+            if response.status_code != 429:
+                break
+            # 准入控制拒绝时稍后重试，不按Retry-After等待整秒，避免掩盖吞吐量
+            rejected += 1
+            await asyncio.sleep(0.01)
+        response.raise_for_status()
+        if not response.json()["success"]:
+            raise RuntimeError(f"{file_name} 分片{chunk_idx}上传失败: {response.text}")
+    return requests, rejected, task["chunk_size"]
+
+
+async def _run(
+    args, file_size: int, chunk_size: int, buffer_size: int, concurrency: int, data: bytes
+) -> dict:
+    with tempfile.TemporaryDirectory() as tmp, _RedisCommandCounter() as counter:
+        app = create_app()
+        redis = aioredis.FakeRedis(decode_responses=True)
+        app.deps.redis.override(providers.Resource(_init_fake_redis, redis))
+        app.deps.config.sse.backend.from_value(args.pubsub_backend)
+        app.deps.file_upload_settings.override(
+            providers.Object(
+                FileUploadSettings(
+                    temp_dir=Path(tmp) / "temp",
+                    storge_dir=Path(tmp) / "storage",
+                    buffer_size=buffer_size,
+                    # 这里测的是上传链路本身，准入控制的并发上限放宽到并发上传数
+                    max_concurrent_writes=max(args.max_concurrent_writes, concurrency),
+                    metrics_enabled=args.stage_timings,
+                )
+            )
+        )
+        async with LifespanManager(app) as manager:
+            async with AsyncClient(
+                transport=ASGITransport(app=manager.app), base_url="http://bench", timeout=None
+            ) as client:
+                # 不统计启动时的命令
+                counter.commands = 0
+                latencies: list[float] = []
+                start = perf_counter()
+                results = await asyncio.gather(
+                    *[
+                        _upload(client, f"bench_{i}.bin", data, chunk_size, args.endpoint, latencies)
+                        for i in range(concurrency)
+                    ]
+                )
+                elapsed = perf_counter() - start
+                commands = counter.commands
+            timings = app.deps.upload_timings().snapshot()
+        await redis.aclose()
+
+    total_mb = concurrency * file_size / 2**20
+    result = {
+        "file_size": file_size,
+        # chunk_size是服务端实际使用的分片大小，不超过single_request_threshold的文件只有一个分片，
+        # 不同的chunk_size_hint会得到相同的chunk_size
+        "chunk_size_hint": chunk_size,
+        "chunk_size": results[0][2],
+        "buffer_size": buffer_size,
+        "concurrency": concurrency,
+        "endpoint": args.endpoint,
+        "pubsub_backend": args.pubsub_backend,
+        "total_s": round(elapsed, 3),
+        "throughput_mb_s": round(total_mb / elapsed, 1),
+        "requests": sum(r for r, _, _ in results),
+        "requests_per_s": round(sum(r for r, _, _ in results) / elapsed, 1),
+        "rejected": sum(r for _, r, _ in results),
+        "chunk_p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+        "chunk_p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        "redis_commands": commands,
+        "redis_commands_per_mb": round(commands / total_mb, 1),
+    }
+    if args.stage_timings:
+        result["stages"] = timings
+    return result
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _main(args) -> list[dict]:
+    results = []
+    payloads = {file_size: os.urandom(file_size) for file_size in args.file_sizes}
+    for file_size, chunk_size, buffer_size, concurrency in itertools.product(
+        args.file_sizes, args.chunk_sizes, args.buffer_sizes, args.concurrency
+    ):
+        if file_size * concurrency > args.max_total_bytes:
+            print(f"跳过 file_size={file_size} concurrency={concurrency}: 超过--max-total-bytes")
+            continue
+        result = await _run(args, file_size, chunk_size, buffer_size, concurrency, payloads[file_size])
+        print({k: v for k, v in result.items() if k != "stages"})
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--file-sizes", type=_int_list, default=[1024 * 1024, 8 * 1024 * 1024])
+    parser.add_argument(
+        "--chunk-sizes", type=_int_list, default=[256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+    )
+    parser.add_argument("--buffer-sizes", type=_int_list, default=[64 * 1024, 256 * 1024])
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 10, 100, 1000])
+    parser.add_argument("--endpoint", choices=["multipart", "raw"], default="multipart")
+    parser.add_argument("--pubsub-backend", choices=["redis", "memory"], default="redis")
+    parser.add_argument("--max-concurrent-writes", type=int, default=64)
+    # 单个组合上传的总数据量上限，超过的组合跳过
+    parser.add_argument("--max-total-bytes", type=int, default=2 * 1024**3)
+    parser.add_argument("--stage-timings", action="store_true")
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    results = asyncio.run(_main(args))
+    if args.output:
+        report = {
+            "commit": _git_commit(),
+            "time": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "args": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import socket
+
+import pytest
+import pytest_asyncio
+from fakeredis import aioredis
+from redis.asyncio import from_url
+
+REDIS_URL = "redis://localhost:6379/0"
+
+
+def _redis_available() -> bool:
+    try:
+        with socket.create_connection(("localhost", 6379), timeout=0.5) as s:
+            s.sendall(b"PING\r\n")
+            return s.recv(7).startswith(b"+PONG")
+    except OSError:
+        return False
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "real_redis: 需要本地的redis服务（localhost:6379），没有时跳过"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    marked = [item for item in items if item.get_closest_marker("real_redis")]
+    if not marked or _redis_available():
+        return
+    skip = pytest.mark.skip(reason="本地没有可用的redis服务")
+    for item in marked:
+        item.add_marker(skip)
+
+
+@pytest_asyncio.fixture
+async def redis():
+    # 进程内的fakeredis，支持lua脚本
+    client = aioredis.FakeRedis(decode_responses=True)
+    yield client
+    await client.aclose()
+
+
+@pytest_asyncio.fixture(
+    params=["fakeredis", pytest.param("redis", marks=pytest.mark.real_redis)]
+)
+async def any_redis(request):
+    # 发布订阅和stream的用例总是在fakeredis上运行，本地有redis服务时再在真实的服务上运行一次
+    if request.param == "fakeredis":
+        client = aioredis.FakeRedis(decode_responses=True)
+    else:
+        client = from_url(REDIS_URL, decode_responses=True)
+    yield client
+    await client.aclose()
@@ -0,0 +1,20 @@
+from dependency_injector import providers
+from fakeredis import aioredis
+from fastapi import FastAPI
+
+
+async def _init_fake_redis(redis: aioredis.FakeRedis):
+    # 和init_redis_pool一样是异步资源
+    yield redis
+    await redis.aclose()
+
+
+def use_fake_redis(app: FastAPI, pubsub_backend: str = "memory") -> aioredis.FakeRedis:
+    """
+    应用依赖的redis换成进程内的fakeredis，进度推送使用进程内的发布订阅后端，
+    测试不需要本地的redis服务，需要在启动应用之前调用
+    """
+    redis = aioredis.FakeRedis(decode_responses=True)
+    app.deps.redis.override(providers.Resource(_init_fake_redis, redis))
+    app.deps.config.sse.backend.from_value(pubsub_backend)
+    return redis
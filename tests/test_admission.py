@@ -0,0 +1,44 @@
+from uuid import uuid4
+
+import pytest
+
+from app.core.file_storage.admission import UploadAdmission, UploadRejected
+
+
+@pytest.mark.asyncio
+async def test_admission_limits(redis):
+    client_id = uuid4().hex
+    admission = UploadAdmission(
+        redis, max_concurrent_writes=1, client_rate=1000, client_burst=2000
+    )
+
+    async with admission.admit("test", client_id, 1500):
+        # 同时写入的分片数超过限制，立即拒绝
+        with pytest.raises(UploadRejected):
+            async with admission.admit("test", client_id, 1):
+                pass
+    assert admission.writing == 0
+
+    # 令牌桶里只剩500字节，需要等待大约1秒
+    with pytest.raises(UploadRejected) as e:
+        async with admission.admit("test", client_id, 1500):
+            pass
+    assert 0.9 < e.value.retry_after <= 1.0
+
+    # 其它客户端不受影响
+    async with admission.admit("test", uuid4().hex, 1500):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_admission_charges_full_cost(redis):
+    client_id = uuid4().hex
+    admission = UploadAdmission(redis, client_rate=1000, client_burst=1000)
+
+    # 超过桶容量的分片在桶满时可以通过，但按实际大小扣减
+    async with admission.admit("test", client_id, 3000):
+        pass
+    with pytest.raises(UploadRejected) as e:
+        async with admission.admit("test", client_id, 1):
+            pass
+    assert e.value.retry_after == pytest.approx(2.0, abs=0.01)
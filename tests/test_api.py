@@ -1,7 +1,11 @@
 import asyncio
+import gzip
+import hashlib
 import json
 import math
 import os
+import zlib
+from uuid import uuid4
 from httpx_sse import aconnect_sse
 import pytest
 import pytest_asyncio
@@ -13,9 +17,14 @@ from app.core.file_storage.schemas import (
     FileChunkUploadResponse,
     FileUploadTaskCreate,
     FileUploadTaskPublic,
+    FileUploadTaskQueryResult,
     FileChunkUploadRequest,
     FileChunkUploadRetCode,
+    FileUploadMode,
+    FileUploadTaskStatus,
 )
+from app.core.deps import ServiceFactory
+from tests.fakes import use_fake_redis
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,6 +34,7 @@ logger = logging.getLogger(__name__)
 async def app():
     from app.api.fastapi import app
 
+    use_fake_redis(app)
     async with LifespanManager(app) as manager:
         print("We're in!")
         yield manager.app
@@ -38,6 +48,14 @@ async def client(app):
         yield ac
 
 
+async def stored_path(file_name: str) -> Path:
+    from app.api.fastapi import app
+
+    srv = await ServiceFactory(app.deps).file_uploader()
+    path, _, _ = await srv.stored_file(file_name)
+    return path
+
+
 @pytest.mark.asyncio
 async def test_root(client: AsyncClient):
     response = await client.get("/")
@@ -46,9 +64,10 @@ async def test_root(client: AsyncClient):
 
 
 @pytest.mark.asyncio
-async def test_file_upload_task_create(client: AsyncClient):
-    # 创建上传任务
-    file_path = (Path(__file__).parent / "test.txt").absolute()
+async def test_file_upload_task_create(client: AsyncClient, tmp_path: Path):
+    # 创建上传任务，上传的文件在测试时生成
+    file_path = tmp_path / "test.txt"
+    file_path.write_bytes(os.urandom(2500000))
     s = os.stat(file_path)
     task_create = FileUploadTaskCreate(file_name=file_path.stem, file_size=s.st_size)
     response = await client.post(
@@ -59,7 +78,7 @@ async def test_file_upload_task_create(client: AsyncClient):
     assert task.id is not None
     assert task.file_name == file_path.stem
     assert task.file_size == s.st_size
-    assert task.chunk_size == 1 * 1024 * 1024
+    assert 256 * 1024 <= task.chunk_size <= s.st_size
     assert task.total_chunks == math.ceil(s.st_size / task.chunk_size)
     assert task.uploaded_bytes == 0
     assert task.status == "started"
@@ -118,3 +137,821 @@ async def test_file_upload_task_create(client: AsyncClient):
     logger.info("wait for task progress task done")
     await task_progress_task
     logger.info("task progress task done")
+
+
+@pytest.mark.asyncio
+async def test_file_upload_parallel_chunks(client: AsyncClient):
+    # 并行、乱序上传分片
+    content = os.urandom(3 * 1024 * 1024 + 123)
+    task_create = FileUploadTaskCreate(
+        file_name=f"parallel_{os.getpid()}.bin",
+        file_size=len(content),
+        mode=FileUploadMode.PARALLEL,
+        chunk_size_hint=1024 * 1024,
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    assert response.status_code == 200
+    task = FileUploadTaskPublic.model_validate(response.json())
+    assert task.mode == FileUploadMode.PARALLEL
+    assert task.total_chunks == 4
+
+    async def upload(chunk_idx: int) -> FileChunkUploadResponse:
+        pos = chunk_idx * task.chunk_size
+        response = await client.post(
+            "/file/upload/chunk",
+            data={"id": str(task.id), "chunk_idx": chunk_idx},
+            files=[("chunk", ("chunk", content[pos : pos + task.chunk_size]))],
+        )
+        assert response.status_code == 200
+        return FileChunkUploadResponse.model_validate(response.json())
+
+    rsps = await asyncio.gather(
+        *[upload(chunk_idx) for chunk_idx in reversed(range(task.total_chunks))]
+    )
+    assert all(rsp.success for rsp in rsps)
+    codes = [rsp.code for rsp in rsps]
+    assert codes.count(FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED) == 1
+
+    # 重复上传已完成任务的分片
+    rsp = await upload(0)
+    assert rsp.success is False
+    assert rsp.code == FileChunkUploadRetCode.TASK_ALREADY_FINISHED
+
+    assert (await stored_path(task.file_name)).read_bytes() == content
+
+
+@pytest.mark.asyncio
+async def test_file_upload_chunk_size_checked(client: AsyncClient):
+    # multipart分片的大小也要和任务期望的一致，不能写到下一个分片的范围里
+    content = os.urandom(3 * 512 * 1024)
+    task_create = FileUploadTaskCreate(
+        file_name=f"oversize_{os.getpid()}.bin",
+        file_size=len(content),
+        mode=FileUploadMode.PARALLEL,
+        chunk_size_hint=512 * 1024,
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    assert task.total_chunks == 3
+
+    async def upload(chunk_idx: int, chunk: bytes) -> FileChunkUploadResponse:
+        response = await client.post(
+            "/file/upload/chunk",
+            data={"id": str(task.id), "chunk_idx": chunk_idx},
+            files=[("chunk", ("chunk", chunk))],
+        )
+        return FileChunkUploadResponse.model_validate(response.json())
+
+    # 超大的分片（落盘的和在内存里的）、不完整的分片
+    for chunk_idx, chunk in [
+        (0, content),
+        (1, content[: task.chunk_size + 10]),
+        (2, content[:10]),
+    ]:
+        rsp = await upload(chunk_idx, chunk)
+        assert rsp.success is False
+        assert rsp.code == FileChunkUploadRetCode.CHUNK_SIZE_WRONG
+
+    for chunk_idx in range(task.total_chunks):
+        pos = chunk_idx * task.chunk_size
+        rsp = await upload(chunk_idx, content[pos : pos + task.chunk_size])
+        assert rsp.success is True
+    assert rsp.code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    response = await client.post("/file/upload/get_tasks", json=[str(task.id)])
+    assert response.json()[0]["task"]["uploaded_bytes"] == len(content)
+    assert (await stored_path(task.file_name)).read_bytes() == content
+
+
+@pytest.mark.asyncio
+async def test_file_upload_reverse_order_rolled_chunks(client: AsyncClient, monkeypatch):
+    # 超过1MB的multipart分片会被starlette落盘，用copy_file_range拷贝到各自的偏移；
+    # 分片倒序到达时摘要需要重新读取整个文件计算
+    from app.core.file_storage.file_io import ChunkFileWriter
+
+    copies = []
+    copy_from = ChunkFileWriter.copy_from
+
+    async def counting_copy_from(self, path, offset, src_fd, src_offset, count):
+        copies.append((offset, count))
+        return await copy_from(self, path, offset, src_fd, src_offset, count)
+
+    monkeypatch.setattr(ChunkFileWriter, "copy_from", counting_copy_from)
+
+    content = os.urandom(2 * 2 * 1024 * 1024 + 1234)
+    digest = hashlib.sha256(content).hexdigest()
+    task_create = FileUploadTaskCreate(
+        file_name=f"reverse_{os.getpid()}.bin",
+        file_size=len(content),
+        mode=FileUploadMode.PARALLEL,
+        digest=digest,
+        chunk_size_hint=2 * 1024 * 1024,
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    assert task.total_chunks == 3
+
+    async def upload(chunk_idx: int, chunk: bytes) -> FileChunkUploadResponse:
+        response = await client.post(
+            "/file/upload/chunk",
+            data={"id": str(task.id), "chunk_idx": chunk_idx},
+            files=[("chunk", ("chunk", chunk))],
+        )
+        return FileChunkUploadResponse.model_validate(response.json())
+
+    # 落盘的分片大小不对时在拷贝之前拒绝
+    rsp = await upload(1, content[: task.chunk_size + 10])
+    assert rsp.code == FileChunkUploadRetCode.CHUNK_SIZE_WRONG
+    assert copies == []
+
+    for chunk_idx in reversed(range(task.total_chunks)):
+        pos = chunk_idx * task.chunk_size
+        rsp = await upload(chunk_idx, content[pos : pos + task.chunk_size])
+        assert rsp.success is True
+    assert rsp.code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    # 最后一个分片不到1MB，留在内存里按流写入
+    assert copies == [(task.chunk_size, task.chunk_size), (0, task.chunk_size)]
+
+    response = await client.post("/file/upload/get_tasks", json=[str(task.id)])
+    assert response.json()[0]["task"]["digest"] == digest
+    stored = await stored_path(task.file_name)
+    assert stored.read_bytes() == content
+    assert hashlib.sha256(stored.read_bytes()).hexdigest() == digest
+
+
+@pytest.mark.asyncio
+async def test_file_upload_finalize_failure_fails_task(client: AsyncClient, monkeypatch):
+    # 所有分片都收到之后存储失败，任务标记为失败，不会一直处于上传中
+    from app.core.file_storage.file_upload import FileChunkUploader
+
+    async def broken_storage_file(self, task):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(FileChunkUploader, "_storage_file", broken_storage_file)
+    content = os.urandom(1000)
+    task_create = FileUploadTaskCreate(
+        file_name=f"finalize_{os.getpid()}.bin", file_size=len(content)
+    )
+    response = await client.post("/file/upload/create_task", json=task_create.model_dump())
+    task = FileUploadTaskPublic.model_validate(response.json())
+    response = await client.post(
+        "/file/upload/chunk",
+        data={"id": str(task.id), "chunk_idx": 0},
+        files=[("chunk", ("chunk", content))],
+    )
+    resp = FileChunkUploadResponse.model_validate(response.json())
+    assert resp.code == FileChunkUploadRetCode.INTERNAL_ERROR
+
+    response = await client.post("/file/upload/get_tasks", json=[str(task.id)])
+    assert response.json()[0]["task"]["status"] == FileUploadTaskStatus.FAILED
+    response = await client.post(
+        "/file/upload/chunk",
+        data={"id": str(task.id), "chunk_idx": 0},
+        files=[("chunk", ("chunk", content))],
+    )
+    assert response.json()["code"] == FileChunkUploadRetCode.TASK_FAILED
+
+
+@pytest.mark.asyncio
+async def test_file_upload_cancelled_chunk_released(client: AsyncClient):
+    # 客户端断开时释放分片，分片可以立即重新上传
+    content = os.urandom(2 * 1024 * 1024)
+    task_create = FileUploadTaskCreate(
+        file_name=f"cancel_{os.getpid()}.bin",
+        file_size=len(content),
+        mode=FileUploadMode.PARALLEL,
+        chunk_size_hint=1024 * 1024,
+    )
+    response = await client.post("/file/upload/create_task", json=task_create.model_dump())
+    task = FileUploadTaskPublic.model_validate(response.json())
+    from app.api.fastapi import app
+
+    srv = await ServiceFactory(app.deps).file_uploader()
+
+    started = asyncio.Event()
+
+    async def stalled_stream():
+        yield content[:1024]
+        started.set()
+        await asyncio.Event().wait()
+
+    upload = asyncio.create_task(
+        srv.upload_chunk_stream(task.id, 0, stalled_stream(), task.chunk_size)
+    )
+    await started.wait()
+    upload.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await upload
+
+    response = await client.put(
+        f"/file/upload/{task.id}/chunks/0",
+        content=content[: task.chunk_size],
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    resp = FileChunkUploadResponse.model_validate(response.json())
+    assert resp.success is True
+
+
+@pytest.mark.asyncio
+async def test_file_upload_dedup_by_digest(client: AsyncClient):
+    # 上传一次之后，相同摘要的文件可以秒传
+    content = os.urandom(1024 * 1024 + 321)
+    digest = hashlib.sha256(content).hexdigest()
+    task_create = FileUploadTaskCreate(
+        file_name=f"dedup_{os.getpid()}_1.bin", file_size=len(content), digest=digest
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    assert task.status == FileUploadTaskStatus.STARTED
+    for chunk_idx in range(task.total_chunks):
+        pos = chunk_idx * task.chunk_size
+        response = await client.post(
+            "/file/upload/chunk",
+            data={"id": str(task.id), "chunk_idx": chunk_idx},
+            files=[("chunk", ("chunk", content[pos : pos + task.chunk_size]))],
+        )
+        resp = FileChunkUploadResponse.model_validate(response.json())
+        assert resp.success is True
+
+    task_create.file_name = f"dedup_{os.getpid()}_2.bin"
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    assert task.status == FileUploadTaskStatus.FINISHED
+    assert task.uploaded_bytes == len(content)
+    assert task.digest == digest
+
+    first = await stored_path(f"dedup_{os.getpid()}_1.bin")
+    second = await stored_path(f"dedup_{os.getpid()}_2.bin")
+    assert second.read_bytes() == content
+    assert first.stat().st_ino == second.stat().st_ino
+
+
+@pytest.mark.asyncio
+async def test_file_upload_same_content_concurrently(client: AsyncClient):
+    # 相同内容的两个上传同时完成，共用同一个blob
+    content = os.urandom(1000)
+    names = [f"same_{os.getpid()}_{i}.bin" for i in range(2)]
+    tasks = []
+    for name in names:
+        response = await client.post(
+            "/file/upload/create_task",
+            json=FileUploadTaskCreate(file_name=name, file_size=len(content)).model_dump(),
+        )
+        tasks.append(FileUploadTaskPublic.model_validate(response.json()))
+
+    responses = await asyncio.gather(
+        *[
+            client.post(
+                "/file/upload/chunk",
+                data={"id": str(task.id), "chunk_idx": 0},
+                files=[("chunk", ("chunk", content))],
+            )
+            for task in tasks
+        ]
+    )
+    assert all(response.json()["success"] for response in responses)
+    first, second = [await stored_path(name) for name in names]
+    assert first.read_bytes() == second.read_bytes() == content
+    assert first.stat().st_ino == second.stat().st_ino
+
+
+@pytest.mark.asyncio
+async def test_file_upload_digest_mismatch(client: AsyncClient):
+    content = os.urandom(1000)
+    task_create = FileUploadTaskCreate(
+        file_name=f"mismatch_{os.getpid()}.bin",
+        file_size=len(content),
+        digest=hashlib.sha256(b"other").hexdigest(),
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    response = await client.post(
+        "/file/upload/chunk",
+        data={"id": str(task.id), "chunk_idx": 0},
+        files=[("chunk", ("chunk", content))],
+    )
+    resp = FileChunkUploadResponse.model_validate(response.json())
+    assert resp.success is False
+    assert resp.code == FileChunkUploadRetCode.DIGEST_MISMATCH
+
+
+@pytest.mark.asyncio
+async def test_file_upload_raw_chunk_stream(client: AsyncClient):
+    # 原始请求体上传分片，不经过multipart解析
+    content = os.urandom(1024 * 1024 + 4321)
+    task_create = FileUploadTaskCreate(
+        file_name=f"raw_{os.getpid()}.bin", file_size=len(content)
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    headers = {"Content-Type": "application/octet-stream"}
+
+    # 分片大小不对
+    response = await client.put(
+        f"/file/upload/{task.id}/chunks/0", content=content[:100], headers=headers
+    )
+    resp = FileChunkUploadResponse.model_validate(response.json())
+    assert resp.success is False
+    assert resp.code == FileChunkUploadRetCode.CHUNK_SIZE_WRONG
+
+    # Content-Length格式不对
+    for content_length in ("abc", "-1"):
+        response = await client.put(
+            f"/file/upload/{task.id}/chunks/0",
+            content=content[:100],
+            headers={**headers, "Content-Length": content_length},
+        )
+        assert response.status_code == 400
+
+    for chunk_idx in range(task.total_chunks):
+        pos = chunk_idx * task.chunk_size
+        response = await client.put(
+            f"/file/upload/{task.id}/chunks/{chunk_idx}",
+            content=content[pos : pos + task.chunk_size],
+            headers=headers,
+        )
+        assert response.status_code == 200
+        resp = FileChunkUploadResponse.model_validate(response.json())
+        assert resp.success is True
+        assert resp.nxt_chunk_idx == chunk_idx + 1
+
+    assert resp.code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    assert (await stored_path(task.file_name)).read_bytes() == content
+
+
+@pytest.mark.asyncio
+async def test_file_upload_batch_tasks(client: AsyncClient):
+    # 批量创建任务，批量查询的结果和请求顺序一致，不存在的任务也有对应的结果
+    tasks_create = [
+        FileUploadTaskCreate(file_name=f"batch_{os.getpid()}_{i}.bin", file_size=i + 1)
+        for i in range(3)
+    ]
+    response = await client.post(
+        "/file/upload/create_tasks",
+        json=[task_create.model_dump() for task_create in tasks_create],
+    )
+    tasks = [FileUploadTaskPublic.model_validate(t) for t in response.json()]
+    assert [task.file_name for task in tasks] == [t.file_name for t in tasks_create]
+
+    missing = "00000000-0000-0000-0000-000000000000"
+    task_ids = [str(tasks[2].id), missing, str(tasks[0].id)]
+    response = await client.post("/file/upload/get_tasks", json=task_ids)
+    results = [FileUploadTaskQueryResult.model_validate(r) for r in response.json()]
+    assert [str(r.id) for r in results] == task_ids
+    assert [r.found for r in results] == [True, False, True]
+    assert results[0].task.file_size == 3
+    assert results[1].task is None
+    assert results[2].task.status == FileUploadTaskStatus.STARTED
+
+    # 超过最大文件大小的任务整批拒绝，不创建任何文件
+    tasks_create[0].file_size = 2**62
+    response = await client.post(
+        "/file/upload/create_tasks",
+        json=[task_create.model_dump() for task_create in tasks_create],
+    )
+    assert response.status_code == 413
+    response = await client.post(
+        "/file/upload/create_task", json=tasks_create[0].model_dump()
+    )
+    assert response.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_file_upload_single_request(client: AsyncClient):
+    # 小文件一次请求上传完，超过大小限制的文件需要分片上传
+    content = os.urandom(1000)
+    response = await client.post(
+        "/file/upload",
+        data={"file_name": f"single_{os.getpid()}.bin"},
+        files=[("file", ("file", content))],
+    )
+    resp = FileChunkUploadResponse.model_validate(response.json())
+    assert resp.success is True
+    assert resp.code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    stored = await stored_path(f"single_{os.getpid()}.bin")
+    assert stored.read_bytes() == content
+    # 按哈希前缀分片存放：<bucket>/ab/cd/<id>
+    assert stored.parent.parent.parent == Path("/tmp/file_upload/storage/test")
+
+    response = await client.post(
+        "/file/upload",
+        data={"file_name": f"single_{os.getpid()}_big.bin"},
+        files=[("file", ("file", os.urandom(2 * 1024 * 1024)))],
+    )
+    assert response.status_code == 413
+
+    response = await client.post(
+        "/file/upload",
+        data={"file_name": f"single_{os.getpid()}_empty.bin"},
+        files=[("file", ("file", b""))],
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_file_upload_progress_batch(client: AsyncClient):
+    # 默认每个事件是一个任务的进度，batch=true时是各个任务最新进度组成的数组
+    task_ids = []
+    for i in range(2):
+        content = os.urandom(1000)
+        response = await client.post(
+            "/file/upload/create_task",
+            json=FileUploadTaskCreate(
+                file_name=f"progress_batch_{i}_{os.getpid()}.bin", file_size=len(content)
+            ).model_dump(),
+        )
+        task = FileUploadTaskPublic.model_validate(response.json())
+        response = await client.put(f"/file/upload/{task.id}/chunks/0", content=content)
+        assert response.json()["code"] == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+        task_ids.append(str(task.id))
+
+    async def events(url: str) -> list:
+        async with aconnect_sse(client, "POST", url, json=task_ids) as event_source:
+            return [json.loads(sse.data) async for sse in event_source.aiter_sse()]
+
+    # 任务都已经完成，收到最后的进度后关闭
+    progresses = [json.loads(data) for data in await events("/file/upload/progress")]
+    assert {p["id"] for p in progresses} == set(task_ids)
+    assert all(p["status"] == FileUploadTaskStatus.FINISHED for p in progresses)
+
+    batches = await events("/file/upload/progress?batch=true")
+    assert all(isinstance(batch, list) for batch in batches)
+    assert {p["id"] for batch in batches for p in batch} == set(task_ids)
+
+
+@pytest.mark.asyncio
+async def test_file_download(client: AsyncClient):
+    # 下载已经存储的文件，支持Range、多个Range和ETag
+    content = os.urandom(1000)
+    file_name = f"download_{os.getpid()}.bin"
+    response = await client.post(
+        "/file/upload",
+        data={"file_name": file_name},
+        files=[("file", ("file", content))],
+    )
+    assert response.json()["success"] is True
+
+    response = await client.get(f"/file/test/{file_name}")
+    assert response.status_code == 200
+    assert response.content == content
+    assert response.headers["etag"] == f'"{hashlib.sha256(content).hexdigest()}"'
+    assert "last-modified" in response.headers
+
+    response = await client.get(
+        f"/file/test/{file_name}",
+        headers={"If-None-Match": response.headers["etag"]},
+    )
+    assert response.status_code == 304
+
+    response = await client.get(
+        f"/file/test/{file_name}", headers={"Range": "bytes=100-199"}
+    )
+    assert response.status_code == 206
+    assert response.content == content[100:200]
+
+    response = await client.get(
+        f"/file/test/{file_name}", headers={"Range": "bytes=0-9,500-509"}
+    )
+    assert response.status_code == 206
+    assert response.headers["content-type"].startswith("multipart/byteranges")
+    assert content[500:510] in response.content
+
+    response = await client.get(f"/file/test/not_exist_{os.getpid()}.bin")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_file_download_pathsend(app, client: AsyncClient):
+    # 服务器支持http.response.pathsend时整个文件交给服务器按路径发送
+    content = os.urandom(1000)
+    file_name = f"pathsend_{os.getpid()}.bin"
+    response = await client.post(
+        "/file/upload",
+        data={"file_name": file_name},
+        files=[("file", ("file", content))],
+    )
+    assert response.json()["success"] is True
+
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": f"/file/test/{file_name}",
+        "raw_path": f"/file/test/{file_name}".encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"test")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("test", 80),
+        "extensions": {"http.response.pathsend": {}},
+        "state": {},
+    }
+    await app(scope, receive, send)
+    assert messages[0]["status"] == 200
+    assert messages[-1]["type"] == "http.response.pathsend"
+    assert Path(messages[-1]["path"]).read_bytes() == content
+    assert Path(messages[-1]["path"]) == await stored_path(file_name)
+
+
+@pytest.mark.asyncio
+async def test_file_upload_gzip_chunks(client: AsyncClient):
+    # 压缩的分片按解压后的偏移写入，进度和摘要按原始文件计算
+    content = os.urandom(16).hex().encode() + b"".join(
+        f"{i},line,{i * i}\n".encode() for i in range(200000)
+    )
+    task_create = FileUploadTaskCreate(
+        file_name=f"gzip_{os.getpid()}.csv",
+        file_size=len(content),
+        digest=hashlib.sha256(content).hexdigest(),
+        chunk_size_hint=1024 * 1024,
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    assert task.total_chunks > 2
+
+    # 损坏的压缩数据
+    response = await client.put(
+        f"/file/upload/{task.id}/chunks/0",
+        content=gzip.compress(content[: task.chunk_size])[:-20],
+        headers={"Content-Encoding": "gzip"},
+    )
+    resp = FileChunkUploadResponse.model_validate(response.json())
+    assert resp.code == FileChunkUploadRetCode.CHUNK_DECODE_FAILED
+
+    for chunk_idx in range(task.total_chunks):
+        chunk = gzip.compress(
+            content[chunk_idx * task.chunk_size : (chunk_idx + 1) * task.chunk_size]
+        )
+        if chunk_idx % 2:
+            response = await client.put(
+                f"/file/upload/{task.id}/chunks/{chunk_idx}",
+                content=chunk,
+                headers={"Content-Encoding": "gzip"},
+            )
+        else:
+            response = await client.post(
+                "/file/upload/chunk",
+                data={
+                    "id": str(task.id),
+                    "chunk_idx": chunk_idx,
+                    "content_encoding": "gzip",
+                },
+                files=[("chunk", ("chunk", chunk))],
+            )
+        resp = FileChunkUploadResponse.model_validate(response.json())
+        assert resp.success is True
+
+    assert resp.code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    assert (await stored_path(task.file_name)).read_bytes() == content
+
+    response = await client.put(
+        f"/file/upload/{task.id}/chunks/0",
+        content=b"x",
+        headers={"Content-Encoding": "br"},
+    )
+    assert response.status_code == 415
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+async def test_file_upload_decompression_bomb(client: AsyncClient, encoding: str):
+    # 一小段压缩数据展开后超过分片大小，边解压边检查，不会全部解压到内存里
+    if encoding == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+        compress = zstandard.ZstdCompressor().compress
+    else:
+        compress = gzip.compress
+    task_create = FileUploadTaskCreate(
+        file_name=f"bomb_{encoding}_{os.getpid()}.bin",
+        file_size=3 * 256 * 1024,
+        chunk_size_hint=256 * 1024,
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    bomb = compress(bytes(64 * 1024 * 1024))
+    assert len(bomb) < 1024 * 1024
+
+    response = await client.put(
+        f"/file/upload/{task.id}/chunks/0",
+        content=bomb,
+        headers={"Content-Encoding": encoding},
+    )
+    resp = FileChunkUploadResponse.model_validate(response.json())
+    assert resp.code == FileChunkUploadRetCode.CHUNK_SIZE_WRONG
+
+
+@pytest.mark.asyncio
+async def test_file_upload_chunk_checksum(client: AsyncClient):
+    # 校验和不对的分片单独重传，完成时用分片的CRC合并校验整个文件
+    content = os.urandom(5 * 256 * 1024 + 1000)
+    task_create = FileUploadTaskCreate(
+        file_name=f"crc_{os.getpid()}.bin",
+        file_size=len(content),
+        mode=FileUploadMode.PARALLEL,
+        checksum=f"crc32:{zlib.crc32(content):08x}",
+        chunk_size_hint=256 * 1024,
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+    assert task.total_chunks == 6
+
+    def chunk(chunk_idx: int) -> bytes:
+        return content[chunk_idx * task.chunk_size : (chunk_idx + 1) * task.chunk_size]
+
+    corrupted = bytearray(chunk(1))
+    corrupted[100] ^= 0xFF
+    response = await client.put(
+        f"/file/upload/{task.id}/chunks/1",
+        content=bytes(corrupted),
+        headers={"X-Chunk-Checksum": f"crc32:{zlib.crc32(chunk(1)):08x}"},
+    )
+    resp = FileChunkUploadResponse.model_validate(response.json())
+    assert resp.success is False
+    assert resp.code == FileChunkUploadRetCode.CHUNK_CHECKSUM_MISMATCH
+
+    for chunk_idx in range(task.total_chunks):
+        # 第0个分片不带校验和，服务端也会计算CRC用于合并
+        checksum = f"crc32:{zlib.crc32(chunk(chunk_idx)):08x}" if chunk_idx else None
+        response = await client.post(
+            "/file/upload/chunk",
+            data={"id": str(task.id), "chunk_idx": chunk_idx}
+            | ({"checksum": checksum} if checksum else {}),
+            files=[("chunk", ("chunk", chunk(chunk_idx)))],
+        )
+        resp = FileChunkUploadResponse.model_validate(response.json())
+        assert resp.success is True
+
+    assert resp.code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    assert (await stored_path(task.file_name)).read_bytes() == content
+
+
+@pytest.mark.asyncio
+async def test_file_upload_rejected_chunk_resets_digest(client: AsyncClient):
+    # 被拒绝的分片重传到了其它进程，这个进程之后收到的分片不能接着算增量摘要
+    from app.api.fastapi import app
+    from app.core.file_storage.digest import IncrementalDigests
+
+    content = os.urandom(5 * 256 * 1024 + 1000)
+    task_create = FileUploadTaskCreate(
+        file_name=f"digest_retry_{os.getpid()}.bin",
+        file_size=len(content),
+        digest=hashlib.sha256(content).hexdigest(),
+        chunk_size_hint=256 * 1024,
+    )
+    response = await client.post(
+        "/file/upload/create_task", json=task_create.model_dump()
+    )
+    task = FileUploadTaskPublic.model_validate(response.json())
+
+    def chunk(chunk_idx: int) -> bytes:
+        return content[chunk_idx * task.chunk_size : (chunk_idx + 1) * task.chunk_size]
+
+    corrupted = bytes(task.chunk_size)
+    response = await client.put(
+        f"/file/upload/{task.id}/chunks/0",
+        content=corrupted,
+        headers={"X-Chunk-Checksum": f"crc32:{zlib.crc32(chunk(0)):08x}"},
+    )
+    assert response.json()["code"] == FileChunkUploadRetCode.CHUNK_CHECKSUM_MISMATCH
+
+    async def stream(data: bytes):
+        yield data
+
+    # 其它进程有自己的增量摘要
+    other = await app.deps.file_uploader(bucket_name="test", digests=IncrementalDigests())
+    resp = await other.upload_chunk_stream(task.id, 0, stream(chunk(0)), len(chunk(0)))
+    assert resp.success is True
+
+    for chunk_idx in range(1, task.total_chunks):
+        response = await client.put(
+            f"/file/upload/{task.id}/chunks/{chunk_idx}", content=chunk(chunk_idx)
+        )
+        resp = FileChunkUploadResponse.model_validate(response.json())
+        assert resp.success is True
+    assert resp.code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    assert (await stored_path(task.file_name)).read_bytes() == content
+
+
+def test_file_upload_progress_ws():
+    from dependency_injector import providers
+    from starlette.testclient import TestClient
+
+    from app.api.fastapi import create_app
+    from app.core.file_storage.file_upload import FileUploadSettings
+    from app.core.file_storage.progress_ws import DELTA
+
+    app = create_app()
+    use_fake_redis(app)
+    app.deps.file_upload_settings.override(
+        providers.Object(FileUploadSettings(progress_ws_max_tasks=2))
+    )
+    with TestClient(app) as client:
+        tasks = [
+            client.post(
+                "/file/upload/create_task",
+                json={"file_name": f"ws_{i}.txt", "file_size": 8},
+            ).json()
+            for i in range(2)
+        ]
+        with client.websocket_connect("/file/upload/progress/ws") as ws:
+            ws.send_json({"op": "watch", "task_ids": [tasks[0]["id"]]})
+            snapshot = ws.receive_json()
+            assert snapshot["type"] == "snapshot"
+            assert [t["index"] for t in snapshot["tasks"]] == [0]
+            assert snapshot["tasks"][0]["task"]["uploaded_bytes"] == 0
+            statuses = snapshot["statuses"]
+
+            # 同一个连接上增加关注的任务，只发送新任务的完整状态
+            ws.send_json({"op": "watch", "task_ids": [tasks[0]["id"], tasks[1]["id"]]})
+            snapshot = ws.receive_json()
+            assert [(t["index"], t["id"]) for t in snapshot["tasks"]] == [(1, tasks[1]["id"])]
+
+            ws.send_json({"op": "unwatch", "task_ids": [tasks[0]["id"]]})
+            for task in tasks:
+                response = client.post(
+                    "/file/upload/chunk",
+                    data={"id": task["id"], "chunk_idx": 0},
+                    files=[("chunk", ("chunk", b"abcdefgh"))],
+                )
+                assert response.json()["success"]
+            frame = ws.receive_bytes()
+            assert len(frame) == DELTA.size
+            index, uploaded_bytes, status = DELTA.unpack(frame)
+            assert (index, uploaded_bytes) == (1, 8)
+            assert statuses[status] == FileUploadTaskStatus.FINISHED.value
+
+            ws.send_json({"op": "bogus"})
+            assert ws.receive_json()["type"] == "error"
+
+            # 无效的命令回复错误，连接继续可用
+            for command in ["not json", "[1, 2]", '{"op": "watch", "task_ids": ["x"]}']:
+                ws.send_text(command)
+                assert ws.receive_json()["type"] == "error"
+            ws.send_bytes(b"\xff")
+            assert ws.receive_json()["type"] == "error"
+
+            # 还在关注1个任务，再关注2个超过了每个连接的上限
+            ws.send_json({"op": "watch", "task_ids": [tasks[0]["id"], str(uuid4())]})
+            error = ws.receive_json()
+            assert error["type"] == "error" and "2" in error["detail"]
+            ws.send_json({"op": "watch", "task_ids": [tasks[0]["id"]]})
+            snapshot = ws.receive_json()
+            assert [(t["index"], t["id"]) for t in snapshot["tasks"]] == [(2, tasks[0]["id"])]
+
+
+def test_client_id_from_trusted_proxy():
+    from dependency_injector import providers
+    from starlette.requests import Request
+
+    from app.api.deps import get_client_id
+    from app.api.fastapi import app
+    from app.core.file_storage.file_upload import FileUploadSettings
+
+    def client_id(host: str) -> str | None:
+        return get_client_id(
+            Request(
+                {
+                    "type": "http",
+                    "app": app,
+                    "client": (host, 1234),
+                    "headers": [(b"x-client-id", b"uploader-1")],
+                }
+            )
+        )
+
+    # 不是可信代理时忽略X-Client-Id，按来源地址区分
+    assert client_id("10.0.0.2") == "10.0.0.2"
+    with app.deps.file_upload_settings.override(
+        providers.Object(FileUploadSettings(trusted_proxies=["10.0.0.1"]))
+    ):
+        assert client_id("10.0.0.1") == "uploader-1"
+        assert client_id("10.0.0.2") == "10.0.0.2"
@@ -0,0 +1,84 @@
+import os
+import zlib
+
+import google_crc32c
+import pytest
+import xxhash
+
+from app.core.file_storage.checksum import (
+    ChunkChecksumAlgorithm,
+    ChunkChecksumMismatch,
+    ChunkHasher,
+    combine_chunk_checksums,
+    supported_checksums,
+)
+
+
+def test_combine_chunk_crc32():
+    chunk_size = 1000
+    content = os.urandom(10 * chunk_size + 123)
+    checksums = [
+        f"crc32:{zlib.crc32(content[pos : pos + chunk_size]):08x}"
+        for pos in range(0, len(content), chunk_size)
+    ]
+    assert (
+        combine_chunk_checksums(checksums, chunk_size, len(content))
+        == f"crc32:{zlib.crc32(content):08x}"
+    )
+    # 分片校验和不全时不能合并
+    checksums[3] = None
+    assert combine_chunk_checksums(checksums, chunk_size, len(content)) is None
+
+
+def test_chunk_hasher_verify():
+    data = os.urandom(1000)
+    hasher = ChunkHasher.from_checksum(f"crc32:{zlib.crc32(data):08x}")
+    hasher.update(data[:500])
+    hasher.update(data[500:])
+    hasher.verify()
+
+    hasher = ChunkHasher.from_checksum(f"crc32:{zlib.crc32(data):08x}")
+    hasher.update(data[:999])
+    with pytest.raises(ChunkChecksumMismatch):
+        hasher.verify()
+
+
+def test_combine_chunk_crc32c():
+    assert supported_checksums() == set(ChunkChecksumAlgorithm)
+    # crc32c的标准测试向量
+    hasher = ChunkHasher(ChunkChecksumAlgorithm.CRC32C)
+    hasher.update(b"123456789")
+    assert hasher.checksum == "crc32c:e3069283"
+
+    chunk_size = 1000
+    content = os.urandom(10 * chunk_size + 123)
+    checksums = [
+        f"crc32c:{google_crc32c.value(content[pos : pos + chunk_size]):08x}"
+        for pos in range(0, len(content), chunk_size)
+    ]
+    assert (
+        combine_chunk_checksums(checksums, chunk_size, len(content))
+        == f"crc32c:{google_crc32c.value(content):08x}"
+    )
+
+
+@pytest.mark.parametrize(
+    "algorithm, digest",
+    [
+        (ChunkChecksumAlgorithm.XXH64, xxhash.xxh64_hexdigest),
+        (ChunkChecksumAlgorithm.XXH3_64, xxhash.xxh3_64_hexdigest),
+    ],
+)
+def test_chunk_hasher_xxhash(algorithm, digest):
+    data = os.urandom(1000)
+    hasher = ChunkHasher.from_checksum(f"{algorithm.value}:{digest(data)}")
+    hasher.update(data[:500])
+    hasher.update(memoryview(data)[500:])
+    hasher.verify()
+    # xxhash不能按分片合并
+    assert combine_chunk_checksums([hasher.checksum], 1000, 1000) is None
+
+    hasher = ChunkHasher.from_checksum(f"{algorithm.value}:{digest(data)}")
+    hasher.update(data[1:])
+    with pytest.raises(ChunkChecksumMismatch):
+        hasher.verify()
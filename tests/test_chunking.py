@@ -0,0 +1,35 @@
+from app.core.file_storage.chunking import ChunkSizePolicy
+
+KB = 1024
+MB = 1024 * 1024
+
+
+def test_small_file_single_chunk():
+    policy = ChunkSizePolicy(single_request_threshold=MB)
+    assert policy.choose(1000) == 1000
+    assert policy.choose(MB, hint=256 * KB) == MB
+
+
+def test_hint_and_throughput():
+    policy = ChunkSizePolicy(min_chunk_size=256 * KB, max_chunk_size=64 * MB)
+    assert policy.choose(100 * MB) == MB
+    assert policy.choose(100 * MB, hint=8 * MB) == 8 * MB
+    # 提示的分片大小优先于吞吐量
+    assert policy.choose(100 * MB, hint=8 * MB, throughput=MB) == 8 * MB
+    # 每个分片大约上传2秒
+    assert policy.choose(100 * MB, throughput=4 * MB) == 8 * MB
+
+
+def test_bounds():
+    policy = ChunkSizePolicy(
+        min_chunk_size=256 * KB, max_chunk_size=64 * MB, max_chunks=10000
+    )
+    assert policy.choose(100 * MB, hint=1) == 256 * KB
+    assert policy.choose(1024 * MB, hint=1024 * MB) == 64 * MB
+    # 按min_chunk_size对齐
+    assert policy.choose(100 * MB, hint=300 * KB) == 256 * KB
+    # 分片数不超过max_chunks
+    file_size = 20 * 1024 * MB
+    chunk_size = policy.choose(file_size)
+    assert file_size / chunk_size <= 10000
+    assert chunk_size % (256 * KB) == 0
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from app.core.docker.image import ImageSpec
+from app.core.docker.pool import ContainerPoolTimeout, DockerContainerPool
+
+
+class _Container:
+    def __init__(self, n: int):
+        self.short_id = f"c{n}"
+        self.running = True
+
+
+class _LocalPool(DockerContainerPool):
+    """
+    不连接docker，只验证池的名额和等待者的处理
+    """
+
+    def __init__(self, fail_creates: int = 0, **kwargs):
+        super().__init__(None, ImageSpec(image="python:3.11-slim"), **kwargs)
+        self.created = 0
+        self.destroyed = 0
+        self._fail_creates = fail_creates
+
+    async def _create_container(self):
+        await asyncio.sleep(0.01)
+        if self._fail_creates:
+            self._fail_creates -= 1
+            raise RuntimeError("create failed")
+        self.created += 1
+        return _Container(self.created)
+
+    @staticmethod
+    async def _is_running(c) -> bool:
+        return c.running
+
+    async def _destroy(self, c):
+        self.destroyed += 1
+
+    async def _remove_all_labeled(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_pool_max_size_and_fifo_waiters():
+    pool = _LocalPool(max_size=2, min_idle=1, acquire_timeout=1)
+    await pool.start()
+    assert (pool.size, pool.idle) == (1, 1)
+
+    order = []
+    release = asyncio.Event()
+
+    async def use(i: int):
+        async with pool.get_container() as c:
+            order.append((i, c.short_id))
+            await release.wait()
+
+    holders = [asyncio.create_task(use(i)) for i in range(2)]
+    await asyncio.sleep(0.05)
+    # 达到上限后按到达顺序排队
+    waiters = []
+    for i in range(2, 5):
+        waiters.append(asyncio.create_task(use(i)))
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.05)
+    assert (pool.size, pool.waiting) == (2, 3)
+
+    release.set()
+    await asyncio.gather(*holders, *waiters)
+    assert [i for i, _ in order] == [0, 1, 2, 3, 4]
+    assert pool.created == 2
+    assert (pool.size, pool.idle, pool.waiting) == (2, 2, 0)
+    await pool.close()
+    assert pool.size == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_acquire_timeout():
+    pool = _LocalPool(max_size=1, acquire_timeout=0.05)
+    async with pool.get_container():
+        with pytest.raises(ContainerPoolTimeout):
+            async with pool.get_container():
+                pass
+        assert pool.waiting == 0
+    # 超时的等待者不影响之后的获取
+    async with pool.get_container():
+        pass
+    assert pool.created == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_create_failure_releases_slot():
+    pool = _LocalPool(fail_creates=1, max_size=1, acquire_timeout=1)
+    with pytest.raises(RuntimeError):
+        async with pool.get_container():
+            pass
+    assert pool.size == 0
+
+    # 等待者拿到名额后创建失败，名额交给下一个等待者
+    pool = _LocalPool(max_size=1, acquire_timeout=1)
+    release = asyncio.Event()
+
+    async def hold():
+        async with pool.get_container() as c:
+            await release.wait()
+            # 归还时容器已经停止，销毁后名额交给等待者
+            c.running = False
+
+    async def use():
+        async with pool.get_container() as c:
+            return c.short_id
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0.05)
+    waiters = [asyncio.create_task(use()) for _ in range(2)]
+    await asyncio.sleep(0)
+    pool._fail_creates = 1
+    release.set()
+    results = await asyncio.gather(holder, *waiters, return_exceptions=True)
+    assert isinstance(results[1], RuntimeError)
+    assert results[2] == "c2"
+    assert (pool.size, pool.destroyed) == (1, 1)
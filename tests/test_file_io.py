@@ -0,0 +1,49 @@
+import asyncio
+import os
+
+import pytest
+
+from app.core.file_storage.file_io import ChunkFileWriter
+
+
+@pytest.mark.asyncio
+async def test_coalesced_writes(tmp_path):
+    writer = ChunkFileWriter(io_workers=2)
+    path = tmp_path / "coalesced.bin"
+    content = os.urandom(10 * 1000)
+    await writer.preallocate(path, 100 + len(content))
+
+    batch = writer.coalesce(path, 100, 4000)
+    written = []
+    for pos in range(0, len(content), 1000):
+        written.append(await batch.write(content[pos : pos + 1000]))
+    written.append(await batch.flush())
+    # 攒够4000字节才落盘一次
+    assert written == [0, 0, 0, 4000, 0, 0, 0, 4000, 0, 0, 2000]
+    await writer.close(path)
+    writer.close_all()
+    assert path.read_bytes() == b"\0" * 100 + content
+
+
+@pytest.mark.asyncio
+async def test_concurrent_writes_exceeding_open_files(tmp_path):
+    # 同时写入的文件数超过max_open_files时，使用中的fd不能淘汰，刚打开的fd也不能被关掉
+    writer = ChunkFileWriter(max_open_files=1, io_workers=4)
+    paths = [tmp_path / f"{i}.bin" for i in range(4)]
+    for path in paths:
+        await writer.preallocate(path, 1000)
+        await writer.close(path)
+
+    await asyncio.gather(*[writer.pwrite(path, 0, os.urandom(1000)) for path in paths])
+    writer.close_all()
+    assert all(path.stat().st_size == 1000 for path in paths)
+
+
+@pytest.mark.asyncio
+async def test_preallocate_failure_removes_file(tmp_path):
+    writer = ChunkFileWriter(io_workers=1)
+    path = tmp_path / "too_large.bin"
+    with pytest.raises(OSError):
+        await writer.preallocate(path, 2**62)
+    assert not path.exists()
+    writer.close_all()
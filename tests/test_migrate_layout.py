@@ -0,0 +1,57 @@
+import hashlib
+import itertools
+import os
+
+import pytest
+
+from app.core.file_storage import migrate_layout
+from app.core.file_storage.layout import paths_key
+from app.core.file_storage.migrate_layout import STAGING_DIR, migrate_bucket
+
+
+def _name_with_id_prefix(prefix: str) -> str:
+    # 找一个sha1以prefix开头的文件名，它的分片目录和名为prefix的文件重名
+    for i in itertools.count():
+        name = f"file_{i}.bin"
+        if hashlib.sha1(name.encode()).hexdigest().startswith(prefix):
+            return name
+
+
+@pytest.mark.asyncio
+async def test_migrate_flat_bucket(redis, tmp_path, monkeypatch):
+    bucket_dir = tmp_path / "bucket"
+    bucket_dir.mkdir()
+    files = {name: os.urandom(16) for name in ["ab", _name_with_id_prefix("ab"), "c.txt"]}
+    for name, content in files.items():
+        (bucket_dir / name).write_bytes(content)
+    (bucket_dir / ".hidden").write_bytes(b"x")
+
+    # 第一批移到暂存目录之后中断
+    rename = os.rename
+    calls = 0
+
+    def crashing_rename(src, dst):
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise OSError("crash")
+        rename(src, dst)
+
+    monkeypatch.setattr(migrate_layout.os, "rename", crashing_rename)
+    with pytest.raises(OSError):
+        await migrate_bucket(redis, tmp_path, "bucket", batch_size=1)
+    monkeypatch.setattr(migrate_layout.os, "rename", rename)
+    assert len(os.listdir(bucket_dir / STAGING_DIR)) == 1
+
+    # 重新执行继续迁移，重复执行没有影响
+    assert await migrate_bucket(redis, tmp_path, "bucket", batch_size=1) == 2
+    assert await migrate_bucket(redis, tmp_path, "bucket") == 0
+    assert not (bucket_dir / STAGING_DIR).exists()
+    assert (bucket_dir / ".hidden").exists()
+
+    paths = await redis.hgetall(paths_key("bucket"))
+    assert paths.keys() == files.keys()
+    for name, content in files.items():
+        file_id = hashlib.sha1(name.encode()).hexdigest()
+        assert paths[name] == f"{file_id[:2]}/{file_id[2:4]}/{file_id}"
+        assert (bucket_dir / paths[name]).read_bytes() == content
@@ -0,0 +1,77 @@
+import json
+import time
+from uuid import uuid4
+
+from app.core.file_storage.metrics import StageTimings, UploadStage
+from app.core.file_storage.progress import ProgressThrottle
+
+
+def test_progress_throttle_by_bytes_and_time():
+    throttle = ProgressThrottle(interval_ms=60 * 1000, step_percent=10.0)
+    task_id = uuid4()
+    file_size = 1000
+
+    # 第一次总是推送
+    assert throttle.should_emit(task_id, 0, file_size)
+    # 进度不足10%且时间未到，不推送
+    assert not throttle.should_emit(task_id, 50, file_size)
+    assert not throttle.should_emit(task_id, 99, file_size)
+    # 进度超过10%，推送
+    assert throttle.should_emit(task_id, 100, file_size)
+    assert not throttle.should_emit(task_id, 150, file_size)
+    # 强制推送
+    assert throttle.should_emit(task_id, 150, file_size, force=True)
+
+    throttle = ProgressThrottle(interval_ms=0, step_percent=100.0)
+    assert throttle.should_emit(task_id, 0, file_size)
+    # 时间间隔为0，每次都推送
+    assert throttle.should_emit(task_id, 1, file_size)
+
+
+def test_progress_throttle_forget_and_evict():
+    throttle = ProgressThrottle(interval_ms=60 * 1000, step_percent=100.0, max_tasks=2)
+    task_ids = [uuid4() for _ in range(3)]
+    for task_id in task_ids:
+        assert throttle.should_emit(task_id, 0, 1000)
+    # 最早的任务被淘汰，再次推送时视为第一次
+    assert throttle.should_emit(task_ids[0], 1, 1000)
+    assert not throttle.should_emit(task_ids[2], 1, 1000)
+
+    throttle.forget(task_ids[2])
+    assert throttle.should_emit(task_ids[2], 1, 1000)
+
+
+def test_stage_timings():
+    timings = StageTimings(enabled=False)
+    with timings.stage(UploadStage.DISK_WRITE):
+        pass
+    assert timings.snapshot()["disk_write"]["count"] == 0
+
+    timings.enabled = True
+    for seconds in (0.0001, 0.003, 0.003, 2.0):
+        timings.observe(UploadStage.DISK_WRITE, seconds)
+    with timings.stage(UploadStage.PUBLISH):
+        pass
+    snapshot = timings.snapshot()
+    assert snapshot["disk_write"]["count"] == 4
+    assert snapshot["disk_write"]["p50"] == 0.005
+    assert snapshot["disk_write"]["p99"] == 2.5
+    assert snapshot["publish"]["count"] == 1
+    text = timings.render_prometheus()
+    assert 'file_upload_stage_seconds_count{stage="disk_write"} 4' in text
+
+    # 超过最大的桶时按最大的有限上界估计，快照可以编码成JSON
+    timings.observe(UploadStage.FINALIZE, 12.0)
+    assert timings.snapshot()["finalize"]["p99"] == 10.0
+    json.dumps(timings.snapshot(), allow_nan=False)
+
+
+def test_stage_timings_nested():
+    # 写入期间推送进度的时间只计入PUBLISH
+    timings = StageTimings(enabled=True, buckets=(0.01, 0.05, 0.1))
+    with timings.stage(UploadStage.DISK_WRITE):
+        with timings.stage(UploadStage.PUBLISH):
+            time.sleep(0.06)
+    snapshot = timings.snapshot()
+    assert snapshot["publish"]["p50"] == 0.1
+    assert snapshot["disk_write"]["p50"] == 0.01
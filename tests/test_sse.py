@@ -0,0 +1,317 @@
+import asyncio
+import json
+from time import perf_counter
+from uuid import uuid4
+
+import pytest
+
+from app.core.pubsub import (
+    InProcessPubSubBackend,
+    PubSubMode,
+    RedisPubSubBackend,
+    SubscriptionHub,
+)
+from app.core.sse import SSEPubSub
+
+
+@pytest.mark.asyncio
+async def test_subscription_hub_fan_out(any_redis):
+    hub = SubscriptionHub(any_redis, queue_size=2)
+    a, b = f"hub_{uuid4().hex}", f"hub_{uuid4().hex}"
+
+    # 同一轮事件循环里的订阅合并成一条命令，共用一个连接
+    sub1, sub2 = await asyncio.gather(hub.subscribe(a), hub.subscribe(a, b))
+    assert hub.channels == 2
+    await any_redis.publish(a, "1")
+    await any_redis.publish(b, "2")
+    assert await asyncio.wait_for(sub1.get(), 1) == (a, None, "1")
+    assert await asyncio.wait_for(sub2.get(), 1) == (a, None, "1")
+    assert await asyncio.wait_for(sub2.get(), 1) == (b, None, "2")
+
+    # 最后一个订阅者取消后才取消订阅频道
+    sub2.close()
+    assert hub.channels == 1
+    # 队列满时丢弃最旧的消息
+    for i in range(3):
+        await any_redis.publish(a, str(i))
+    await asyncio.sleep(0.1)
+    assert sub1.dropped == 1
+    assert await sub1.get() == (a, None, "1")
+    assert await sub1.get() == (a, None, "2")
+
+    sub1.close()
+    assert hub.channels == 0
+    await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_sse_delivery_latency():
+    sse_pubsub = SSEPubSub(InProcessPubSubBackend(), ping_interval=60)
+    channel = f"sse_{uuid4().hex}"
+    events = (await sse_pubsub.subscribe(channel)).body_iterator
+
+    # 收到消息立即推送，不等待轮询间隔
+    for i in range(5):
+        waiting = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0.01)
+        start = perf_counter()
+        await sse_pubsub.publish(channel, f"message {i}")
+        event = await asyncio.wait_for(waiting, 1)
+        assert event.data == json.dumps(f"message {i}")
+        assert perf_counter() - start < 0.05
+
+    await events.aclose()
+    assert sse_pubsub.backend.channels == 0
+    await sse_pubsub.close()
+
+
+@pytest.mark.asyncio
+async def test_sse_stream_replay(any_redis):
+    sse_pubsub = SSEPubSub(
+        RedisPubSubBackend(any_redis, mode=PubSubMode.STREAM, stream_maxlen=10)
+    )
+    a, b = f"sse_{uuid4().hex}", f"sse_{uuid4().hex}"
+    for i in range(3):
+        await sse_pubsub.publish(a, f"a{i}")
+        await sse_pubsub.publish(b, f"b{i}")
+
+    # 新连接每个频道只取最后一条
+    events = await sse_pubsub.backend.snapshot((a, b))
+    assert [(channel, message) for channel, _, message in events] == [(a, "a2"), (b, "b2")]
+
+    # 断线重连，从最后收到的事件之后补发，之后继续推送实时消息
+    last_event_id = (await any_redis.xrange(f"stream_{a}"))[0][0]
+    events = (
+        await sse_pubsub.subscribe(a, b, last_event_id=last_event_id)
+    ).body_iterator
+    received = []
+    while len(received) < 6:
+        event = await asyncio.wait_for(events.__anext__(), 1)
+        received.append(json.loads(event.data))
+        assert event.id
+    # 从last_event_id所在的毫秒开始补发，最后收到的那条也会重复发送
+    assert sorted(received) == ["a0", "a1", "a2", "b0", "b1", "b2"]
+
+    await sse_pubsub.publish(b, "b3")
+    while (event := await asyncio.wait_for(events.__anext__(), 1)).data != json.dumps("b3"):
+        pass
+    assert event.id == (await any_redis.xrevrange(f"stream_{b}", count=1))[0][0]
+
+    await events.aclose()
+    await sse_pubsub.close()
+
+
+@pytest.mark.asyncio
+async def test_in_process_backend():
+    backend = InProcessPubSubBackend(mode=PubSubMode.STREAM, stream_maxlen=2)
+    sub = await backend.subscribe("a", "b")
+    ids = [await backend.publish(channel, f"{channel}{i}") for i in range(3) for channel in "ab"]
+    assert backend.channels == 2
+    assert await sub.get() == ("a", ids[0], "a0")
+
+    # 事件id在进程内全局有序，从last_event_id之后准确补发，每个频道只保留最近stream_maxlen条
+    events = await backend.snapshot(("a", "b"), ids[2])
+    assert [message for _, _, message in events] == ["b1", "a2", "b2"]
+    events = await backend.snapshot(("a", "b"))
+    assert [message for _, _, message in events] == ["a2", "b2"]
+
+    sub.close()
+    assert backend.channels == 0
+
+    # pubsub模式只保留最后一条消息，没有事件id
+    backend = InProcessPubSubBackend()
+    await backend.publish("a", "a0")
+    await backend.publish("a", "a1")
+    assert await backend.snapshot(("a", "b")) == [("a", None, "a1")]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", [PubSubMode.PUBSUB, PubSubMode.STREAM])
+async def test_redis_publish_many(any_redis, mode):
+    backend = RedisPubSubBackend(any_redis, mode=mode, snapshot_ttl=60)
+    channels = [f"batch_{uuid4().hex}" for _ in range(3)]
+    sub = await backend.subscribe(*channels)
+
+    event_ids = await backend.publish_many(
+        [(channel, f"m{i}") for i, channel in enumerate(channels)]
+    )
+    assert len(event_ids) == 3
+    for i, channel in enumerate(channels):
+        assert await asyncio.wait_for(sub.get(), 1) == (channel, event_ids[i], f"m{i}")
+    # 保存的消息带过期时间，每次发布时刷新
+    key = f"prev_{channels[0]}" if mode == PubSubMode.PUBSUB else f"stream_{channels[0]}"
+    assert 0 < await any_redis.ttl(key) <= 60
+
+    sub.close()
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_in_process_snapshot_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("app.core.pubsub.time", lambda: now)
+    backend = InProcessPubSubBackend(snapshot_ttl=10)
+    await backend.publish_many([("a", "a0"), ("b", "b0")])
+    now += 5
+    await backend.publish("a", "a1")
+    now += 6
+    # b超过10秒没有更新，已经过期
+    assert await backend.snapshot(("a", "b")) == [("a", None, "a1")]
+
+
+@pytest.mark.asyncio
+async def test_sse_batched_stream_closes_when_final():
+    sse_pubsub = SSEPubSub(InProcessPubSubBackend())
+
+    def message(channel: str, status: str) -> str:
+        return json.dumps({"channel": channel, "status": status})
+
+    events = (
+        await sse_pubsub.subscribe(
+            "a",
+            "b",
+            "c",
+            batch_interval=0.05,
+            is_final=lambda m: json.loads(m)["status"] == "finished",
+            done=["c"],
+        )
+    ).body_iterator
+    waiting = asyncio.ensure_future(events.__anext__())
+    await asyncio.sleep(0.01)
+
+    # 一个间隔内的更新合并成一个事件，每个频道只保留最新的状态
+    await sse_pubsub.publish("a", message("a", "1"))
+    await sse_pubsub.publish("b", message("b", "1"))
+    await sse_pubsub.publish("a", message("a", "2"))
+    event = await asyncio.wait_for(waiting, 1)
+    assert json.loads(event.data) == [
+        {"channel": "a", "status": "2"},
+        {"channel": "b", "status": "1"},
+    ]
+
+    # 所有频道都结束后流自动关闭
+    await sse_pubsub.publish("a", message("a", "finished"))
+    await sse_pubsub.publish("b", message("b", "finished"))
+    event = await asyncio.wait_for(events.__anext__(), 1)
+    assert len(json.loads(event.data)) == 2
+    with pytest.raises(StopAsyncIteration):
+        await asyncio.wait_for(events.__anext__(), 1)
+    assert sse_pubsub.backend.channels == 0
+
+
+@pytest.mark.asyncio
+async def test_sse_batched_stream_keeps_final_messages():
+    # 队列长度小于频道数，按频道合并后一个间隔内的最终消息也不会被丢弃
+    sse_pubsub = SSEPubSub(InProcessPubSubBackend(queue_size=2))
+    channels = [f"batch_{i}" for i in range(10)]
+    events = (
+        await sse_pubsub.subscribe(
+            *channels,
+            batch_interval=0.05,
+            is_final=lambda m: m == '"finished"',
+        )
+    ).body_iterator
+    waiting = asyncio.ensure_future(events.__anext__())
+    await asyncio.sleep(0.01)
+
+    for status in ("1", "2", "finished"):
+        await sse_pubsub.publish_many([(channel, json.dumps(status)) for channel in channels])
+    event = await asyncio.wait_for(waiting, 1)
+    assert json.loads(event.data) == ["finished"] * len(channels)
+    with pytest.raises(StopAsyncIteration):
+        await asyncio.wait_for(events.__anext__(), 1)
+    assert sse_pubsub.backend.channels == 0
+
+
+@pytest.mark.asyncio
+async def test_subscription_coalesce():
+    backend = InProcessPubSubBackend(queue_size=1)
+    sub = await backend.subscribe("a", "b", coalesce=True)
+    for i in range(3):
+        await backend.publish("a", f"a{i}")
+        await backend.publish("b", f"b{i}")
+    # 每个频道只保留最新的消息，按频道第一次到达的顺序取出
+    assert sub.dropped == 0
+    assert await sub.get() == ("a", None, "a2")
+    await backend.publish("a", "a3")
+    assert sub.drain() == [("b", None, "b2"), ("a", None, "a3")]
+    sub.close()
+
+
+class _FailingPubSub:
+    async def subscribe(self, *channels):
+        raise ConnectionError("subscribe failed")
+
+    async def unsubscribe(self, *channels):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_subscription_hub_rolls_back_failed_attach(redis, monkeypatch):
+    hub = SubscriptionHub(redis)
+    monkeypatch.setattr(redis, "pubsub", _FailingPubSub)
+    # SUBSCRIBE失败时撤销订阅者，不留下没有人读取的队列
+    with pytest.raises(ConnectionError):
+        await hub.subscribe("failing")
+    assert hub.channels == 0
+
+    # SSE订阅失败时异常传给响应，不泄漏订阅
+    sse_pubsub = SSEPubSub(RedisPubSubBackend(redis), ping_interval=60)
+    events = (await sse_pubsub.subscribe("failing")).body_iterator
+    with pytest.raises(ConnectionError):
+        await events.__anext__()
+    assert sse_pubsub._backend.channels == 0
+    await sse_pubsub.close()
+    await hub.close()
+
+
+class _FlakyPubSub:
+    """
+    第一次SUBSCRIBE等到fail被设置后失败，之后的命令都成功
+    """
+
+    def __init__(self):
+        self.fail = asyncio.Event()
+        self.subscribed: list[tuple[str, ...]] = []
+
+    async def subscribe(self, *channels):
+        if not self.subscribed:
+            self.subscribed.append(())
+            await self.fail.wait()
+            raise ConnectionError("subscribe failed")
+        self.subscribed.append(channels)
+
+    async def unsubscribe(self, *channels):
+        pass
+
+    async def get_message(self, **kwargs):
+        await asyncio.Event().wait()
+
+    async def aclose(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_subscription_hub_resubscribes_after_failed_flush(redis, monkeypatch):
+    hub = SubscriptionHub(redis)
+    pubsub = _FlakyPubSub()
+    monkeypatch.setattr(redis, "pubsub", lambda: pubsub)
+
+    # A的SUBSCRIBE还没有返回时B订阅同一个频道
+    a = asyncio.create_task(hub.subscribe("flaky"))
+    await asyncio.sleep(0.01)
+    b = asyncio.create_task(hub.subscribe("flaky"))
+    await asyncio.sleep(0.01)
+    pubsub.fail.set()
+
+    # A失败并撤销，B的flush重新发出SUBSCRIBE
+    with pytest.raises(ConnectionError):
+        await a
+    sub = await asyncio.wait_for(b, 1)
+    assert pubsub.subscribed[-1] == ("flaky",)
+    assert hub.channels == 1
+    sub.close()
+    await hub.close()
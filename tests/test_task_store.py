@@ -0,0 +1,120 @@
+from pathlib import Path
+
+import pytest
+
+from app.core.file_storage.schemas import (
+    FileChunkUploadRetCode,
+    FileUploadMode,
+    FileUploadTaskPrivate,
+    FileUploadTaskStatus,
+)
+from app.core.file_storage.task_store import FileUploadTaskStore
+
+
+def _task(mode: FileUploadMode, total_chunks: int = 3) -> FileUploadTaskPrivate:
+    return FileUploadTaskPrivate(
+        file_name="task_store.bin",
+        file_size=total_chunks * 10,
+        mode=mode,
+        chunk_size=10,
+        total_chunks=total_chunks,
+        temp_dir=Path("/tmp"),
+        storge_dir=Path("/tmp"),
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", [FileUploadMode.SEQUENTIAL, FileUploadMode.PARALLEL])
+async def test_claim_release_and_expire(redis, monkeypatch, mode):
+    now = 1000.0
+    monkeypatch.setattr("app.core.file_storage.task_store.time", lambda: now)
+    store = FileUploadTaskStore(redis, claim_timeout=60)
+    task = _task(mode)
+    await store.store(task)
+
+    code, claimed = await store.claim_chunk(task.id, 0, "a")
+    assert code is None
+    assert claimed.status == FileUploadTaskStatus.STARTED
+    # 同一个分片同时只能有一个请求在写
+    code, _ = await store.claim_chunk(task.id, 0, "b")
+    assert code == FileChunkUploadRetCode.CHUNK_UPLOADING
+
+    # 释放后可以重新占用，其它请求的token不能释放
+    await store.release_chunk(task.id, 0, "a")
+    code, _ = await store.claim_chunk(task.id, 0, "b")
+    assert code is None
+    await store.release_chunk(task.id, 0, "a")
+    code, _ = await store.claim_chunk(task.id, 0, "c")
+    assert code == FileChunkUploadRetCode.CHUNK_UPLOADING
+
+    # 占用的请求退出了没有释放，超过claim_timeout后可以被重新占用
+    now += 30
+    code, _ = await store.claim_chunk(task.id, 0, "c")
+    assert code == FileChunkUploadRetCode.CHUNK_UPLOADING
+    now += 31
+    code, _ = await store.claim_chunk(task.id, 0, "c")
+    assert code is None
+    now += 30
+    code, _ = await store.claim_chunk(task.id, 0, "d")
+    assert code == FileChunkUploadRetCode.CHUNK_UPLOADING
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", [FileUploadMode.SEQUENTIAL, FileUploadMode.PARALLEL])
+async def test_complete_after_reclaim(redis, monkeypatch, mode):
+    now = 1000.0
+    monkeypatch.setattr("app.core.file_storage.task_store.time", lambda: now)
+    store = FileUploadTaskStore(redis, claim_timeout=60)
+    task = _task(mode, total_chunks=1)
+    await store.store(task)
+
+    # 第一个请求的占用超时，被第二个请求接手
+    assert (await store.claim_chunk(task.id, 0, "a"))[0] is None
+    now += 61
+    assert (await store.claim_chunk(task.id, 0, "b"))[0] is None
+
+    # 原来的请求不能提交，只有接手的请求能完成任务
+    code = await store.complete_chunk(task, 0, 10, "a")
+    assert code == FileChunkUploadRetCode.CHUNK_UPLOADING
+    assert task.uploaded_bytes == 0
+    code = await store.complete_chunk(task, 0, 10, "b")
+    assert code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    code = await store.complete_chunk(task, 0, 10, "a")
+    assert code == FileChunkUploadRetCode.CHUNK_ALREADY_UPLOADED
+    assert (task.uploaded_bytes, task.received_chunks) == (10, 1)
+
+
+@pytest.mark.asyncio
+async def test_complete_chunks_finishes_task(redis):
+    store = FileUploadTaskStore(redis)
+
+    task = _task(FileUploadMode.SEQUENTIAL, total_chunks=2)
+    await store.store(task)
+    code, _ = await store.claim_chunk(task.id, 1, "a")
+    assert code == FileChunkUploadRetCode.CHUNK_IDX_WRONG
+    for chunk_idx in range(2):
+        code, task = await store.claim_chunk(task.id, chunk_idx, "a")
+        assert code is None
+        code = await store.complete_chunk(task, chunk_idx, 10, "a")
+    assert code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    assert (task.uploaded_bytes, task.nxt_chunk_idx) == (20, 2)
+
+    # 并行上传由置上最后一位的请求完成任务，重复完成的分片不重复计数
+    task = _task(FileUploadMode.PARALLEL)
+    await store.store(task)
+    for chunk_idx in (2, 0):
+        assert (await store.claim_chunk(task.id, chunk_idx, "a"))[0] is None
+        code = await store.complete_chunk(task, chunk_idx, 10, "a")
+        assert code == FileChunkUploadRetCode.WAITING_NEXT_CHUNK
+    assert task.nxt_chunk_idx == 1
+    code, _ = await store.claim_chunk(task.id, 2, "a")
+    assert code == FileChunkUploadRetCode.CHUNK_ALREADY_UPLOADED
+    assert (await store.claim_chunk(task.id, 1, "a"))[0] is None
+    code = await store.complete_chunk(task, 1, 10, "a")
+    assert code == FileChunkUploadRetCode.ALL_CHUNKS_UPLOADED
+    assert (task.uploaded_bytes, task.received_chunks, task.nxt_chunk_idx) == (30, 3, 3)
+
+    await store.finish(task)
+    code, _ = await store.claim_chunk(task.id, 1, "a")
+    assert code == FileChunkUploadRetCode.TASK_ALREADY_FINISHED
+    assert (await store.get(task.id)).status == FileUploadTaskStatus.FINISHED